@@ -1,56 +1,139 @@
 #!python3
 r""" ImeAudioIODevice.py
 
-newrel: list of things to do in this class
-    - create a buffer for the mix
-    - sum the track data into the buffer
-    - there are now different indexs and positions that need translation
+    ImeAudioIODevice is the QIODevice a QAudioSink pulls the project mix
+    from.
+
+    There are three kinds of position, this class translates between them
         - self.pos()    the byte position of ImeAudioIODevice from
-                        ImeAudioPlayer's point of view
-        - track.getData uses the index into the ys numpy array
-                        this is a frame index, and each frame is 4 bytes
-                        because we convert all formats to 32 bit arrays
-        - mix buffer    we need to decide the width, but this is going
-                        to also be an array of frames, either 32 or 64 wide
-                        also indexed by frame, not byte or time
-      this class should handle all the fix-ups needed translate from pos to
-      indexes and visa-versa
+                        ImeAudioPlayer's point of view, always a whole
+                        number of sink frames
+        - frame         index into the project, pos() // bytes_per_frame,
+                        this is what ImeMixEngine and track.getData take
+        - sink frame    channels samples of the sink's sample format,
+                        bytes_per_frame bytes
+    The mix is summed by an ImeMixEngine in float and converted to the sink's
+    format by an ImeSampleConverter, both into buffers they own. They run on
+    an ImeRenderThread that keeps an ImeRingBuffer read_ahead frames ahead
+    of the playhead, readData only copies out of the ring, so a busy GUI
+    thread does not starve the sink. The ring counts underruns and overruns.
 
     Copyright (c) 2024 Chip Ueltschey All rights reserved.
 """
+import time
+
+import numpy
+
 import PySide6
+import PySide6.QtMultimedia
+
+import ImeMetrics
+import ImeMixEngine
+import ImeRenderThread
+import ImeRingBuffer
+import ImeSampleConverter
 
 
+# QAudioFormat.SampleFormat: dtype of the samples
+sample_dtypes = {
+    PySide6.QtMultimedia.QAudioFormat.Int16: numpy.dtype(numpy.int16),
+    PySide6.QtMultimedia.QAudioFormat.Int32: numpy.dtype(numpy.int32),
+    PySide6.QtMultimedia.QAudioFormat.Float: numpy.dtype(numpy.float32),
+}
 
 
 class ImeAudioIODevice(PySide6.QtCore.QIODevice):
+    # the project frames before and after a seek
+    seek_signal = PySide6.QtCore.Signal(int, int)
 
-    def __init__(self, tracks):
+    def __init__(self, tracks, audio_format, read_ahead=ImeRenderThread.READ_AHEAD,
+                 block_frames=ImeRenderThread.RENDER_FRAMES):
         super().__init__()
+        if audio_format.sampleFormat() not in sample_dtypes:
+            raise ValueError(f"{self.__class__.__name__} does not support {audio_format.sampleFormat()}")
         self.tracks = tracks
+        self.framerate = audio_format.sampleRate()
+        channels = audio_format.channelCount()
+        dtype = sample_dtypes[audio_format.sampleFormat()]
+        self.engine = ImeMixEngine.ImeMixEngine(tracks, channels=channels, block_frames=block_frames, metering=True)
+        self.converter = ImeSampleConverter.ImeSampleConverter(dtype, channels, block_frames)
+        self.ring = ImeRingBuffer.ImeRingBuffer(max(read_ahead, block_frames), channels, dtype)
+        self.bytes_per_frame = self.converter.bytes_per_frame
+        # played when the ring runs dry, enough for any read
+        self._silence = bytes(self.ring.capacity * self.bytes_per_frame)
+        self.render = None
+
+    def frame(self):
+        """Returns the project frame of the current position."""
+        return self.pos() // self.bytes_per_frame
+
+    def open(self, mode):
+        opened = super().open(mode)
+        if opened:
+            self._start_render()
+        return opened
+
+    def close(self):
+        self._stop_render()
+        super().close()
+
+    def _start_render(self):
+        self._stop_render()
+        self.ring.clear()
+        self.render = ImeRenderThread.ImeRenderThread(
+            self.engine, self.converter, self.ring, frame=self.frame(), framerate=self.framerate)
+        self.render.start()
 
+    def _stop_render(self):
+        if self.render is not None:
+            self.render.stop()
+            self.render = None
 
     def readData(self, maxSize):
-        print(f"{self.__class__.__name__}.readData({maxSize=})")
-        current_pos = self.pos()
-        data = self.tracks[0].getData(current_pos, current_pos + maxSize)
-        self.seek(current_pos + len(data))  # Update position
+        # Runs on the audio thread, only copies out of the ring the render
+        # thread fills. QIODevice.read advances pos by what we return, so
+        # there is no seek here.
+        timed = ImeMetrics.metrics.enabled
+        if timed:
+            t0 = time.perf_counter_ns()
+        nframes = maxSize // self.bytes_per_frame
+        if self.render is None or nframes <= 0:
+            return b''
+        if self.ring.read_available() == 0 and self.frame() >= self.engine.nframes():
+            # the end of the mix, the sink goes idle
+            return b''
+        data = self.ring.read_bytes(nframes)
+        if not data:
+            # underrun, play silence and have the renderer skip it so the
+            # audio stays in step with pos
+            nframes = min(nframes, self.ring.capacity)
+            self.render.silence_frames += nframes
+            data = self._silence[:nframes * self.bytes_per_frame]
+            if timed:
+                ImeMetrics.metrics.counter('audio.underruns').add()
+        self.render.wake()
+        if timed:
+            ImeMetrics.metrics.counter('audio.bytes_served').add(len(data))
+            ImeMetrics.metrics.histogram('audio.callback').observe(time.perf_counter_ns() - t0)
         return data
 
     def seek(self, pos):
-        print(f"{self.__class__.__name__}.seek({pos=})")
-        return super().seek(pos)  # Call base class implementation
+        if ImeMetrics.metrics.enabled:
+            ImeMetrics.metrics.counter('audio.seeks').add()
+        old_frame = self.frame()
+        # keep the position on a frame boundary
+        moved = super().seek(pos - pos % self.bytes_per_frame)
+        if moved and self.isOpen():
+            # what is in the ring was rendered for the old position
+            self._start_render()
+        if moved:
+            self.seek_signal.emit(old_frame, self.frame())
+        return moved
 
     def isSequential(self):
-        print(f"{self.__class__.__name__}.isSequential()")
         # Return True if your device is sequential, False if random-access
         return False
 
     def bytesAvailable(self):
-        print(f"{self.__class__.__name__}.bytesAvailable()")
-        # bugbug: need to do this operation on the project's mix buffer and not
-        #         on the tracks themselves, but that requires that we make the
-        #         project mix buffer first...
-        if not self.tracks:
-            return 0
-        return max(0, self.tracks[0].totalSize() - self.pos())
+        remaining = max(0, self.engine.nframes() - self.frame()) * self.bytes_per_frame
+        return remaining + super().bytesAvailable()
@@ -1,7 +1,34 @@
 #!python3
 r""" ImeAudioPlayer.py
 
+    ImeAudioPlayer plays the project mix through a QAudioSink.
 
+    The output device, the sample format, the channel count and the sink
+    buffer size come from the settings, the sample rate is the project rate
+    the waves were resampled to when they were opened:
+        audio_output            id of the QAudioDevice, default device if
+                                missing or unplugged
+        audio_sample_format     Int16, Int32 or Float
+        audio_channels          channels of the sink, 1 or 2, what
+                                ImeMixEngine mixes
+        audio_buffer_frames     sink buffer in frames, 0 lets the backend
+                                choose
+    configure() changes them, and rebuild() replaces the sink and the IO
+    device in place, keeping the playhead, and resumes playback if it was
+    playing. The new ones are made before the old ones are torn down, so a
+    setting that fails leaves the player as it was. The buffer size is a
+    request, the backend may round it, what it chose is in buffer_frames
+    once the sink starts.
+
+    The output latency is measured while playing. The IO device has handed
+    the sink everything up to its pos, the sink reports in processedUSecs how
+    much of that it has played since start, the difference is what is still
+    queued between us and the speaker:
+        latency = (frames read since start) / framerate - processedUSecs
+    A seek moves pos but not processedUSecs, so it moves the frame the
+    count starts from by as much.
+    It is shown next to the player buttons, emitted by latency_signal and
+    recorded in the ImeMetrics histogram audio.output_latency.
 
     Copyright (c) 2024 Chip Ueltschey All rights reserved.
 """
@@ -9,6 +36,8 @@ import PySide6
 import PySide6.QtMultimedia
 
 import ImeAudioIODevice
+import ImeMetrics
+import ImeRenderThread
 
 
 player_buttons = [
@@ -20,42 +49,47 @@ player_buttons = [
     'player_pause',
 ]
 
+# setting value: QAudioFormat.SampleFormat, what ImeAudioIODevice can render
+SAMPLE_FORMATS = {
+    'Int16': PySide6.QtMultimedia.QAudioFormat.Int16,
+    'Int32': PySide6.QtMultimedia.QAudioFormat.Int32,
+    'Float': PySide6.QtMultimedia.QAudioFormat.Float,
+}
+DEFAULT_SAMPLE_FORMAT = 'Int16'
+DEFAULT_CHANNELS = 2
+# ImeMixEngine mixes mono or stereo
+MAX_CHANNELS = 2
+# 0 keeps the buffer size the backend picks
+DEFAULT_BUFFER_FRAMES = 0
+# milliseconds between latency measurements while playing
+LATENCY_INTERVAL = 500
+
 
 class ImeAudioPlayer(PySide6.QtCore.QObject):
+    latency_signal = PySide6.QtCore.Signal(float)
+
     def __init__(self, parent, attached_actions):
         super().__init__(parent)
+        self.tracks = parent.parent.tracks
+        self.settings = parent.parent.settings
+        self.audio_sink = None
+        self.io_device = None
+        self.buffer_frames = 0
+        self.latency = 0.0
+        # project frame the sink started at, processedUSecs counts from there
+        self._start_frame = 0
 
-        # newrel: setup the signals to make this a project setting, such that
-        #         if the user changes it we will reinit our player with the new
-        #         device
-        self.audio_device = PySide6.QtMultimedia.QMediaDevices.defaultAudioOutput()
-
-        # Create a QAudioFormat object and set its properties
-        # newrel: make the audio format configurable at the project level.
-        self.audio_format = PySide6.QtMultimedia.QAudioFormat()
-        # bugbug: these settings are all questionable...and may need to be
-        #         configurable
-        self.audio_format.setSampleRate(44100)
-        self.audio_format.setChannelCount(1)
-        #self.audio_format.setSampleFormat(PySide6.QtMultimedia.QAudioFormat.Int32)
-        self.audio_format.setSampleFormat(PySide6.QtMultimedia.QAudioFormat.Int16)
-
-
-        # newrel: if either the device or the format change at the project
-        #         level we need to create a new sink using the new device and
-        #         format
-        self.audio_sink = PySide6.QtMultimedia.QAudioSink(self.audio_device, self.audio_format)
-        self.audio_sink.stateChanged.connect(self.on_state_changed)
+        # follow devices being plugged and unplugged
+        self.media_devices = PySide6.QtMultimedia.QMediaDevices(self)
+        self.media_devices.audioOutputsChanged.connect(self.on_outputs_changed)
 
+        self.latency_timer = PySide6.QtCore.QTimer(self)
+        self.latency_timer.setInterval(LATENCY_INTERVAL)
+        self.latency_timer.timeout.connect(self.measure_latency)
 
-        # bugbug: connnect this to an interface signal
+        self.rebuild()
         self.set_volume(1.0)
-
-        self.io_device = ImeAudioIODevice.ImeAudioIODevice(parent.parent.tracks)
-        self.io_device.open(PySide6.QtCore.QIODevice.ReadOnly)
-        print(f"{self.io_device.isSequential()=}, {self.io_device.pos()=}")
-        #self.setSourceDevice(self.io_device)
-        self.audio_sink.start(self.io_device)
+        self._start()
 
         self.widget = PySide6.QtWidgets.QWidget()
         self.widget.setSizePolicy(PySide6.QtWidgets.QSizePolicy.Fixed, PySide6.QtWidgets.QSizePolicy.Fixed)
@@ -71,35 +105,225 @@ class ImeAudioPlayer(PySide6.QtCore.QObject):
             button.clicked.connect(attached_actions[action_name].trigger)
             button.setSizePolicy(PySide6.QtWidgets.QSizePolicy.Fixed, PySide6.QtWidgets.QSizePolicy.Fixed)
             layout.addWidget(button, alignment=PySide6.QtCore.Qt.AlignLeft)
+        self.latency_label = PySide6.QtWidgets.QLabel()
+        self.latency_label.setToolTip("Output latency and sink buffer size")
+        self.latency_signal.connect(self.show_latency)
+        layout.addWidget(self.latency_label, alignment=PySide6.QtCore.Qt.AlignLeft)
+
+    def audio_device(self):
+        """Returns the QAudioDevice of the settings, or the default output."""
+        device_id = self.settings.value("audio_output")
+        if device_id:
+            for device in PySide6.QtMultimedia.QMediaDevices.audioOutputs():
+                if device.id() == device_id:
+                    return device
+        return PySide6.QtMultimedia.QMediaDevices.defaultAudioOutput()
+
+    def audio_format(self, device):
+        """Returns the QAudioFormat of the settings at the project rate.
+
+        A device that does not take the channels or sample format of the
+        settings gets its preferred ones, still at the project rate.
+        """
+        audio_format = PySide6.QtMultimedia.QAudioFormat()
+        audio_format.setSampleRate(self.tracks.framerate)
+        channels = int(self.settings.value("audio_channels", DEFAULT_CHANNELS))
+        audio_format.setChannelCount(min(MAX_CHANNELS, max(1, channels)))
+        sample_format = self.settings.value("audio_sample_format", DEFAULT_SAMPLE_FORMAT)
+        audio_format.setSampleFormat(SAMPLE_FORMATS.get(sample_format, SAMPLE_FORMATS[DEFAULT_SAMPLE_FORMAT]))
+        if device.isNull() or device.isFormatSupported(audio_format):
+            return audio_format
+        preferred = device.preferredFormat()
+        print(f"{device.description()} does not support {audio_format}, using the channels and sample format of {preferred}")
+        audio_format.setChannelCount(min(MAX_CHANNELS, max(1, preferred.channelCount())))
+        if preferred.sampleFormat() in SAMPLE_FORMATS.values():
+            audio_format.setSampleFormat(preferred.sampleFormat())
+        return audio_format
+
+    def configure(self, device=None, sample_format=None, channels=None, buffer_frames=None):
+        """Saves the given settings and rebuilds the sink with them.
+
+        device: QAudioDevice to play on
+        sample_format: key of SAMPLE_FORMATS
+        channels: channels of the sink
+        buffer_frames: sink buffer size in frames, 0 lets the backend choose
+        """
+        if sample_format is not None and sample_format not in SAMPLE_FORMATS:
+            raise ValueError(f"{sample_format=} must be one of {list(SAMPLE_FORMATS)}")
+        if channels is not None and not 1 <= channels <= MAX_CHANNELS:
+            raise ValueError(f"{channels=} must be 1 to {MAX_CHANNELS}")
+        if buffer_frames is not None and buffer_frames < 0:
+            raise ValueError(f"{buffer_frames=} must not be negative")
+        if device is not None:
+            self.settings.setValue("audio_output", device.id())
+        if sample_format is not None:
+            self.settings.setValue("audio_sample_format", sample_format)
+        if channels is not None:
+            self.settings.setValue("audio_channels", channels)
+        if buffer_frames is not None:
+            self.settings.setValue("audio_buffer_frames", buffer_frames)
+        self.rebuild()
+
+    def rebuild(self):
+        """Replaces the sink and the IO device with ones made from the
+        settings, without moving the playhead."""
+        device = self.audio_device()
+        audio_format = self.audio_format(device)
+        buffer_frames = int(self.settings.value("audio_buffer_frames", DEFAULT_BUFFER_FRAMES))
+        # frames mixed ahead of the playhead, more survives longer GUI stalls
+        # at the cost of a slower response to mute, solo, volume and pan, it
+        # has to cover at least the sink buffer
+        read_ahead = int(self.settings.value("render_read_ahead", ImeRenderThread.READ_AHEAD))
+        # raises before anything is torn down if the format is unusable
+        io_device = ImeAudioIODevice.ImeAudioIODevice(self.tracks, audio_format,
+                                                      read_ahead=max(read_ahead, 2 * buffer_frames))
+
+        playing = False
+        frame = 0
+        if self.audio_sink is not None:
+            playing = self.audio_sink.state() in (PySide6.QtMultimedia.QAudio.State.ActiveState,
+                                                  PySide6.QtMultimedia.QAudio.State.IdleState)
+            frame = self.io_device.frame()
+            self.latency_timer.stop()
+            self.audio_sink.stateChanged.disconnect(self.on_state_changed)
+            self.io_device.seek_signal.disconnect(self.on_seek)
+            volume = self.audio_sink.volume()
+            self.audio_sink.stop()
+            self.io_device.close()
+            self.audio_sink.deleteLater()
+            self.io_device.deleteLater()
+        else:
+            volume = 1.0
+
+        self.device = device
+        self.format = audio_format
+        self.audio_sink = PySide6.QtMultimedia.QAudioSink(self.device, self.format, self)
+        self.audio_sink.setVolume(volume)
+        self.audio_sink.stateChanged.connect(self.on_state_changed)
+        if buffer_frames > 0:
+            self.audio_sink.setBufferSize(buffer_frames * self.format.bytesPerFrame())
+
+        self.io_device = io_device
+        self.io_device.seek_signal.connect(self.on_seek)
+        self.io_device.open(PySide6.QtCore.QIODevice.ReadOnly)
+        if frame:
+            self.io_device.seek(frame * self.io_device.bytes_per_frame)
+        if playing:
+            self._start()
+
+    def _start(self):
+        self._start_frame = self.io_device.frame()
+        self.audio_sink.start(self.io_device)
+        # the backend settles the buffer size when it starts
+        self.buffer_frames = self.audio_sink.bufferSize() // max(1, self.format.bytesPerFrame())
+        self.latency_timer.start()
+
+    def output_latency(self):
+        """Returns the seconds of audio read from the IO device that the
+        sink has not played yet."""
+        read = (self.io_device.frame() - self._start_frame) / self.format.sampleRate()
+        return max(0.0, read - self.audio_sink.processedUSecs() / 1e6)
+
+    @PySide6.QtCore.Slot(int, int)
+    def on_seek(self, old_frame, new_frame):
+        # the sink keeps counting processedUSecs across the jump
+        self._start_frame += new_frame - old_frame
+
+    @PySide6.QtCore.Slot()
+    def measure_latency(self):
+        if self.audio_sink.state() != PySide6.QtMultimedia.QAudio.State.ActiveState:
+            return
+        self.latency = self.output_latency()
+        if ImeMetrics.metrics.enabled:
+            ImeMetrics.metrics.histogram('audio.output_latency').observe(int(self.latency * 1e9))
+        self.latency_signal.emit(self.latency)
+
+    @PySide6.QtCore.Slot(float)
+    def show_latency(self, latency):
+        self.latency_label.setText(f" {latency * 1000:.1f} ms, buffer {self.buffer_frames}")
+
+    @PySide6.QtCore.Slot()
+    def on_outputs_changed(self):
+        # the device we play on was unplugged, fall back to the default
+        ids = [device.id() for device in PySide6.QtMultimedia.QMediaDevices.audioOutputs()]
+        if self.device.id() not in ids:
+            self.rebuild()
 
     def play(self):
-        print(f"play")
         if self.audio_sink.state() == PySide6.QtMultimedia.QAudio.State.StoppedState:
-            self.audio_sink.start(self.io_device)
+            self._start()
         elif self.audio_sink.state() == PySide6.QtMultimedia.QAudio.State.SuspendedState:
             self.audio_sink.resume()
 
     def pause(self):
-        print(f"pause")
         if self.audio_sink.state() == PySide6.QtMultimedia.QAudio.State.ActiveState:
             self.audio_sink.suspend()
         elif self.audio_sink.state() == PySide6.QtMultimedia.QAudio.State.SuspendedState:
             self.audio_sink.resume()
 
     def stop(self):
-        print(f"stop")
+        self.latency_timer.stop()
         if self.audio_sink.state() != PySide6.QtMultimedia.QAudio.State.StoppedState:
             self.audio_sink.stop()
             self.io_device.reset()  # Reset the IO device to the beginning
 
     @PySide6.QtCore.Slot(PySide6.QtMultimedia.QAudio.State)
     def on_state_changed(self, state):
-        print(f"on_state_changed({state=})")
         if state == PySide6.QtMultimedia.QAudio.State.IdleState:
             # This is emitted when the audio device has no more data to process
             self.stop()
 
     def set_volume(self, volume):
-        print(f"set_volume({volume=})")
         # volume should be between 0.0 and 1.0
         self.audio_sink.setVolume(volume)
+
+
+class ImeAudioSettingsDialog(PySide6.QtWidgets.QDialog):
+    # Edits the audio settings of an ImeAudioPlayer, applied on OK.
+
+    def __init__(self, parent, player):
+        super().__init__(parent)
+        self.player = player
+        self.setWindowTitle("Audio Settings")
+        layout = PySide6.QtWidgets.QFormLayout(self)
+
+        self.device = PySide6.QtWidgets.QComboBox()
+        for device in PySide6.QtMultimedia.QMediaDevices.audioOutputs():
+            self.device.addItem(device.description(), device)
+            if device.id() == player.device.id():
+                self.device.setCurrentIndex(self.device.count() - 1)
+        layout.addRow("Output", self.device)
+
+        self.sample_format = PySide6.QtWidgets.QComboBox()
+        self.sample_format.addItems(list(SAMPLE_FORMATS))
+        for name, sample_format in SAMPLE_FORMATS.items():
+            if sample_format == player.format.sampleFormat():
+                self.sample_format.setCurrentText(name)
+        layout.addRow("Sample format", self.sample_format)
+
+        self.channels = PySide6.QtWidgets.QSpinBox()
+        self.channels.setRange(1, MAX_CHANNELS)
+        self.channels.setValue(player.format.channelCount())
+        layout.addRow("Channels", self.channels)
+
+        self.buffer_frames = PySide6.QtWidgets.QSpinBox()
+        self.buffer_frames.setRange(0, 1 << 16)
+        self.buffer_frames.setSingleStep(64)
+        self.buffer_frames.setSpecialValueText("Default")
+        self.buffer_frames.setValue(int(player.settings.value("audio_buffer_frames", DEFAULT_BUFFER_FRAMES)))
+        self.buffer_frames.setToolTip(f"Frames at {player.format.sampleRate()} Hz, now {player.buffer_frames}")
+        layout.addRow("Buffer frames", self.buffer_frames)
+
+        buttons = PySide6.QtWidgets.QDialogButtonBox(
+            PySide6.QtWidgets.QDialogButtonBox.Ok | PySide6.QtWidgets.QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    def accept(self):
+        self.player.configure(
+            device=self.device.currentData(),
+            sample_format=self.sample_format.currentText(),
+            channels=self.channels.value(),
+            buffer_frames=self.buffer_frames.value())
+        super().accept()
@@ -0,0 +1,384 @@
+#!python3
+r""" ImeBounce.py - render the project mix or its stems to wav files
+
+    A bounce splits the timeline into segments and renders them in a pool of
+    worker processes, so it runs on every core and as fast as they allow
+    rather than in real time. The segments come back to this process in
+    timeline order and are stitched together by an ImeWavWriter, so the
+    memory used is a few segments per worker no matter how long the project.
+
+    The workers get a picklable description of the project, not the tracks
+    themselves: for each track its volume, pan, mute and solo and the
+    filename, position, offset, length and gain of each clip. Each worker
+    opens the sources once, the same way the tracks did (memory mapped,
+    through the same ImeWaveCache), and mixes with the same ImeMixEngine as
+    playback. Without a cache, a source at another rate than the project
+    would be decoded and resampled whole in the memory of every worker, so
+    it is resampled once here instead, streamed through an ImeResampler
+    into a float wav file in a temporary directory that the workers map.
+
+    The mixdown can go through an ImePipeline of master processors. A
+    processor with state, e.g. a Filter, would start each segment cold, so
+    every segment is rendered from preroll frames before its start and those
+    frames are dropped. With preroll at least as long as the memory of the
+    processors, len(taps) - 1 for a Filter, the stitched output is the same
+    as one render of the whole timeline. Only the last segment flushes the
+    pipeline, its tail extends the file past the end of the timeline.
+    Processors must not depend on the absolute position in the stream,
+    Window and Apodize are not supported here.
+
+    A bounce that is cancelled or fails deletes the files it was writing,
+    so a file that exists is always a whole bounce. Cancelling raises
+    BounceCancelled.
+
+    Headless use
+        python ImeBounce.py mix.wav drums.wav bass.wav --bits 24
+        python ImeBounce.py stems.wav drums.wav bass.wav --stems
+    puts each input file on its own track at the start of the timeline, as
+    opening them in ime does.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import argparse
+import concurrent.futures
+import multiprocessing
+import os
+import pathlib
+import sys
+import tempfile
+import threading
+
+import numpy
+
+import PySide6
+import PySide6.QtCore
+
+import ImeClip
+import ImeMixEngine
+import ImeResampler
+import ImeTrack
+import ImeWave
+import ImeWavFile
+import ImeWavWriter
+import ImeWaveCache
+
+
+# frames per segment, about 12 s at 44.1 kHz
+SEGMENT_FRAMES = 1 << 19
+# frames mixed per block inside a segment
+RENDER_FRAMES = 1 << 14
+
+
+class BounceCancelled(Exception):
+    """Raised by bounce when it is cancelled, its files are deleted."""
+
+
+def describe(tracks):
+    """Returns a picklable description of tracks for the worker processes.
+
+    tracks: ImeTrackCollection
+
+    returns: dict, see the module docstring
+    """
+    cache = getattr(tracks, 'cache', None)
+    project = dict(
+        precision=getattr(tracks, 'precision', None),
+        cache=(str(cache.directory), cache.budget) if cache else None,
+        tracks=[],
+        framerate=getattr(tracks, 'framerate', None),
+    )
+    for track in tracks:
+        clips = []
+        for clip in track.clips:
+            if clip.name not in track.ws or not os.path.isfile(clip.name):
+                raise ValueError(f"{clip} of track {track.name!r} has no source file to bounce from")
+            clips.append((clip.name, clip.position, clip.offset, clip.length, clip.gain))
+            project['framerate'] = project['framerate'] or clip.wave.framerate
+        project['tracks'].append(dict(name=track.name, volume=track.volume, pan=track.pan,
+                                      mute=track.mute, solo=track.solo, clips=clips))
+    return project
+
+
+def stem_filename(filename, index, name):
+    """Names the file of one stem after the bounce filename and the track."""
+    path = pathlib.Path(filename)
+    label = pathlib.Path(str(name)).stem if name else 'track'
+    return str(path.with_name(f"{path.stem}-{index + 1:02d}-{label}{path.suffix}"))
+
+
+def _resample_sources(project, directory):
+    """Converts the sources at another rate than the project for the
+    workers, see the module docstring.
+
+    project: description from describe(), without a cache
+    directory: where the converted files are written
+
+    returns: copy of project whose clips name the converted files
+    """
+    framerate = project['framerate']
+    converted = dict()
+    tracks = []
+    for t in project['tracks']:
+        clips = []
+        for filename, position, offset, length, gain in t['clips']:
+            if filename not in converted:
+                converted[filename] = filename
+                if ImeWavFile.ImeWavFile(filename).framerate != framerate:
+                    w = ImeWave.ImeWave.from_file(filename, mmap=True, precision=project['precision'])
+                    out = os.path.join(directory, f"{len(converted):03d}-{pathlib.Path(filename).name}")
+                    resampler = ImeResampler.ImeResampler(w.framerate, framerate, dtype=w.working_dtype)
+                    with ImeWavWriter.ImeWavWriter(out, framerate, w.nchannels, bits=8 * w.working_dtype.itemsize,
+                                                   is_float=True) as writer:
+                        for block in resampler(w.iter_blocks()):
+                            writer.write(block.T)
+                    converted[filename] = out
+            clips.append((converted[filename], position, offset, length, gain))
+        tracks.append(dict(t, clips=clips))
+    return dict(project, tracks=tracks)
+
+
+# The state of a worker process, set up once by _init_worker
+_worker = None
+
+
+def _init_worker(project, channels, pipeline, preroll, stems):
+    global _worker
+    cache = ImeWaveCache.ImeWaveCache(*project['cache']) if project['cache'] else None
+    sources = dict()
+    tracks = []
+    for t in project['tracks']:
+        track = ImeTrack.ImeTrack(t['name'])
+        track.volume, track.pan, track.mute, track.solo = t['volume'], t['pan'], t['mute'], t['solo']
+        for filename, position, offset, length, gain in t['clips']:
+            if filename not in sources:
+                sources[filename] = ImeWave.ImeWave.from_file(
+                    filename, mmap=True, precision=project['precision'], cache=cache, framerate=project['framerate'])
+            track.ws[filename] = sources[filename]
+            track.add_clip(ImeClip.ImeClip(sources[filename], position, offset, length, gain, name=filename))
+        tracks.append(track)
+    if stems:
+        # Each stem is mixed alone, so solo is resolved across all the tracks
+        # first. A stem that is not audible in the mix is silent.
+        soloed = any(track.solo for track in tracks)
+        for track in tracks:
+            track.mute = track.mute or (soloed and not track.solo)
+            track.solo = False
+        engines = [ImeMixEngine.ImeMixEngine([track], channels, RENDER_FRAMES) for track in tracks]
+    else:
+        engines = [ImeMixEngine.ImeMixEngine(tracks, channels, RENDER_FRAMES)]
+    _worker = dict(engines=engines, pipeline=None if stems else pipeline, preroll=preroll)
+
+
+def _mix_blocks(engine, start, end):
+    for frame in range(start, end, RENDER_FRAMES):
+        # copied, the engine reuses its buffer for the next block
+        yield engine.mix(frame, min(RENDER_FRAMES, end - frame)).copy()
+
+
+def _render_segment(start, end, last):
+    """Renders the frames [start, end) of every output, runs in a worker.
+
+    start: first frame of the segment
+    end: frame one past the last frame of the segment
+    last: boolean, the segment ends the timeline, flush the pipeline
+
+    returns: list of float32 arrays of shape (channels, frames), one per
+             output file
+    """
+    pipeline = _worker['pipeline']
+    first = max(0, start - _worker['preroll']) if pipeline else start
+    outputs = []
+    for engine in _worker['engines']:
+        blocks = _mix_blocks(engine, first, end)
+        if pipeline:
+            pipeline.reset()
+            blocks = pipeline(blocks, flush=last)
+        # drop the preroll, it only warmed up the pipeline
+        skip = start - first
+        pieces = []
+        for block in blocks:
+            drop = min(skip, block.shape[-1])
+            skip -= drop
+            if drop < block.shape[-1]:
+                pieces.append(block[..., drop:].astype(numpy.float32, copy=False))
+        if pieces:
+            outputs.append(numpy.concatenate(pieces, axis=-1))
+        else:
+            outputs.append(numpy.zeros((engine.channels, 0), dtype=numpy.float32))
+    return outputs
+
+
+def bounce(tracks, filename, channels=2, bits=24, is_float=False, dither=False, stems=False,
+           pipeline=None, preroll=0, segment_frames=SEGMENT_FRAMES, max_workers=None,
+           progress=None, cancel=None):
+    """Renders the tracks to wav files, faster than real time.
+
+    tracks: ImeTrackCollection, or a description from describe()
+    filename: path of the mixdown, stems are named after it, see stem_filename
+    channels: 1 or 2
+    bits, is_float, dither: sample format, see ImeWavWriter
+    stems: boolean, write one file per track instead of the mixdown
+    pipeline: optional ImePipeline applied to the mixdown
+    preroll: frames each segment renders before its start to warm up the
+             pipeline, at least the memory of its processors
+    segment_frames: frames per segment, the unit of work of a worker
+    max_workers: number of worker processes, default is one per core
+    progress: optional function(segments done, segments total)
+    cancel: optional threading.Event that stops the bounce, see
+            BounceCancelled
+
+    returns: list of the filenames written
+    """
+    project = tracks if isinstance(tracks, dict) else describe(tracks)
+    framerate = project['framerate']
+    length = max((position + n for t in project['tracks'] for _, position, _, n, _ in t['clips']), default=0)
+    if length == 0:
+        raise ValueError(f"nothing to bounce to {filename}, the tracks have no clips")
+    bounds = list(range(0, length, segment_frames)) + [length]
+    segments = list(zip(bounds[:-1], bounds[1:]))
+    if stems:
+        filenames = [stem_filename(filename, i, t['name']) for i, t in enumerate(project['tracks'])]
+    else:
+        filenames = [filename]
+    writers = [ImeWavWriter.ImeWavWriter(f, framerate, channels, bits=bits, is_float=is_float, dither=dither)
+               for f in filenames]
+
+    max_workers = max_workers or os.cpu_count()
+    # spawn rather than fork, the GUI process has threads and Qt state
+    context = multiprocessing.get_context('spawn')
+    complete = False
+    try:
+        with tempfile.TemporaryDirectory(prefix='bounce-') as directory:
+            if not project['cache']:
+                project = _resample_sources(project, directory)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=max_workers, mp_context=context, initializer=_init_worker,
+                    initargs=(project, channels, pipeline, preroll, stems)) as executor:
+                # a window of segments in flight keeps every worker busy while
+                # the finished segments wait for their turn to be written
+                pending = dict()
+                queued = iter(enumerate(segments))
+                for k, (start, end) in queued:
+                    pending[k] = executor.submit(_render_segment, start, end, k == len(segments) - 1)
+                    if len(pending) >= 2 * max_workers:
+                        break
+                for k in range(len(segments)):
+                    if cancel is not None and cancel.is_set():
+                        for future in pending.values():
+                            future.cancel()
+                        raise BounceCancelled(f"bounce to {filename} cancelled")
+                    outputs = pending.pop(k).result()
+                    for writer, ys in zip(writers, outputs):
+                        writer.write(ys.T)
+                    for j, (start, end) in queued:
+                        pending[j] = executor.submit(_render_segment, start, end, j == len(segments) - 1)
+                        break
+                    if progress:
+                        progress(k + 1, len(segments))
+        complete = True
+    finally:
+        for writer in writers:
+            writer.close()
+        if not complete:
+            # a truncated file must not pass for a bounce
+            for f in filenames:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+    return filenames
+
+
+class ImeBouncer(PySide6.QtCore.QObject):
+    # Runs a bounce without blocking the GUI thread. The signals are emitted
+    # in the thread that owns the bouncer, the GUI thread.
+    progress_signal = PySide6.QtCore.Signal(int, int)    # segments done, segments total
+    finished_signal = PySide6.QtCore.Signal(list)        # filenames written
+    cancelled_signal = PySide6.QtCore.Signal()           # nothing was written
+    failed_signal = PySide6.QtCore.Signal(str)           # error
+
+    # Emitted from the coordinating thread, only used to hop to the GUI thread
+    _progress_signal = PySide6.QtCore.Signal(int, int)
+    _done_signal = PySide6.QtCore.Signal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._cancel = threading.Event()
+        self._executor = None
+        self._progress_signal.connect(self.progress_signal, PySide6.QtCore.Qt.QueuedConnection)
+        self._done_signal.connect(self._on_done, PySide6.QtCore.Qt.QueuedConnection)
+
+    def start(self, tracks, filename, **kwargs):
+        """Starts bouncing tracks to filename.
+
+        The tracks are described right away, edits made while the bounce
+        runs do not change it.
+
+        tracks: ImeTrackCollection
+        filename: path of the mixdown
+        kwargs: passed on to bounce
+        """
+        project = describe(tracks)
+        self._cancel.clear()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.__class__.__name__)
+        future = self._executor.submit(bounce, project, filename, progress=self._progress_signal.emit,
+                                       cancel=self._cancel, **kwargs)
+        future.add_done_callback(self._done_signal.emit)
+
+    def cancel(self):
+        self._cancel.set()
+
+    @PySide6.QtCore.Slot(object)
+    def _on_done(self, future):
+        self._executor.shutdown(wait=False)
+        self._executor = None
+        error = future.exception()
+        if isinstance(error, BounceCancelled):
+            self.cancelled_signal.emit()
+        elif error is not None:
+            self.failed_signal.emit(str(error))
+        else:
+            self.finished_signal.emit(future.result())
+
+
+def parse():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output', help="wav file to write, stems are named after it")
+    parser.add_argument('inputs', nargs='+', help="wav files, one track each")
+    parser.add_argument('--stems', action='store_true', help="write one file per track")
+    parser.add_argument('--channels', type=int, default=2, choices=(1, 2))
+    parser.add_argument('--framerate', type=int, default=44100, help="project rate, inputs are resampled to it")
+    parser.add_argument('--bits', type=int, default=24)
+    parser.add_argument('--float', dest='is_float', action='store_true', help="write floating point PCM")
+    parser.add_argument('--dither', action='store_true')
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument('--cache', action='store_true', help="decode through the ImeWaveCache like ime does")
+    return parser.parse_args()
+
+
+def main():
+    args = parse()
+    tracks = ImeTrack.ImeTrackCollection(cache=ImeWaveCache.ImeWaveCache() if args.cache else None,
+                                         framerate=args.framerate)
+    for filename in args.inputs:
+        # no ImePeaks, nothing is drawn
+        w = ImeWave.ImeWave.from_file(filename, mmap=True, precision=tracks.precision, cache=tracks.cache,
+                                      framerate=tracks.framerate)
+        track = ImeTrack.ImeTrack(filename)
+        track.ws[filename] = w
+        track.add_clip(ImeClip.ImeClip(w, name=filename))
+        tracks.append(track)
+
+    def progress(done, total):
+        print(f"\rbounced {done} of {total} segments", end='', flush=True)
+
+    filenames = bounce(tracks, args.output, channels=args.channels, bits=args.bits, is_float=args.is_float,
+                       dither=args.dither, stems=args.stems, max_workers=args.workers, progress=progress)
+    print(f"\nwrote {', '.join(filenames)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+#!python3
+r""" ImeClip.py
+
+    An ImeClip places part of a source wave on a track.
+
+    The frames [offset, offset + length) of the source play at the project
+    frames [position, position + length), multiplied by gain. Clips do not
+    copy their source, any number of clips can share one ImeWave, which is
+    what splitting and trimming an item produces.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+
+
+class ImeClip:
+    """A region of a source wave at a position in the project."""
+
+    def __init__(self, wave, position=0, offset=0, length=None, gain=1.0, name=None):
+        """Initializes the clip.
+
+        wave: source ImeWave
+        position: project frame where the clip starts
+        offset: frame of the source that plays at position
+        length: number of frames, default is the rest of the source
+        gain: linear gain of the clip
+        name: label of the clip, e.g. the source filename
+        """
+        if length is None:
+            length = len(wave) - offset
+        if offset < 0 or length <= 0 or offset + length > len(wave):
+            raise ValueError(f"{self.__class__.__name__} {offset=} {length=} do not fit a source of {len(wave)} frames")
+        self.wave = wave
+        self.position = position
+        self.offset = offset
+        self.length = length
+        self.gain = gain
+        self.name = name
+
+    def __repr__(self):
+        return (f"ImeClip({self.name!r}, position={self.position}, offset={self.offset}, "
+                f"length={self.length}, gain={self.gain})")
+
+    @property
+    def end(self):
+        """Project frame one past the last frame of the clip."""
+        return self.position + self.length
+
+    def overlap(self, start, end):
+        """Maps the project frames [start, end) onto the clip.
+
+        start: first project frame
+        end: project frame one past the last
+
+        returns: (source_start, source_end, at), the source frames that play
+                 in the range and the index into the range where they land,
+                 or None if the clip does not play in the range
+        """
+        first = max(start, self.position)
+        last = min(end, self.end)
+        if first >= last:
+            return None
+        source_start = self.offset + first - self.position
+        return source_start, source_start + last - first, first - start
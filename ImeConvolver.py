@@ -0,0 +1,349 @@
+#!python3
+r""" ImeConvolver.py
+
+    ImeConvolver convolves a stream with an impulse response in the
+    frequency domain, and convolve() picks the fastest way to convolve two
+    arrays by their sizes.
+
+    Direct convolution, numpy.convolve, costs N * M multiplies. Through the
+    FFT it costs O((N + M) log(N + M)), which is what makes a reverb impulse
+    response of a few seconds usable on a track of a few minutes:
+        METHOD_DIRECT       numpy.convolve, for short filters, DIRECT_TAPS
+                            taps or fewer, where it beats the transforms
+        METHOD_FFT          one transform of the whole signal, when N + M
+                            is at most FFT_FRAMES
+        METHOD_PARTITIONED  uniformly partitioned overlap-save, for long
+                            signals and for streams
+    The partitioned method cuts the impulse response into partitions of B
+    frames and keeps their spectra, of size 2 * B. Each block of B input
+    frames is transformed once, pushed on a delay line of the last K input
+    spectra, and multiplied with the K partitions in one reduction, the
+    inverse transform of the sum gives B output frames. The memory is K + 1
+    spectra whatever the length of the signal. The larger B, the fewer
+    transforms and the longer a stream waits for a full block, so streams
+    pass the block size they want and convolve() uses large partitions.
+
+    A stream that cannot wait, e.g. an ImePipeline Filter, sets partial. The
+    output frames of a block only depend on the input frames up to them, so
+    a partly filled block padded with zeros gives its first frames exactly.
+    process then returns as many frames as it is given, at the cost of one
+    more transform pair per call that ends inside a block.
+
+    The spectra of an impulse response are computed once per partition size
+    and kept in a cache of at most CACHE_BYTES, keyed by a hash of the taps,
+    so convolving many tracks or blocks with the same response transforms it
+    once.
+
+    Arrays are 1-D or planar (channels, frames). A 1-D impulse response
+    applies to every channel, a planar one has one response per channel.
+    The transforms run in float32 for float32 input, else float64.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import collections
+import hashlib
+import threading
+
+import numpy
+
+
+METHOD_AUTO = 'auto'
+METHOD_DIRECT = 'direct'
+METHOD_FFT = 'fft'
+METHOD_PARTITIONED = 'partitioned'
+
+# filters up to this many taps are convolved directly
+DIRECT_TAPS = 64
+# the longest output one transform computes, longer is partitioned
+FFT_FRAMES = 1 << 20
+# partition sizes convolve() picks from, by the length of the response
+MIN_PARTITION = 1 << 12
+MAX_PARTITION = 1 << 16
+# bytes of impulse response spectra kept between calls
+CACHE_BYTES = 256 << 20
+
+
+def fft_size(n):
+    """Returns the smallest 2, 3, 5 smooth number at least n, the sizes the
+    FFT is fast at."""
+    best = 1 << max(0, (n - 1).bit_length())
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # the smallest power of 2 times p35 that reaches n
+            m = p35
+            while m < n:
+                m *= 2
+            best = min(best, m)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def _float_dtype(*arrays):
+    dtype = numpy.result_type(*arrays)
+    return numpy.dtype(numpy.float32) if dtype == numpy.float32 else numpy.dtype(numpy.float64)
+
+
+class _SpectraCache:
+    # LRU of impulse response spectra by (hash of the taps, fft size,
+    # partition size), bounded in bytes, shared by every thread
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, taps, nfft, partition):
+        """Returns the spectra of taps cut into partitions, see ImeConvolver.
+
+        taps: float array of shape (frames,) or (channels, frames)
+        nfft: transform size
+        partition: frames per partition, the whole response if None
+
+        returns: complex array of shape (..., partitions, nfft // 2 + 1)
+        """
+        digest = hashlib.blake2b(taps.tobytes(), digest_size=16).digest()
+        key = (digest, taps.shape, taps.dtype.str, nfft, partition)
+        with self._lock:
+            spectra = self._entries.get(key)
+            if spectra is not None:
+                self._entries.move_to_end(key)
+                return spectra
+        size = partition or taps.shape[-1]
+        count = -(-taps.shape[-1] // size)
+        pad = [(0, 0)] * (taps.ndim - 1) + [(0, count * size - taps.shape[-1])]
+        parts = numpy.pad(taps, pad).reshape(taps.shape[:-1] + (count, size))
+        spectra = numpy.fft.rfft(parts, nfft, axis=-1)
+        spectra.flags.writeable = False
+        with self._lock:
+            self._entries[key] = spectra
+            self._bytes += spectra.nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= old.nbytes
+        return spectra
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+# the cache of the application
+spectra_cache = _SpectraCache()
+
+
+def choose_method(nframes, ntaps):
+    """Returns the METHOD_ convolve() uses for these sizes."""
+    if min(nframes, ntaps) <= DIRECT_TAPS:
+        return METHOD_DIRECT
+    if nframes + ntaps - 1 <= FFT_FRAMES:
+        return METHOD_FFT
+    return METHOD_PARTITIONED
+
+
+def partition_size(ntaps):
+    """Returns the partition size convolve() uses for a response of ntaps."""
+    return min(MAX_PARTITION, max(MIN_PARTITION, 1 << max(0, (ntaps - 1).bit_length())))
+
+
+def convolve(xs, taps, method=METHOD_AUTO, block_frames=None):
+    """Convolves xs with taps, like numpy.convolve with mode="full".
+
+    xs: array of shape (frames,) or (channels, frames)
+    taps: impulse response, array of shape (frames,) or (channels, frames)
+    method: one of the METHOD_ constants, METHOD_AUTO picks by size
+    block_frames: partition size of METHOD_PARTITIONED, see partition_size
+
+    returns: array of xs.shape[-1] + taps.shape[-1] - 1 frames, 1-D if both
+             xs and taps are
+    """
+    dtype = _float_dtype(xs, taps)
+    xs = numpy.asarray(xs, dtype=dtype)
+    taps = numpy.asarray(taps, dtype=dtype)
+    n, m = xs.shape[-1], taps.shape[-1]
+    if n == 0 or m == 0:
+        raise ValueError(f"cannot convolve {n} frames with {m} taps")
+    if method == METHOD_AUTO:
+        method = choose_method(n, m)
+
+    if method == METHOD_DIRECT:
+        if xs.ndim == 1 and taps.ndim == 1:
+            return numpy.convolve(xs, taps, mode='full')
+        xs2 = xs.reshape(-1, n)
+        taps2 = taps.reshape(-1, m)
+        return numpy.stack([numpy.convolve(xs2[c % len(xs2)], taps2[c % len(taps2)], mode='full')
+                            for c in range(max(len(xs2), len(taps2)))])
+
+    if method == METHOD_FFT:
+        nfft = fft_size(n + m - 1)
+        spectrum = spectra_cache.get(taps, nfft, None)[..., 0, :]
+        return numpy.fft.irfft(numpy.fft.rfft(xs, nfft, axis=-1) * spectrum, nfft, axis=-1)[..., :n + m - 1].astype(dtype, copy=False)
+
+    if method == METHOD_PARTITIONED:
+        convolver = ImeConvolver(taps, block_frames or partition_size(m))
+        out = numpy.empty(numpy.broadcast_shapes(xs.shape[:-1], taps.shape[:-1]) + (n + m - 1,), dtype=dtype)
+        i = 0
+        for block in convolver(xs[..., k:k + convolver.block_frames] for k in range(0, n, convolver.block_frames)):
+            out[..., i:i + block.shape[-1]] = block
+            i += block.shape[-1]
+        return out
+
+    raise ValueError(f"{method=} unknown")
+
+
+class ImeConvolver:
+    """Uniformly partitioned overlap-save convolution of a stream."""
+
+    def __init__(self, taps, block_frames=MIN_PARTITION, partial=False):
+        """Transforms the impulse response, or takes it from the cache.
+
+        taps: impulse response, array of shape (frames,) or (channels, frames)
+        block_frames: partition size B, the output comes in multiples of it
+        partial: boolean, process also returns the output of a partly filled
+                 block, so it returns as many frames as it is given
+        """
+        self.taps = numpy.asarray(taps)
+        if not self.taps.shape[-1]:
+            raise ValueError(f"{self.__class__.__name__} needs at least one tap")
+        self.block_frames = block_frames
+        self.partial = partial
+        self.nfft = 2 * block_frames
+        self.reset()
+
+    def __repr__(self):
+        return (f"ImeConvolver(taps={self.taps.shape[-1]}, block_frames={self.block_frames}, "
+                f"partitions={-(-self.taps.shape[-1] // self.block_frames)})")
+
+    def reset(self):
+        """Forgets the stream so another one can start."""
+        self._spectra = None    # (..., K, B + 1) partitions of the response
+        self._delay = None      # (..., K, B + 1) input spectra, newest at _head
+        self._head = 0
+        self._input = None      # (..., 2 * B) the previous and current input block
+        self._fill = 0          # frames of the current input block
+        self._sent = 0          # output frames of the current block already returned
+        self._consumed = 0      # input frames seen
+        self._produced = 0      # output frames returned
+
+    def _start(self, block):
+        dtype = _float_dtype(block, self.taps)
+        taps = self.taps.astype(dtype, copy=False)
+        self._spectra = spectra_cache.get(taps, self.nfft, self.block_frames)
+        shape = numpy.broadcast_shapes(block.shape[:-1], taps.shape[:-1])
+        self._delay = numpy.zeros(shape + self._spectra.shape[-2:], dtype=self._spectra.dtype)
+        self._input = numpy.zeros(shape + (self.nfft,), dtype=dtype)
+
+    def _output(self, h):
+        # the B output frames of the input spectrum at h of the delay line
+        # partition k multiplies the input spectrum of k blocks ago, which is
+        # k places after h, in two runs so nothing is copied
+        K = self._delay.shape[-2]
+        spectrum = numpy.einsum('...kf,...kf->...f', self._delay[..., h:, :], self._spectra[..., :K - h, :])
+        if h:
+            spectrum += numpy.einsum('...kf,...kf->...f', self._delay[..., :h, :], self._spectra[..., K - h:, :])
+        out = numpy.fft.irfft(spectrum, self.nfft, axis=-1)[..., self.block_frames:]
+        return out.astype(self._input.dtype, copy=False)
+
+    def _step(self):
+        # one block of B input frames in, the output frames of the block not
+        # returned yet out
+        B = self.block_frames
+        self._head = (self._head - 1) % self._delay.shape[-2]
+        self._delay[..., self._head, :] = numpy.fft.rfft(self._input, axis=-1)
+        out = self._output(self._head)[..., self._sent:]
+        self._input[..., :B] = self._input[..., B:]
+        self._fill = 0
+        self._sent = 0
+        return out
+
+    def _peek(self):
+        # the output frames of the partly filled block not returned yet, the
+        # block goes through the slot of the oldest spectrum, which it would
+        # push out, and the delay line is put back
+        B = self.block_frames
+        self._input[..., B + self._fill:] = 0
+        h = (self._head - 1) % self._delay.shape[-2]
+        oldest = self._delay[..., h, :].copy()
+        self._delay[..., h, :] = numpy.fft.rfft(self._input, axis=-1)
+        out = self._output(h)[..., self._sent:self._fill]
+        self._delay[..., h, :] = oldest
+        self._sent = self._fill
+        return out
+
+    def process(self, block):
+        """Convolves the next block of a stream.
+
+        block: array of shape (frames,) or (channels, frames)
+
+        returns: the output frames completed so far, a multiple of
+                 block_frames, possibly none, or with partial the output
+                 of every frame of block
+        """
+        block = numpy.asarray(block)
+        if self._spectra is None:
+            self._start(block)
+        B = self.block_frames
+        outs = []
+        i = 0
+        n = block.shape[-1]
+        while i < n:
+            take = min(B - self._fill, n - i)
+            self._input[..., B + self._fill:B + self._fill + take] = block[..., i:i + take]
+            self._fill += take
+            i += take
+            if self._fill == B:
+                outs.append(self._step())
+        if self.partial and self._fill > self._sent:
+            outs.append(self._peek())
+        self._consumed += n
+        return self._join(outs)
+
+    def flush(self):
+        """Ends the stream.
+
+        returns: the last output frames, so the whole stream has consumed
+                 + len(taps) - 1 of them, or None if there are none
+        """
+        if self._spectra is None:
+            return None
+        total = self._consumed + self.taps.shape[-1] - 1
+        B = self.block_frames
+        outs = []
+        produced = self._produced
+        while produced < total:
+            self._input[..., B + self._fill:] = 0
+            outs.append(self._step())
+            produced += outs[-1].shape[-1]
+        out = self._join(outs)
+        self.reset()
+        if out is None:
+            return None
+        keep = out.shape[-1] - (produced - total)
+        return out[..., :keep] if keep > 0 else None
+
+    def _join(self, outs):
+        if not outs:
+            return None
+        out = outs[0] if len(outs) == 1 else numpy.concatenate(outs, axis=-1)
+        self._produced += out.shape[-1]
+        return out
+
+    def __call__(self, blocks):
+        """Convolves a whole stream of blocks.
+
+        blocks: iterable of arrays, see process
+
+        returns: generator of the output blocks, the flushed tail included
+        """
+        self.reset()
+        for block in blocks:
+            out = self.process(block)
+            if out is not None:
+                yield out
+        tail = self.flush()
+        if tail is not None:
+            yield tail
@@ -0,0 +1,103 @@
+#!python3
+r""" ImeFileLoader.py
+
+    ImeFileLoader opens audio files in a pool of worker threads so the Qt
+    event loop keeps running while they decode.
+
+    The peaks of each file are loaded or built in the same worker.
+
+    The decode work is numpy file reads and ufuncs, which release the GIL, so
+    threads spread it over every core without pickling decoded arrays back
+    from worker processes. Each result is handed back to the GUI thread
+    through a queued signal, where the caller turns it into a track.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import concurrent.futures
+import functools
+import os
+import threading
+
+import PySide6
+import PySide6.QtCore
+
+import ImePeaks
+import ImeWave
+
+
+class ImeFileLoader(PySide6.QtCore.QObject):
+    # These are emitted in the thread that owns the loader, the GUI thread
+    wave_loaded_signal = PySide6.QtCore.Signal(str, object, object) # filename, ImeWave, ImePeaks
+    load_failed_signal = PySide6.QtCore.Signal(str, str)            # filename, error
+    progress_signal = PySide6.QtCore.Signal(str, int, int)          # filename, files done, files total
+    finished_signal = PySide6.QtCore.Signal()
+
+    # Emitted from the worker threads, only used to hop to the GUI thread
+    _done_signal = PySide6.QtCore.Signal(str, object)
+
+    def __init__(self, parent=None, max_workers=None):
+        super().__init__(parent)
+        self.max_workers = max_workers or os.cpu_count()
+        self._executor = None
+        self._futures = dict()
+        self._cancel = threading.Event()
+        self.total = 0
+        self.done = 0
+        self._done_signal.connect(self._on_done, PySide6.QtCore.Qt.QueuedConnection)
+
+    def load(self, filenames, **kwargs):
+        """Starts loading filenames in the worker pool.
+
+        filenames: iterable of paths
+        kwargs: passed on to ImeWave.from_file
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix=self.__class__.__name__)
+        self._cancel.clear()
+        for filename in filenames:
+            future = self._executor.submit(self._load, filename, kwargs)
+            self._futures[future] = filename
+            self.total += 1
+            future.add_done_callback(functools.partial(self._emit_done, filename))
+
+    def cancel(self):
+        """Drops the files that are not loaded yet.
+
+        Files that have not started are never opened, files that are being
+        decoded are discarded when they finish.
+        """
+        self._cancel.set()
+        for future in self._futures:
+            future.cancel()
+
+    @property
+    def is_busy(self):
+        return self.done < self.total
+
+    def _load(self, filename, kwargs):
+        # runs in a worker thread
+        if self._cancel.is_set():
+            return None
+        w = ImeWave.ImeWave.from_file(filename, **kwargs)
+        return w, ImePeaks.ImePeaks.for_file(filename, w)
+
+    def _emit_done(self, filename, future):
+        # runs in whichever thread completed the future
+        self._done_signal.emit(filename, future)
+
+    @PySide6.QtCore.Slot(str, object)
+    def _on_done(self, filename, future):
+        self._futures.pop(future, None)
+        self.done += 1
+        if not (future.cancelled() or self._cancel.is_set()):
+            error = future.exception()
+            if error is not None:
+                self.load_failed_signal.emit(filename, str(error))
+            else:
+                self.wave_loaded_signal.emit(filename, *future.result())
+        self.progress_signal.emit(filename, self.done, self.total)
+        if not self.is_busy:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            self.finished_signal.emit()
@@ -0,0 +1,162 @@
+#!python3
+r""" ImeIntervalTree.py
+
+    ImeIntervalTree finds the items whose half open intervals [start, end)
+    overlap a query range, in O(log n + k) for n items and k results.
+
+    It is a centered interval tree. Each node holds the intervals that
+    contain its center point, sorted once by start and once by end, the
+    intervals entirely left or right of the center go to the child nodes.
+    A query visits one path down the tree plus the nodes inside the range,
+    and at each node only scans the intervals that overlap.
+
+    The tree is rebuilt on every edit, in O(n log n), and published as one
+    immutable snapshot, so a query on another thread (the render thread)
+    always sees a whole tree without a lock. Edits are rare next to
+    queries, which happen for every block of audio.
+
+    Queries also remember the last elementary region they landed in, the
+    span between two consecutive interval endpoints. Every range inside a
+    region overlaps the same items, so consecutive audio blocks, which are
+    much shorter than clips, are answered from that memo in constant time.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import bisect
+
+
+class _Node:
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, intervals):
+        # intervals: list of (start, end, item), not empty
+        points = sorted(p for start, end, _ in intervals for p in (start, end))
+        # the lower median endpoint is always inside some interval
+        self.center = points[(len(points) - 1) // 2]
+        here, left, right = [], [], []
+        for interval in intervals:
+            start, end, _ = interval
+            if end <= self.center:
+                left.append(interval)
+            elif start > self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        self.by_start = sorted(here, key=lambda i: i[0])
+        self.by_end = sorted(here, key=lambda i: i[1], reverse=True)
+        self.left = _Node(left) if left else None
+        self.right = _Node(right) if right else None
+
+    def query(self, start, end, found):
+        # every interval here contains center, start <= center < end
+        if end <= self.center:
+            for s, e, item in self.by_start:
+                if s >= end:
+                    break
+                found.append((s, e, item))
+            if self.left:
+                self.left.query(start, end, found)
+        elif start > self.center:
+            for s, e, item in self.by_end:
+                if e <= start:
+                    break
+                found.append((s, e, item))
+            if self.right:
+                self.right.query(start, end, found)
+        else:
+            found.extend(self.by_start)
+            if self.left:
+                self.left.query(start, end, found)
+            if self.right:
+                self.right.query(start, end, found)
+
+
+class _Snapshot:
+    __slots__ = ('root', 'bounds', 'memo')
+
+    def __init__(self, intervals):
+        self.root = _Node(intervals) if intervals else None
+        # sorted distinct endpoints, the edges of the elementary regions
+        self.bounds = sorted({p for start, end, _ in intervals for p in (start, end)})
+        # (lo, hi, items) of the last region a query fell in
+        self.memo = None
+
+
+class ImeIntervalTree:
+    """Index of items by the half open interval of frames they cover."""
+
+    def __init__(self, intervals=()):
+        """Builds the index.
+
+        intervals: iterable of (start, end, item)
+        """
+        self._intervals = dict()
+        for start, end, item in intervals:
+            self._intervals[id(item)] = (start, end, item)
+        self._snapshot = _Snapshot(list(self._intervals.values()))
+
+    def __repr__(self):
+        return f"ImeIntervalTree({len(self)} intervals)"
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __iter__(self):
+        """Iterates the items in the order of their start."""
+        return (item for _, _, item in sorted(self._intervals.values(), key=lambda i: i[0]))
+
+    def __contains__(self, item):
+        return id(item) in self._intervals
+
+    def add(self, item, start, end):
+        """Adds item covering [start, end), or moves it there if present."""
+        self.update(add=[(start, end, item)])
+
+    def remove(self, item):
+        """Removes item, a KeyError if it is not in the index."""
+        self.update(remove=[item])
+
+    def update(self, add=(), remove=()):
+        """Edits several items with one rebuild.
+
+        add: iterable of (start, end, item) to add or move
+        remove: iterable of items to remove
+        """
+        for item in remove:
+            del self._intervals[id(item)]
+        for start, end, item in add:
+            if end <= start:
+                raise ValueError(f"{self.__class__.__name__} needs start < end, got [{start}, {end})")
+            self._intervals[id(item)] = (start, end, item)
+        self._snapshot = _Snapshot(list(self._intervals.values()))
+
+    def span(self):
+        """Returns (first start, last end) of all intervals, or (0, 0)."""
+        bounds = self._snapshot.bounds
+        return (bounds[0], bounds[-1]) if bounds else (0, 0)
+
+    def query(self, start, end):
+        """Finds the intervals that overlap [start, end).
+
+        start: first frame of the range
+        end: frame one past the last frame of the range
+
+        returns: list of (start, end, item), sorted by start, do not modify it
+        """
+        snapshot = self._snapshot
+        if snapshot.root is None or end <= start:
+            return []
+        memo = snapshot.memo
+        if memo and memo[0] <= start and end <= memo[1]:
+            return memo[2]
+        found = []
+        snapshot.root.query(start, end, found)
+        found.sort(key=lambda i: i[0])
+        # remember the region if the range fell inside one
+        bounds = snapshot.bounds
+        i = bisect.bisect_right(bounds, start)
+        lo = bounds[i - 1] if i else float('-inf')
+        hi = bounds[i] if i < len(bounds) else float('inf')
+        if end <= hi:
+            snapshot.memo = (lo, hi, found)
+        return found
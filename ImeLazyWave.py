@@ -0,0 +1,296 @@
+#!python3
+r""" ImeLazyWave.py
+
+    ImeLazyWave records a chain of ImeWave transforms and evaluates them
+    fused, a block at a time, instead of one full pass over the signal and
+    one temporary per transform.
+
+        w2 = w.lazy().scale(0.5).apodize().hamming().unbias().normalize().evaluate()
+
+    The methods have the names and arguments of the ImeWave methods, but
+    each only appends a node to the chain and returns the ImeLazyWave.
+    Elementwise nodes, scale, apodize, hamming and window, work in place on
+    a block of frames. evaluate reads each block of the source once, runs
+    every node on it while it is in cache and stores it in the result, so
+    the chain costs one pass over memory and one array, the result.
+
+    unbias and normalize are reductions, they need the mean and the peak of
+    the signal as it reaches them. plan() computes them ahead of the final
+    pass. One pass runs the nodes before the first reduction and keeps the
+    sum, the largest and the smallest value of every channel. The nodes
+    after it that are the same for every frame, a scale or an offset, move
+    those statistics along without touching the signal, so each reduction
+    up to the next node that varies per frame, apodize, hamming or window,
+    is answered by that one pass. Then the reductions are just a scale and
+    an offset. scale, apodize, window, unbias, normalize takes two passes,
+    one that only reads and one that writes the result.
+
+    The source wave is never modified. An encoded or mapped wave is decoded
+    a block at a time, straight into the result.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import numpy
+
+import ImeWave
+import ImeWavFile
+
+
+class _Stats:
+    # per channel sum, largest and smallest value of n frames, arrays of the
+    # frame shape of the signal with a frames axis of 1
+
+    def __init__(self, total, high, low, n):
+        self.total = total
+        self.high = high
+        self.low = low
+        self.n = n
+
+    def transform(self, a, b):
+        """Returns the statistics of a * ys + b, for a and b that are the same
+        for every frame."""
+        high, low = a * self.high + b, a * self.low + b
+        flip = numpy.asarray(a) < 0
+        return _Stats(a * self.total + b * self.n, numpy.where(flip, low, high), numpy.where(flip, high, low), self.n)
+
+
+class _Node:
+    # a stage of the chain, apply works in place on the frames
+    # [start, start + ys.shape[-1]) of a block
+    reduction = False
+
+    def apply(self, ys, start):
+        raise NotImplementedError
+
+    def affine(self):
+        """Returns (a, b) when the stage is a * ys + b for every frame, else None."""
+        return None
+
+
+class _Scale(_Node):
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __repr__(self):
+        return f"scale({self.factor})"
+
+    def apply(self, ys, start):
+        ys *= ys.dtype.type(self.factor)
+
+    def affine(self):
+        return self.factor, 0.0
+
+
+class _Offset(_Node):
+
+    def __init__(self, offset):
+        self.offset = offset    # per channel, frames axis of 1
+
+    def __repr__(self):
+        return f"offset({numpy.ravel(self.offset)})"
+
+    def apply(self, ys, start):
+        ys += self.offset.astype(ys.dtype, copy=False)
+
+    def affine(self):
+        return 1.0, self.offset
+
+
+class _Gains(_Node):
+
+    def __init__(self, name, gains):
+        self.name = name
+        self.gains = gains      # function of (start, end), the multipliers of those frames
+
+    def __repr__(self):
+        return self.name
+
+    def apply(self, ys, start):
+        ys *= self.gains(start, start + ys.shape[-1]).astype(ys.dtype, copy=False)
+
+
+class _Unbias(_Node):
+    reduction = True
+
+    def __repr__(self):
+        return "unbias()"
+
+    def resolve(self, stats):
+        return _Offset(-stats.total / max(1, stats.n))
+
+
+class _Normalize(_Node):
+    reduction = True
+
+    def __init__(self, amp):
+        self.amp = amp
+
+    def __repr__(self):
+        return f"normalize({self.amp})"
+
+    def resolve(self, stats):
+        peak = max(abs(float(stats.high.max(initial=0.0))), abs(float(stats.low.min(initial=0.0))))
+        return _Scale(self.amp / peak if peak else 1.0)
+
+
+class ImeLazyWave:
+    """A wave with a chain of deferred transforms, see ImeWave.lazy."""
+
+    def __init__(self, wave):
+        self.wave = wave
+        self.nodes = []
+
+    def __repr__(self):
+        return f"ImeLazyWave({len(self.wave)} frames, {self.nodes})"
+
+    def __len__(self):
+        return len(self.wave)
+
+    def scale(self, factor):
+        """Multiplies the wave by a factor, see ImeWave.scale."""
+        self.nodes.append(_Scale(factor))
+        return self
+
+    def apodize(self, denom=20, duration=0.1):
+        """Tapers the beginning and end of the signal, see ImeWave.apodize."""
+        n = len(self.wave)
+        k = min(n // denom, int(duration * self.wave.framerate))
+        self.nodes.append(_Gains(f"apodize({denom}, {duration})",
+                                 lambda start, end: ImeWave.apodize_gains(start, end, n, k)))
+        return self
+
+    def hamming(self):
+        """Applies a Hamming window, see ImeWave.hamming."""
+        n = len(self.wave)
+
+        def gains(start, end):
+            # numpy.hamming(n)[start:end]
+            if n == 1:
+                return numpy.ones(end - start)
+            return 0.54 - 0.46 * numpy.cos(2 * numpy.pi * numpy.arange(start, end) / (n - 1))
+
+        self.nodes.append(_Gains("hamming()", gains))
+        return self
+
+    def window(self, window):
+        """Applies a window, see ImeWave.window.
+
+        window: sequence of multipliers, same length as the wave
+        """
+        window = numpy.asarray(window)
+        if window.shape[-1] != len(self.wave):
+            raise ValueError(f"window has {window.shape[-1]} values for {len(self.wave)} frames")
+        self.nodes.append(_Gains("window()", lambda start, end: window[..., start:end]))
+        return self
+
+    def unbias(self):
+        """Subtracts the mean of each channel, see ImeWave.unbias."""
+        self.nodes.append(_Unbias())
+        return self
+
+    def normalize(self, amp=1.0):
+        """Scales the peak to amp, see ImeWave.normalize."""
+        self.nodes.append(_Normalize(amp))
+        return self
+
+    def _dtype(self):
+        wave = self.wave
+        if wave.is_encoded or wave.ys.dtype.kind != 'f':
+            return wave.working_dtype
+        return wave.ys.dtype
+
+    def _run(self, nodes, block_frames, out=None):
+        """Evaluates the nodes a block at a time.
+
+        nodes: elementwise nodes
+        block_frames: frames per block
+        out: optional array for the whole result, the blocks are views of it,
+             otherwise they share one scratch array
+
+        returns: generator of (first frame, block)
+        """
+        wave = self.wave
+        n = len(wave)
+        scratch = None
+        for start in range(0, n, block_frames):
+            end = min(n, start + block_frames)
+            if out is not None:
+                ys = out[..., start:end]
+            else:
+                if scratch is None:
+                    scratch = numpy.empty(wave.get_frames(0, 0).shape[:-1] + (min(n, block_frames),), dtype=self._dtype())
+                ys = scratch[..., :end - start]
+            if wave.is_encoded:
+                # decode straight into the block
+                wave.get_frames(start, end, out=ys if ys.ndim == 2 else ys[numpy.newaxis])
+            else:
+                ys[...] = wave.get_frames(start, end)
+            for node in nodes:
+                node.apply(ys, start)
+            yield start, ys
+
+    def _stats(self, nodes, block_frames):
+        """Makes one pass that evaluates nodes and measures the result."""
+        shape = self.wave.get_frames(0, 0).shape[:-1] + (1,)
+        total = numpy.zeros(shape)
+        high = numpy.full(shape, -numpy.inf)
+        low = numpy.full(shape, numpy.inf)
+        for _, ys in self._run(nodes, block_frames):
+            total += ys.sum(axis=-1, keepdims=True, dtype=numpy.float64)
+            numpy.maximum(high, ys.max(axis=-1, keepdims=True), out=high)
+            numpy.minimum(low, ys.min(axis=-1, keepdims=True), out=low)
+        return _Stats(total, high, low, len(self.wave))
+
+    def plan(self, block_frames=ImeWavFile.BLOCK_FRAMES):
+        """Computes the reductions, see the module docstring.
+
+        block_frames: frames per block of the passes that measure the signal
+
+        returns: list of the nodes to run on every block, reductions replaced
+                 by the scale or offset they came to
+        """
+        nodes = list(self.nodes)
+        k = 0
+        while True:
+            k = next((i for i in range(k, len(nodes)) if nodes[i].reduction), None)
+            if k is None:
+                return nodes
+            stats = self._stats(nodes[:k], block_frames)
+            # follow the statistics through the nodes that are the same for
+            # every frame, resolving the reductions on the way
+            while k < len(nodes):
+                if nodes[k].reduction:
+                    nodes[k] = nodes[k].resolve(stats)
+                affine = nodes[k].affine()
+                if affine is None:
+                    break
+                stats = stats.transform(*affine)
+                k += 1
+
+    def iter_blocks(self, block_frames=ImeWavFile.BLOCK_FRAMES):
+        """Generates the transformed frames a block at a time, e.g. for an
+        ImePipeline or an ImeWavWriter, without making the whole result.
+
+        block_frames: frames per block
+
+        returns: generator of NumPy arrays, 1-D or (nchannels, frames), each
+                 one valid until the next is generated
+        """
+        for _, ys in self._run(self.plan(block_frames), block_frames):
+            yield ys
+
+    def evaluate(self, block_frames=ImeWavFile.BLOCK_FRAMES):
+        """Runs the chain into a new wave.
+
+        block_frames: frames per block
+
+        returns: new ImeWave
+        """
+        wave = self.wave
+        nodes = self.plan(block_frames)
+        out = numpy.empty(wave.get_frames(0, 0).shape[:-1] + (len(wave),), dtype=self._dtype())
+        for _ in self._run(nodes, block_frames, out):
+            pass
+        return wave.__class__(out, framerate=wave.framerate, start=wave.start, sampwidth=wave.sampwidth,
+                              precision=wave.precision)
@@ -0,0 +1,229 @@
+#!python3
+r""" ImeMeter.py
+
+    ImeMeter measures the level of a track or of the master bus as it is
+    mixed, ImeMeterWidget draws it.
+
+    ImeMixEngine hands each meter the frames it has just scaled into its
+    scratch buffer, so the measurement reads data that is already in cache
+    and never makes a second pass over the sources. Per output channel a
+    meter keeps, since its last reading,
+        peak        the largest absolute sample
+        rms         the square root of the mean square over the frames mixed,
+                    the gaps between clips count as silence
+        true_peak   the largest absolute value of the signal oversampled 4
+                    times, as in ITU-R BS.1770, which catches the overs a
+                    D/A converter makes between samples
+    The oversampled values are only computed on both sides of the loudest
+    sample of each channel, and only when the segment is louder than the
+    true peak so far in the interval, so the true peak costs a few dozen
+    multiplies a few times per reading. It is an estimate, an over
+    next to a sample a little quieter than the loudest one is missed. Each
+    call sees one segment, the filter continues the first and last samples
+    beyond its ends.
+
+    Every interval seconds the meter publishes an ImeMeterReading and starts
+    over. Publishing replaces the reading attribute with a new object, which
+    is atomic, so the GUI reads it from another thread without a lock and
+    never sees half an update. Only the thread that mixes calls add and
+    advance. The player mixes ahead of the playhead, so the readings lead
+    what is heard by the read ahead of its ImeRenderThread.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import time
+
+import numpy
+
+import PySide6
+import PySide6.QtCore
+import PySide6.QtGui
+import PySide6.QtWidgets
+
+import ImeResampler
+
+
+# seconds between readings, about 30 per second
+METER_INTERVAL = 1 / 30
+# oversampling of the true peak and zero crossings of its filter per side
+TRUE_PEAK_OVERSAMPLING = 4
+TRUE_PEAK_ZERO_CROSSINGS = 6
+# the bottom of the meter scale, and the level readings report for silence
+FLOOR_DB = -60.0
+
+_taps = ImeResampler.polyphase_taps(TRUE_PEAK_OVERSAMPLING, 1, TRUE_PEAK_ZERO_CROSSINGS)[1:]
+_half = _taps.shape[1] // 2
+# the points between samples i - 1 and i and between i and i + 1 from the
+# 2 * _half + 1 samples centered on i, in one product
+_true_peak_taps = numpy.zeros((2 * len(_taps), _taps.shape[1] + 1))
+_true_peak_taps[:len(_taps), :-1] = _taps
+_true_peak_taps[len(_taps):, 1:] = _taps
+
+
+def to_db(level):
+    """Converts linear levels to dBFS, FLOOR_DB for silence."""
+    level = numpy.asarray(level, dtype=numpy.float64)
+    with numpy.errstate(divide='ignore'):
+        return numpy.maximum(FLOOR_DB, 20 * numpy.log10(level))
+
+
+def true_peak(ys):
+    """Estimates the inter-sample peak of each channel.
+
+    ys: float array of shape (channels, frames)
+
+    returns: array of shape (channels,), at least the sample peak
+    """
+    loudest = numpy.abs(ys).argmax(axis=-1)
+    return numpy.array([_true_peak_at(y, int(i), abs(float(y[i]))) for y, i in zip(ys, loudest)])
+
+
+def _true_peak_at(y, i, peak):
+    # the largest of peak and the oversampled points on both sides of y[i],
+    # indices beyond the ends continue the first and last samples
+    lo = i - _half
+    hi = i + _half + 1
+    if lo < 0 or hi > len(y):
+        window = y[numpy.arange(lo, hi).clip(0, len(y) - 1)]
+    else:
+        window = y[lo:hi]
+    return max(peak, float(numpy.abs(_true_peak_taps @ window).max()))
+
+
+class ImeMeterReading:
+    """The levels a meter measured over one interval, linear per channel."""
+    __slots__ = ('peak', 'rms', 'true_peak', 'time')
+
+    def __init__(self, peak, rms, true_peak, time):
+        self.peak = peak
+        self.rms = rms
+        self.true_peak = true_peak
+        self.time = time
+
+    def __repr__(self):
+        return (f"ImeMeterReading(peak={to_db(self.peak).round(1)}, rms={to_db(self.rms).round(1)}, "
+                f"true_peak={to_db(self.true_peak).round(1)})")
+
+
+class ImeMeter:
+    """Peak, RMS and true peak meter fed by the mix."""
+
+    def __init__(self, interval=METER_INTERVAL):
+        """Initializes the meter with no reading.
+
+        interval: seconds between readings
+        """
+        self.interval = interval
+        # the last ImeMeterReading, None until the first interval ends
+        self.reading = None
+        self._channels = 0
+        self._time = time.monotonic()
+        self._reset(0)
+
+    def __repr__(self):
+        return f"ImeMeter(interval={self.interval}, reading={self.reading})"
+
+    def _reset(self, channels):
+        # per channel lists, the mixing thread updates them a float at a time
+        self._channels = channels
+        self._peak = [0.0] * channels
+        self._true_peak = [0.0] * channels
+        self._sum_squares = numpy.zeros(channels)
+        self._count = 0
+
+    def add(self, ys):
+        """Measures frames mixed in the current block.
+
+        ys: float array of shape (channels, frames), a segment of the block
+        """
+        if len(ys) != self._channels:
+            self._reset(len(ys))
+        if not ys.shape[-1]:
+            return
+        highest = ys.argmax(axis=-1)
+        lowest = ys.argmin(axis=-1)
+        for c, y in enumerate(ys):
+            high = float(y[highest[c]])
+            low = -float(y[lowest[c]])
+            i, peak = (int(highest[c]), high) if high >= low else (int(lowest[c]), low)
+            if peak > self._peak[c]:
+                self._peak[c] = peak
+            if peak > self._true_peak[c]:
+                self._true_peak[c] = _true_peak_at(y, i, peak)
+        self._sum_squares += numpy.einsum('ij,ij->i', ys, ys)
+
+    def advance(self, nframes, now=None):
+        """Ends a block of nframes frames, publishes a reading once per interval.
+
+        nframes: frames in the block, silent or not
+        now: time.monotonic() of the block, read if not given
+        """
+        self._count += nframes
+        now = time.monotonic() if now is None else now
+        if now - self._time < self.interval:
+            return
+        rms = numpy.sqrt(self._sum_squares / max(1, self._count))
+        self.reading = ImeMeterReading(numpy.array(self._peak), rms, numpy.array(self._true_peak), now)
+        self._time = now
+        self._reset(self._channels)
+
+
+class ImeMeterWidget(PySide6.QtWidgets.QWidget):
+    # Draws the reading of an ImeMeter as one vertical bar per channel, the
+    # RMS filled, the peak as a line that holds for HOLD seconds and then
+    # falls at FALL dB per second, and the true peak as a number below, red
+    # above 0 dBTP. Call update() at the rate readings are wanted, e.g. from
+    # a QTimer, paintEvent only reads the meter.
+    HOLD = 1.0
+    FALL = 20.0
+
+    def __init__(self, parent, meter):
+        super().__init__(parent)
+        self.meter = meter
+        self._hold = None
+        self._hold_time = 0.0
+        self._shown = 0.0
+        self.setMinimumSize(24, 80)
+        self.setSizePolicy(PySide6.QtWidgets.QSizePolicy.Fixed, PySide6.QtWidgets.QSizePolicy.Expanding)
+
+    def _levels(self):
+        # the reading in dB, falling to the floor when playback stops
+        reading = self.meter.reading
+        now = time.monotonic()
+        if reading is None or now - reading.time > 4 * self.meter.interval:
+            return None, None, None, now
+        return to_db(reading.peak), to_db(reading.rms), to_db(reading.true_peak), now
+
+    def paintEvent(self, event):
+        peak, rms, tp, now = self._levels()
+        painter = PySide6.QtGui.QPainter(self)
+        width, height = self.width(), self.height() - 14
+        painter.fillRect(0, 0, width, height, self.palette().color(PySide6.QtGui.QPalette.Base))
+        if peak is None:
+            peak = rms = tp = numpy.full(max(1, len(self._hold) if self._hold is not None else 1), FLOOR_DB)
+        # peak hold, then fall
+        dt = now - self._shown
+        self._shown = now
+        if self._hold is None or len(self._hold) != len(peak):
+            self._hold = peak.copy()
+        elif now - self._hold_time > self.HOLD:
+            self._hold = numpy.maximum(peak, self._hold - self.FALL * dt)
+        if (peak > self._hold).any():
+            self._hold = numpy.maximum(peak, self._hold)
+            self._hold_time = now
+
+        def y(db):
+            return height * min(1.0, max(0.0, db / FLOOR_DB))
+
+        bar = width / len(peak)
+        fill = self.palette().color(PySide6.QtGui.QPalette.Highlight)
+        for c in range(len(peak)):
+            x = int(c * bar) + 1
+            top = int(y(rms[c]))
+            painter.fillRect(x, top, max(1, int(bar) - 2), height - top, fill)
+            painter.setPen(PySide6.QtGui.QColor('red') if self._hold[c] >= 0 else self.palette().color(PySide6.QtGui.QPalette.WindowText))
+            painter.drawLine(x, int(y(self._hold[c])), x + max(1, int(bar) - 2), int(y(self._hold[c])))
+        top_tp = float(tp.max())
+        painter.setPen(PySide6.QtGui.QColor('red') if top_tp > 0 else self.palette().color(PySide6.QtGui.QPalette.WindowText))
+        text = "-inf" if top_tp <= FLOOR_DB else f"{top_tp:.1f}"
+        painter.drawText(PySide6.QtCore.QRectF(0, height, width, 14), PySide6.QtCore.Qt.AlignCenter, text)
@@ -0,0 +1,208 @@
+#!python3
+r""" ImeMetrics.py
+
+    ImeMetrics counts and times what happens on the audio path, so it can be
+    profiled without printing from the callbacks.
+
+    There is one registry, ImeMetrics.metrics, shared by every module. The
+    hot path looks like this
+        timed = ImeMetrics.metrics.enabled
+        if timed:
+            t0 = time.perf_counter_ns()
+        ...
+        if timed:
+            ImeMetrics.metrics.histogram('audio.callback').observe(time.perf_counter_ns() - t0)
+    so when collection is disabled, the default, it costs one attribute test.
+    The flag is read once, collection can be turned on from another thread
+    between the two tests, and then t0 would not be set.
+
+    A Counter only grows. A Histogram counts durations in power of two
+    buckets of microseconds, bucket k holds [2**(k-1), 2**k) us, and keeps
+    their count, sum and max, which is enough for a mean and approximate
+    percentiles. Each metric is meant to be updated from one thread, the
+    updates are not locked.
+
+    snapshot() returns every metric as a dict, which write_json and write_csv
+    save. ImeMetricsReporter takes a snapshot periodically, writes it to a
+    file and shows a summary in a status bar.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import csv
+import json
+import os
+import time
+
+import PySide6
+import PySide6.QtCore
+import PySide6.QtWidgets
+
+
+# 1 us .. about 1 s, the last bucket also takes everything slower
+BUCKETS = 21
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return dict(type='counter', value=self.value)
+
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, ns):
+        """Adds one duration, in nanoseconds, e.g. from time.perf_counter_ns."""
+        self.buckets[min(BUCKETS - 1, (ns // 1000).bit_length())] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, q):
+        """Returns the upper edge of the bucket holding quantile q, in us."""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return 1 << k
+        return 1 << (BUCKETS - 1)
+
+    def snapshot(self):
+        return dict(type='histogram', count=self.count,
+                    mean_us=self.total / self.count / 1000 if self.count else 0.0,
+                    max_us=self.max / 1000, p50_us=self.percentile(0.5), p99_us=self.percentile(0.99),
+                    buckets=list(self.buckets))
+
+
+class ImeMetrics:
+    """Registry of counters and histograms, by name."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._metrics = dict()
+        self.started = time.time()
+
+    def __repr__(self):
+        return f"ImeMetrics(enabled={self.enabled}, metrics={len(self._metrics)})"
+
+    def counter(self, name):
+        """Returns the counter called name, created on first use."""
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics.setdefault(name, Counter())
+        return metric
+
+    def histogram(self, name):
+        """Returns the histogram called name, created on first use."""
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics.setdefault(name, Histogram())
+        return metric
+
+    def reset(self):
+        """Forgets every metric."""
+        self._metrics = dict()
+        self.started = time.time()
+
+    def snapshot(self):
+        """Returns every metric as a dict of plain values, by name."""
+        metrics = {name: metric.snapshot() for name, metric in sorted(self._metrics.items())}
+        return dict(time=time.time(), started=self.started, enabled=self.enabled, metrics=metrics)
+
+    def write_json(self, filename, snapshot=None):
+        """Writes a snapshot as JSON, replacing the file."""
+        snapshot = snapshot or self.snapshot()
+        tmp = f"{filename}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp, filename)
+
+    def write_csv(self, filename, snapshot=None):
+        """Appends a snapshot to a CSV file, one row per metric and field."""
+        snapshot = snapshot or self.snapshot()
+        new = not os.path.exists(filename)
+        with open(filename, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new:
+                writer.writerow(['time', 'name', 'field', 'value'])
+            for name, values in snapshot['metrics'].items():
+                for field, value in values.items():
+                    if field not in ('type', 'buckets'):
+                        writer.writerow([f"{snapshot['time']:.3f}", name, field, value])
+
+    def summary(self, snapshot=None):
+        """Returns a one line summary of a snapshot for a status bar."""
+        metrics = (snapshot or self.snapshot())['metrics']
+        parts = []
+        callback = metrics.get('audio.callback')
+        if callback:
+            parts.append(f"callback {callback['mean_us']:.0f}/{callback['p99_us']} us")
+        mix = metrics.get('mix.block')
+        if mix:
+            parts.append(f"mix {mix['mean_us']:.0f}/{mix['p99_us']} us")
+        latency = metrics.get('audio.output_latency')
+        if latency:
+            parts.append(f"latency {latency['mean_us'] / 1000:.1f} ms")
+        for name in ('audio.underruns', 'audio.bytes_served'):
+            if name in metrics:
+                parts.append(f"{name.split('.')[-1]} {metrics[name]['value']}")
+        return ', '.join(parts)
+
+
+# The registry of the application
+metrics = ImeMetrics()
+
+
+class ImeMetricsReporter(PySide6.QtCore.QObject):
+    # Takes a snapshot of the metrics every interval, shows the summary in a
+    # label, typically a permanent widget of the status bar, and saves it to
+    # filename, as CSV if it ends in .csv else as JSON.
+
+    def __init__(self, parent=None, interval=1000, filename=None, registry=None):
+        super().__init__(parent)
+        self.registry = registry or metrics
+        self.filename = filename
+        self.label = PySide6.QtWidgets.QLabel()
+        self.timer = PySide6.QtCore.QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.report)
+
+    def start(self):
+        self.registry.enabled = True
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.registry.enabled = False
+
+    @PySide6.QtCore.Slot()
+    def report(self):
+        snapshot = self.registry.snapshot()
+        self.label.setText(self.registry.summary(snapshot))
+        if not self.filename:
+            return
+        try:
+            if str(self.filename).endswith('.csv'):
+                self.registry.write_csv(self.filename, snapshot)
+            else:
+                self.registry.write_json(self.filename, snapshot)
+        except OSError as e:
+            print(f"{self.__class__.__name__} could not write {self.filename}: {e}")
+            self.filename = None
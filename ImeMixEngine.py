@@ -0,0 +1,209 @@
+#!python3
+r""" ImeMixEngine.py
+
+    ImeMixEngine sums the tracks of a project into one block of the project
+    mix, applying each track's volume, pan, mute and solo on the way.
+
+    Each track contributes the segments of its clips that play in the block,
+    found through the track's interval index. Every buffer the mix touches
+    is allocated when the engine is created (or when a source with more
+    channels than seen so far shows up), so mixing a block allocates nothing
+    per track or clip:
+        mix     (channels, block_frames) the project mix, returned as a view
+        scratch (channels, block_frames) one clip segment after its gains
+        track   (channels, block_frames) the sum of one track's segments,
+                only used with metering
+        decode  (nchannels, block_frames) frames of an encoded wave
+    The gains of all tracks are computed together in one vectorized pass per
+    block, then each clip segment is one multiply into scratch and one add
+    into mix.
+
+    With metering, the segments of a track are summed in track before they
+    go into the mix, so each track's ImeMeter, track.meter, measures what the
+    track adds to the mix, overlapping clips included, and the meter of the
+    master bus, tracks.meter, measures the mix, see ImeMeter.
+
+    With ImeMetrics enabled the engine times each block, mix.block, and each
+    track, mix.track.INDEX.
+
+    Pan laws decide how loud a track panned to the center is compared to one
+    panned hard to a side. The rpp PANLAW is this same choice, expressed as
+    the gain at the center:
+        PANLAW_BALANCE      0 dB, the center is unity and a side only
+                            attenuates the other side
+        PANLAW_CONSTANT_POWER  -3 dB, sin/cos, the loudness stays the same
+                            as the track is panned
+        PANLAW_COMPROMISE   -4.5 dB, halfway between the two below
+        PANLAW_LINEAR       -6 dB, the gains sum to one, so a mono track
+                            summed to mono stays at the same level
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import time
+
+import numpy
+
+import ImeMetrics
+
+
+PANLAW_BALANCE = 'balance'
+PANLAW_CONSTANT_POWER = 'constant_power'
+PANLAW_COMPROMISE = 'compromise'
+PANLAW_LINEAR = 'linear'
+
+# frames mixed per block, a few callbacks worth of audio at 44.1/48 kHz
+BLOCK_FRAMES = 4096
+
+
+def pan_gains(pans, law=PANLAW_CONSTANT_POWER):
+    """Computes the left and right gains of pan positions.
+
+    pans: array of pan positions, -1 is hard left, 0 center, 1 hard right
+    law: one of the PANLAW_ constants
+
+    returns: array of shape (2, len(pans)), the left gains then the right
+    """
+    x = (numpy.clip(pans, -1.0, 1.0) + 1.0) / 2.0
+    xs = numpy.stack((1.0 - x, x))
+    if law == PANLAW_LINEAR:
+        return xs
+    if law == PANLAW_BALANCE:
+        return numpy.minimum(1.0, 2.0 * xs)
+    power = numpy.sin(xs * (numpy.pi / 2))
+    if law == PANLAW_CONSTANT_POWER:
+        return power
+    if law == PANLAW_COMPROMISE:
+        return numpy.sqrt(power * xs)
+    raise ValueError(f"{law=} unknown")
+
+
+class ImeMixEngine:
+    """Mixes a collection of ImeTrack objects a block at a time."""
+
+    def __init__(self, tracks, channels=2, block_frames=BLOCK_FRAMES, pan_law=PANLAW_CONSTANT_POWER,
+                 dtype=numpy.float32, metering=False):
+        """Allocates the mix buffers.
+
+        tracks: ImeTrackCollection, or any sequence of ImeTrack
+        channels: channels of the mix, 1 for mono or 2 for stereo
+        block_frames: the most frames mix returns per call
+        pan_law: one of the PANLAW_ constants, only used for a stereo mix
+        dtype: float dtype of the mix
+        metering: boolean, feed the ImeMeter of every track and of tracks
+        """
+        if channels not in (1, 2):
+            raise ValueError(f"{channels=} unsupported, the mix is mono or stereo")
+        self.tracks = tracks
+        self.channels = channels
+        self.block_frames = block_frames
+        self.pan_law = pan_law
+        self.dtype = numpy.dtype(dtype)
+        self._mix = numpy.zeros((channels, block_frames), dtype=self.dtype)
+        self._scratch = numpy.empty_like(self._mix)
+        self._track = numpy.empty_like(self._mix)
+        self._decode = numpy.empty((2, block_frames), dtype=self.dtype)
+        self.metering = metering
+        # the master bus meter, kept by the collection so it outlives us
+        self.meter = getattr(tracks, 'meter', None) if metering else None
+
+    def __repr__(self):
+        return (f"ImeMixEngine(channels={self.channels}, block_frames={self.block_frames}, "
+                f"pan_law={self.pan_law!r}, dtype={self.dtype})")
+
+    def nframes(self):
+        """Returns the length of the mix in frames, that of the longest track."""
+        return max((t.frameCount() for t in self.tracks), default=0)
+
+    def gains(self, tracks):
+        """Computes the gain of every output channel of every track.
+
+        Muted tracks get 0, and so does every track that is not soloed while
+        any track is.
+
+        tracks: sequence of ImeTrack
+
+        returns: array of shape (len(tracks), channels)
+        """
+        n = len(tracks)
+        volume = numpy.fromiter((t.volume for t in tracks), dtype=numpy.float64, count=n)
+        mute = numpy.fromiter((t.mute for t in tracks), dtype=bool, count=n)
+        solo = numpy.fromiter((t.solo for t in tracks), dtype=bool, count=n)
+        audible = ~mute & (solo | ~solo.any())
+        volume *= audible
+        if self.channels == 1:
+            return volume[:, numpy.newaxis]
+        pans = numpy.fromiter((t.pan for t in tracks), dtype=numpy.float64, count=n)
+        return (pan_gains(pans, self.pan_law) * volume).T
+
+    def mix(self, start, nframes):
+        """Mixes the frames in [start, start + nframes) of every track.
+
+        start: first frame of the project
+        nframes: frames wanted, at most block_frames are mixed
+
+        returns: view of the mix buffer of shape (channels, frames), only
+                 valid until the next call
+        """
+        n = max(0, min(nframes, self.block_frames))
+        mix = self._mix[:, :n]
+        mix.fill(0)
+        tracks = list(self.tracks)
+        if not tracks or n == 0:
+            return mix
+        timed = ImeMetrics.metrics.enabled
+        if timed:
+            t0 = time.perf_counter_ns()
+        now = time.monotonic() if self.metering else None
+        for i, (track, gains) in enumerate(zip(tracks, self.gains(tracks).astype(self.dtype))):
+            meter = track.meter if self.metering else None
+            if not gains.any() or start >= track.frameCount():
+                if meter is not None:
+                    meter.advance(n, now)
+                continue
+            if timed:
+                t = time.perf_counter_ns()
+            self._add_track(mix, track, start, n, gains, meter)
+            if meter is not None:
+                meter.advance(n, now)
+            if timed:
+                ImeMetrics.metrics.histogram(f'mix.track.{i}').observe(time.perf_counter_ns() - t)
+        if self.meter is not None:
+            self.meter.add(mix)
+            self.meter.advance(n, now)
+        if timed:
+            ImeMetrics.metrics.histogram('mix.block').observe(time.perf_counter_ns() - t0)
+        return mix
+
+    def _add_track(self, mix, track, start, n, gains, meter=None):
+        # metered, the segments are summed apart first, once into the meter
+        out = mix
+        if meter is not None:
+            out = self._track[:, :n]
+            out.fill(0)
+        for clip, source_start, source_end, at in track.segments(start, start + n):
+            w = clip.wave
+            if w.nchannels > len(self._decode):
+                self._decode = numpy.empty((w.nchannels, self.block_frames), dtype=self.dtype)
+            ys = w.get_frames(source_start, source_end, out=self._decode)
+            self._add_frames(out[:, at:at + ys.shape[-1]], ys, gains * self.dtype.type(clip.gain))
+        if meter is not None:
+            mix += out
+            meter.add(out)
+
+    def _add_frames(self, mix, ys, gains):
+        m = ys.shape[-1]
+        scratch = self._scratch[:, :m]
+        if ys.ndim == 1 or len(ys) == self.channels:
+            # mono to every output channel, or channel to channel
+            numpy.multiply(gains[:, numpy.newaxis], ys, out=scratch)
+        else:
+            # fold the channels round robin onto the outputs, scaled so a
+            # fold down keeps the level of the source
+            fold = self.dtype.type(self.channels / len(ys))
+            for c, y in enumerate(ys):
+                g = gains[c % self.channels] * fold
+                if c < self.channels:
+                    numpy.multiply(y, g, out=scratch[c])
+                else:
+                    scratch[c % self.channels] += y * g
+        mix += scratch
@@ -7,6 +7,7 @@ r""" ImeMixerView.py
 import PySide6
 
 import ImeAudioPlayer
+import ImeMeter
 import ImeTrack
 
 class ImeMixerView(PySide6.QtWidgets.QWidget):
@@ -36,6 +37,7 @@ class ImeMixerView(PySide6.QtWidgets.QWidget):
         self.track_area = PySide6.QtWidgets.QTableWidget()
         self.track_area.setColumnCount(2)
         self.track_area.setHorizontalHeaderLabels(["Track", "Contents"])
+        self.track_area.horizontalHeader().setStretchLastSection(True)
         self.parent.tracks.tracks_changed_signal.connect(self.update_track_table)
         self.update_track_table()
         layout.addWidget(self.track_area)
@@ -52,13 +54,41 @@ class ImeMixerView(PySide6.QtWidgets.QWidget):
 
     def _setup_mix_area(self, layout):
         # bugbug: implement mixing controls
-        layout.addWidget(PySide6.QtWidgets.QLabel("ImeMixerView: mixer area"))
+        # A channel strip per track and the master meter at the end. One
+        # timer repaints the meters at the rate they publish readings.
+        self.mix_area = PySide6.QtWidgets.QWidget()
+        self.mix_area_layout = PySide6.QtWidgets.QHBoxLayout(self.mix_area)
+        self.mix_area_layout.setContentsMargins(0, 0, 0, 0)
+        self.track_mixers = []
+        self.master_meter = ImeMeter.ImeMeterWidget(self.mix_area, self.parent.tracks.meter)
+        self.parent.tracks.tracks_changed_signal.connect(self.update_mix_area)
+        self.update_mix_area()
+        layout.addWidget(self.mix_area)
+        self.meter_timer = PySide6.QtCore.QTimer(self)
+        self.meter_timer.setInterval(int(ImeMeter.METER_INTERVAL * 1000))
+        self.meter_timer.timeout.connect(self.update_meters)
+        self.meter_timer.start()
+
+    def update_mix_area(self):
+        while self.mix_area_layout.count():
+            widget = self.mix_area_layout.takeAt(0).widget()
+            if widget is not None and widget is not self.master_meter:
+                widget.deleteLater()
+        self.track_mixers = [ImeTrack.ImeTrackMixer(self.mix_area, track) for track in self.parent.tracks]
+        for track_mixer in self.track_mixers:
+            self.mix_area_layout.addWidget(track_mixer)
+        self.mix_area_layout.addStretch()
+        self.mix_area_layout.addWidget(self.master_meter)
+
+    def update_meters(self):
+        for track_mixer in self.track_mixers:
+            track_mixer.update_meter()
+        self.master_meter.update()
 
     def update_track_table(self):
         self.track_area.setRowCount(len(self.parent.tracks))
         for row, track in enumerate(self.parent.tracks):
             track_handle = ImeTrack.ImeTrackHandle(self.track_area, track)
             self.track_area.setCellWidget(row, 0, track_handle)
-            # bugbug: implement the content view
-            #contents_item = PySide6.QtWidgets.QTableWidgetItem(str(track.wavs))
-            #self.track_area.setItem(row, 1, contents_item)
+            track_content = ImeTrack.ImeTrackContent(self.track_area, track)
+            self.track_area.setCellWidget(row, 1, track_content)
@@ -0,0 +1,301 @@
+#!python3
+r""" ImePeaks.py
+
+    ImePeaks is a min/max/RMS pyramid of a wave for drawing overviews.
+
+    Level 0 summarizes every BASE frames of the wave, each level above it
+    summarizes pairs of bins of the level below, so level k covers
+    BASE * 2**k frames per bin. Drawing a track looks up the coarsest level
+    that still has a bin per pixel, which keeps the work proportional to the
+    width of the widget rather than to the length of the track.
+
+    A wave that is still growing, a recording, starts from empty() and adds
+    its frames with extend(), which only computes the bins they change.
+
+    The pyramid is built in one pass over the frames when a file is opened
+    and saved next to it in a sidecar file, FILENAME + SIDECAR_SUFFIX. The
+    sidecar records the size and mtime of the source and is ignored when
+    either has changed.
+
+    The pyramid summarizes the frames before the gain of the wave, so it
+    depends only on the file and not on how the file was opened or scaled
+    since. query applies the gain the caller passes, e.g. wave.gain.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import os
+import warnings
+
+import numpy
+
+import ImeWavFile
+
+
+# frames per bin of level 0
+BASE = 256
+SIDECAR_SUFFIX = '.imepeaks'
+# bumped whenever the sidecar layout changes
+SIDECAR_VERSION = 2
+
+
+class ImePeaks:
+    """Multi-resolution min/max/RMS summary of a wave."""
+
+    def __init__(self, levels, nframes, base=BASE):
+        """Initializes the pyramid.
+
+        levels: list of (mins, maxs, rms) tuples, each array of shape
+                (nchannels, bins), level 0 first
+        nframes: number of frames in the wave
+        base: frames per bin of level 0
+        """
+        self.levels = levels
+        self.nframes = nframes
+        self.base = base
+        # for extend, the frames of the last, partial bin of level 0 and the
+        # arrays the levels are views of, with room to grow
+        self._tail = None
+        self._store = None
+
+    def __repr__(self):
+        return f"ImePeaks(nframes={self.nframes}, base={self.base}, levels={len(self.levels)})"
+
+    @property
+    def nchannels(self):
+        return len(self.levels[0][0])
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for level in self.levels for a in level)
+
+    @classmethod
+    def from_wave(cls, wave, base=BASE, block_frames=ImeWavFile.BLOCK_FRAMES):
+        """Builds the pyramid with one pass over the frames of wave.
+
+        The frames are read with get_frames a block at a time, so building
+        the peaks of a mapped wave does not decode it as a whole. The gain of
+        wave is divided out, see query.
+
+        wave: ImeWave
+        base: frames per bin of level 0
+        block_frames: frames read per block, rounded down to a multiple of base
+
+        returns: new ImePeaks
+        """
+        block_frames = max(base, block_frames - block_frames % base)
+        nbins = -(-len(wave) // base)
+        mins = numpy.empty((wave.nchannels, nbins), dtype=numpy.float32)
+        maxs = numpy.empty_like(mins)
+        rms = numpy.empty_like(mins)
+        for i in range(0, len(wave), block_frames):
+            ys = wave.get_frames(i, i + block_frames).reshape(wave.nchannels, -1)
+            k = i // base
+            _summarize(ys, base, mins[:, k:], maxs[:, k:], rms[:, k:])
+
+        if wave.gain and wave.gain != 1.0:
+            mins, maxs = mins / numpy.float32(wave.gain), maxs / numpy.float32(wave.gain)
+            if wave.gain < 0:
+                mins, maxs = maxs, mins
+            rms /= numpy.float32(abs(wave.gain))
+
+        levels = [(mins, maxs, rms)]
+        while levels[-1][0].shape[-1] > 1:
+            levels.append(_halve(*levels[-1]))
+        return cls(levels, len(wave), base)
+
+    @classmethod
+    def empty(cls, nchannels, base=BASE):
+        """Returns the pyramid of a wave with no frames yet, see extend.
+
+        nchannels: number of channels of the wave
+        base: frames per bin of level 0
+        """
+        zeros = numpy.zeros((nchannels, 0), dtype=numpy.float32)
+        peaks = cls([(zeros, zeros, zeros)], 0, base)
+        peaks._tail = zeros
+        peaks._store = []
+        return peaks
+
+    def extend(self, ys):
+        """Adds frames at the end of a wave that is still growing, e.g. a
+        recording, for a pyramid made by empty.
+
+        Only the bins the new frames fall in are computed, on every level,
+        so the cost follows the number of frames added and not the length of
+        the wave. The arrays grow by doubling. Another thread may query
+        while this runs, it sees the old pyramid or the new one.
+
+        ys: float array of shape (frames,) or (nchannels, frames), at gain 1
+        """
+        if self._tail is None:
+            raise ValueError(f"{self.__class__.__name__} was not made by empty() and cannot grow")
+        ys = numpy.asarray(ys, dtype=numpy.float32).reshape(self.nchannels, -1)
+        if not ys.shape[-1]:
+            return
+        # the partial bin is computed again with the new frames
+        frames = numpy.concatenate((self._tail, ys), axis=-1)
+        k = (self.nframes - self._tail.shape[-1]) // self.base
+        nbins = -(-frames.shape[-1] // self.base)
+        bins = tuple(numpy.empty((self.nchannels, nbins), dtype=numpy.float32) for _ in range(3))
+        _summarize(frames, self.base, *bins)
+        levels = [self._put(0, k, bins)]
+        while levels[-1][0].shape[-1] > 1:
+            k //= 2
+            below = tuple(a[:, 2 * k:] for a in levels[-1])
+            levels.append(self._put(len(levels), k, _halve(*below)))
+        self._tail = frames[:, frames.shape[-1] - frames.shape[-1] % self.base:].copy()
+        self.levels = levels
+        self.nframes += ys.shape[-1]
+
+    def _put(self, j, k, bins):
+        # writes bins at index k of level j, returns views of the level
+        n = k + bins[0].shape[-1]
+        if j == len(self._store):
+            self._store.append(tuple(numpy.empty((self.nchannels, 0), dtype=numpy.float32) for _ in range(3)))
+        store = self._store[j]
+        if n > store[0].shape[-1]:
+            capacity = max(n, 2 * store[0].shape[-1])
+            grown = tuple(numpy.empty((self.nchannels, capacity), dtype=numpy.float32) for _ in range(3))
+            for g, s in zip(grown, store):
+                g[:, :k] = s[:, :k]
+            self._store[j] = store = grown
+        for s, b in zip(store, bins):
+            s[:, k:n] = b
+        return tuple(s[:, :n] for s in store)
+
+    @classmethod
+    def for_file(cls, filename, wave):
+        """Returns the pyramid for a wave read from filename.
+
+        The sidecar is used when it matches the file, otherwise the pyramid
+        is built from wave and the sidecar is written for next time.
+
+        filename: path of the source file
+        wave: ImeWave read from filename
+
+        returns: ImePeaks
+        """
+        key = _source_key(filename)
+        sidecar = filename + SIDECAR_SUFFIX
+        peaks = cls.load(sidecar, key)
+        if peaks is None or peaks.nframes != len(wave) or peaks.nchannels != wave.nchannels:
+            peaks = cls.from_wave(wave)
+            try:
+                peaks.save(sidecar, key)
+            except OSError as e:
+                # a read only folder only costs us the rebuild next time
+                warnings.warn(f"{cls.__name__} could not write {sidecar}: {e}")
+        return peaks
+
+    def save(self, sidecar, key):
+        """Writes the pyramid to a sidecar file.
+
+        sidecar: path of the file to write
+        key: (size, mtime_ns) of the source file
+        """
+        arrays = dict()
+        for k, (mins, maxs, rms) in enumerate(self.levels):
+            arrays[f'mins{k}'] = mins
+            arrays[f'maxs{k}'] = maxs
+            arrays[f'rms{k}'] = rms
+        header = numpy.array([SIDECAR_VERSION, key[0], key[1], self.nframes, self.base, len(self.levels)],
+                             dtype=numpy.int64)
+        with open(sidecar, 'wb') as f:
+            numpy.savez(f, header=header, **arrays)
+
+    @classmethod
+    def load(cls, sidecar, key):
+        """Reads a pyramid from a sidecar file.
+
+        sidecar: path of the file to read
+        key: (size, mtime_ns) the source file must still have
+
+        returns: ImePeaks, or None if the sidecar is missing or stale
+        """
+        try:
+            with numpy.load(sidecar) as data:
+                version, size, mtime_ns, nframes, base, nlevels = (int(x) for x in data['header'])
+                if version != SIDECAR_VERSION or (size, mtime_ns) != tuple(key):
+                    return None
+                levels = [(data[f'mins{k}'], data[f'maxs{k}'], data[f'rms{k}']) for k in range(nlevels)]
+        except (OSError, KeyError, ValueError):
+            return None
+        return cls(levels, nframes, base)
+
+    def level_for(self, frames_per_bin):
+        """Returns the index of the coarsest level with at most frames_per_bin."""
+        if frames_per_bin < self.base:
+            return 0
+        k = int(numpy.log2(frames_per_bin / self.base))
+        return min(k, len(self.levels) - 1)
+
+    def query(self, start, end, nbins, gain=1.0):
+        """Summarizes the frames in [start, end) in nbins bins.
+
+        start: first frame
+        end: frame one past the last frame
+        nbins: number of bins to return, typically the width in pixels
+        gain: the gain of the wave, the pyramid is stored without it
+
+        returns: mins, maxs, rms arrays of shape (nchannels, nbins)
+        """
+        start = max(0, start)
+        end = min(self.nframes, end)
+        if end <= start or nbins < 1:
+            empty = numpy.zeros((self.nchannels, 0), dtype=numpy.float32)
+            return empty, empty, empty
+        k = self.level_for((end - start) / nbins)
+        mins, maxs, rms = self.levels[k]
+        size = self.base << k
+        i0 = start // size
+        i1 = max(i0 + 1, -(-end // size))
+        # first level bin of each output bin, reduceat folds the runs
+        edges = numpy.linspace(i0, i1, nbins + 1)
+        idx = edges[:-1].astype(numpy.intp)
+        counts = numpy.maximum(1, numpy.diff(edges.astype(numpy.intp)))
+        out_mins = numpy.minimum.reduceat(mins[:, i0:i1], idx - i0, axis=-1)
+        out_maxs = numpy.maximum.reduceat(maxs[:, i0:i1], idx - i0, axis=-1)
+        out_rms = numpy.sqrt(numpy.add.reduceat(rms[:, i0:i1] ** 2, idx - i0, axis=-1) / counts)
+        if gain != 1.0:
+            out_mins, out_maxs = out_mins * numpy.float32(gain), out_maxs * numpy.float32(gain)
+            if gain < 0:
+                out_mins, out_maxs = out_maxs, out_mins
+            out_rms *= numpy.float32(abs(gain))
+        return out_mins, out_maxs, out_rms
+
+
+def _summarize(ys, base, mins, maxs, rms):
+    """Fills a bin per base frames of ys, the last one may be partial.
+
+    ys: float array of shape (nchannels, frames)
+    mins, maxs, rms: arrays of shape (nchannels, bins or more) to write to
+    """
+    n = ys.shape[-1]
+    full = n - n % base
+    # every whole bin in one reduction each
+    bins = ys[:, :full].reshape(len(ys), -1, base)
+    kk = bins.shape[1]
+    bins.min(axis=-1, out=mins[:, :kk])
+    bins.max(axis=-1, out=maxs[:, :kk])
+    rms[:, :kk] = numpy.sqrt(numpy.einsum('cij,cij->ci', bins, bins) / base)
+    if full < n:
+        # the partial bin at the end
+        tail = ys[:, full:]
+        mins[:, kk] = tail.min(axis=-1)
+        maxs[:, kk] = tail.max(axis=-1)
+        rms[:, kk] = numpy.sqrt(numpy.mean(tail * tail, axis=-1))
+
+
+def _halve(mins, maxs, rms):
+    """Combines pairs of bins into the next level of the pyramid."""
+    if mins.shape[-1] & 1:
+        # repeat the last bin, min, max and rms of a pair of equals is itself
+        mins, maxs, rms = (numpy.concatenate((a, a[:, -1:]), axis=-1) for a in (mins, maxs, rms))
+    return (numpy.minimum(mins[:, 0::2], mins[:, 1::2]),
+            numpy.maximum(maxs[:, 0::2], maxs[:, 1::2]),
+            numpy.sqrt((rms[:, 0::2] ** 2 + rms[:, 1::2] ** 2) / 2))
+
+
+def _source_key(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime_ns
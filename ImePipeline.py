@@ -0,0 +1,257 @@
+#!python3
+r""" ImePipeline.py
+
+    ImePipeline streams blocks of frames through a chain of stateful block
+    processors, so processing a file costs memory in proportion to the block
+    rather than to the file.
+
+        pipeline = ImePipeline.ImePipeline([
+            ImePipeline.Gain(0.5),
+            ImePipeline.Apodize(len(w), w.framerate),
+            ImePipeline.Filter(taps),
+        ])
+        with ImeWavWriter.ImeWavWriter('out.wav', w.framerate, w.nchannels) as writer:
+            pipeline.run(w.iter_blocks(), ImePipeline.Encode(writer))
+
+    A block is what ImeWave.get_frames returns, a 1-D array for mono or a
+    planar (nchannels, frames) array. A processor may return fewer or more
+    frames than it was given, e.g. a resampler holds back the input frames
+    its filter still needs. A Filter returns exactly the frames it is given,
+    however long it is, and emits its tail when the stream is flushed, so a
+    stream cut into segments that each run without a flush, as ImeBounce
+    does, loses nothing at the cuts. Processors never modify the block they
+    are given in place, it may be a view of a wave's ys.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import numpy
+
+import ImeConvolver
+import ImeResampler
+import ImeWave
+
+
+class ImeBlockProcessor:
+    """Base class of the pipeline stages."""
+
+    def process(self, block):
+        """Processes one block.
+
+        block: NumPy array, 1-D or (nchannels, frames)
+
+        returns: NumPy array, or None if there is nothing to pass on yet
+        """
+        return block
+
+    def flush(self):
+        """Ends the stream.
+
+        returns: NumPy array of the frames still held back, or None
+        """
+        return None
+
+    def reset(self):
+        """Forgets the state so the processor can run another stream."""
+
+
+class Gain(ImeBlockProcessor):
+    """Multiplies every frame by a constant."""
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def process(self, block):
+        return block * block.dtype.type(self.factor)
+
+
+class Window(ImeBlockProcessor):
+    """Multiplies the stream by a window that spans the whole stream.
+
+    The window is either a sequence as long as the stream, or a function
+    gains(start, end) returning the multipliers of frames [start, end), which
+    lets long streams avoid a full length window.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.position = 0
+
+    def gains(self, start, end):
+        if callable(self.window):
+            return self.window(start, end)
+        return numpy.asarray(self.window[start:end])
+
+    def process(self, block):
+        n = block.shape[-1]
+        gains = self.gains(self.position, self.position + n)
+        self.position += n
+        return block * gains.astype(block.dtype, copy=False)
+
+    def reset(self):
+        self.position = 0
+
+
+class Apodize(Window):
+    """Tapers the beginning and end of the stream, see ImeWave.apodize."""
+
+    def __init__(self, nframes, framerate, denom=20, duration=0.1):
+        k = min(nframes // denom, int(duration * framerate))
+        super().__init__(lambda start, end: ImeWave.apodize_gains(start, end, nframes, k))
+
+
+class Filter(ImeBlockProcessor):
+    """Streaming FIR filter.
+
+    The last len(taps) - 1 input frames are carried from block to block, so
+    the output is the same as numpy.convolve over the whole stream with
+    mode="full", the tail comes out of flush. Filters longer than
+    ImeConvolver.DIRECT_TAPS, e.g. a reverb impulse response, go through a
+    partial ImeConvolver instead. Either way process returns as many frames
+    as it is given, there is no latency, in the dtype of the block.
+    """
+
+    def __init__(self, taps, block_frames=ImeConvolver.MIN_PARTITION):
+        self.taps = numpy.asarray(taps)
+        self.block_frames = block_frames
+        self._history = None
+        self._convolver = None
+        self._dtype = None
+
+    def _start_convolver(self, dtype):
+        # the convolver runs in the float dtype of the stream, so float32
+        # blocks are transformed in float32
+        taps = self.taps.astype(dtype, copy=False) if dtype.kind == 'f' else self.taps
+        if self._convolver is None or self._convolver.taps.dtype != taps.dtype:
+            self._convolver = ImeConvolver.ImeConvolver(taps, self.block_frames, partial=True)
+        self._dtype = dtype
+
+    def _convolve(self, xs):
+        if xs.ndim == 1:
+            return numpy.convolve(xs, self.taps, mode='valid')
+        return numpy.stack([numpy.convolve(x, self.taps, mode='valid') for x in xs])
+
+    def process(self, block):
+        if len(self.taps) > ImeConvolver.DIRECT_TAPS:
+            if self._dtype is None:
+                self._start_convolver(block.dtype)
+            out = self._convolver.process(block)
+            return None if out is None else out.astype(self._dtype, copy=False)
+        if self._history is None:
+            self._history = numpy.zeros(block.shape[:-1] + (len(self.taps) - 1,), dtype=block.dtype)
+        xs = numpy.concatenate((self._history, block), axis=-1)
+        self._history = xs[..., xs.shape[-1] - (len(self.taps) - 1):]
+        return self._convolve(xs).astype(block.dtype, copy=False)
+
+    def flush(self):
+        if self._convolver is not None:
+            out = self._convolver.flush()
+            dtype, self._dtype = self._dtype, None
+            return None if out is None else out.astype(dtype, copy=False)
+        if self._history is None or len(self.taps) < 2:
+            return None
+        xs = numpy.concatenate((self._history, numpy.zeros_like(self._history)), axis=-1)
+        self._history = None
+        return self._convolve(xs).astype(xs.dtype, copy=False)
+
+    def reset(self):
+        self._history = None
+        self._dtype = None
+        if self._convolver is not None:
+            self._convolver.reset()
+
+
+class Resample(ImeBlockProcessor):
+    """Converts the frame rate of the stream, see ImeResampler.
+
+    The input frames the filter still needs are held back between blocks,
+    the end of the stream comes out of flush.
+    """
+
+    def __init__(self, from_rate, to_rate, dtype=numpy.float32):
+        self.resampler = ImeResampler.ImeResampler(from_rate, to_rate, dtype=dtype)
+
+    def process(self, block):
+        return self.resampler.process(block)
+
+    def flush(self):
+        return self.resampler.flush()
+
+    def reset(self):
+        self.resampler.reset()
+
+
+class Encode(ImeBlockProcessor):
+    """Sink that writes the stream with an ImeWavWriter.
+
+    Blocks are passed through unchanged, so the encoder can sit in the
+    middle of a chain as a tap.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def process(self, block):
+        # the writer wants interleaved (frames, nchannels) blocks
+        self.writer.write(block.T)
+        return block
+
+
+class ImePipeline:
+    """A chain of block processors."""
+
+    def __init__(self, processors=()):
+        self.processors = list(processors)
+
+    def __repr__(self):
+        return f"ImePipeline({self.processors})"
+
+    def __call__(self, blocks, flush=True):
+        """Processes a stream of blocks.
+
+        blocks: iterable of NumPy arrays, e.g. ImeWave.iter_blocks()
+        flush: boolean, end the stream after the blocks, False leaves the
+               processors holding their state, e.g. for a stream that is
+               cut short on purpose
+
+        returns: generator of the processed blocks, including the tails that
+                 come out when the processors are flushed at the end
+        """
+        for block in blocks:
+            yield from self._push(block, 0)
+        if not flush:
+            return
+        # flush in order, each tail still goes through the stages after it
+        for i, p in enumerate(self.processors):
+            tail = p.flush()
+            if tail is not None:
+                yield from self._push(tail, i + 1)
+
+    def _push(self, block, first):
+        for p in self.processors[first:]:
+            block = p.process(block)
+            if block is None or block.shape[-1] == 0:
+                return
+        yield block
+
+    def run(self, blocks, sink=None):
+        """Processes a stream of blocks into a sink.
+
+        blocks: iterable of NumPy arrays
+        sink: optional ImeBlockProcessor that consumes the output, e.g. Encode
+
+        returns: number of frames that came out of the chain
+        """
+        nframes = 0
+        for block in self(blocks):
+            if sink is not None:
+                sink.process(block)
+            nframes += block.shape[-1]
+        if sink is not None:
+            tail = sink.flush()
+            if tail is not None:
+                nframes += tail.shape[-1]
+        return nframes
+
+    def reset(self):
+        for p in self.processors:
+            p.reset()
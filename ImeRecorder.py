@@ -0,0 +1,275 @@
+#!python3
+r""" ImeRecorder.py
+
+    ImeRecorder captures a take from an audio input to a wav file, and the
+    take can be played and drawn while it is being recorded.
+
+    Nothing on the way waits on anything else:
+        QAudioSource    captures into its buffer, SOURCE_BUFFER long, and
+                        signals readyRead, the recorder only copies the
+                        whole frames out into an ImeRingBuffer
+        ImeRecordThread drains the ring to an ImeWavWriter a block at a
+                        time, in the format captured, and every
+                        PUBLISH_PERIOD flushes the file and publishes the
+                        frames on disk
+        GUI thread      gets grown_signal(nframes) and only moves the end
+                        of the clip of the take
+    Publishing remaps the file, see ImeWave.grow, and adds the new frames to
+    an ImePeaks made by ImePeaks.empty. So a take is never held in memory,
+    whatever its length, the playback thread reads it through the mapping
+    like any other wave, and the overview of the track grows with it.
+
+    The source is read rather than given a QIODevice to write to, PySide6
+    hands writeData its data as a str cut at the first zero byte.
+
+    If the writer falls behind by more than the ring holds, the frames that
+    do not fit are dropped and counted as overruns, in the ring and in the
+    ImeMetrics counter record.overruns.
+
+    The input device, channels and sample format come from the settings,
+    at the project rate:
+        audio_input             id of the QAudioDevice, default input if
+                                missing or unplugged
+        record_sample_format    Int16, Int32 or Float
+        record_channels         channels of the take
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import threading
+import time
+
+import numpy
+
+import PySide6
+import PySide6.QtMultimedia
+
+import ImeAudioIODevice
+import ImeAudioPlayer
+import ImeMetrics
+import ImePeaks
+import ImeRingBuffer
+import ImeWave
+import ImeWavWriter
+
+
+# frames the capture ring holds, about 3 s at 44.1 kHz, the longest the
+# writer may stall before frames are dropped
+RECORD_BUFFER = 1 << 17
+# seconds the source buffers, how long the GUI thread may stall before the
+# backend drops frames
+SOURCE_BUFFER = 1.0
+# frames written to the file per pass
+WRITE_FRAMES = 1 << 13
+# seconds between publishing the frames on disk to the track
+PUBLISH_PERIOD = 0.1
+DEFAULT_SAMPLE_FORMAT = 'Int16'
+DEFAULT_CHANNELS = 1
+
+# sample dtype: (bits, is_float) of the wav file
+_wav_formats = {
+    numpy.dtype(numpy.int16): (16, False),
+    numpy.dtype(numpy.int32): (32, False),
+    numpy.dtype(numpy.float32): (32, True),
+}
+
+
+class ImeRecordThread(threading.Thread):
+    """Consumer side of the capture ring, writes the take to disk."""
+
+    def __init__(self, ring, writer, wave, peaks, grown, finished, block_frames=WRITE_FRAMES,
+                 period=PUBLISH_PERIOD):
+        """Prepares the thread, start() runs it.
+
+        ring: ImeRingBuffer the input fills
+        writer: ImeWavWriter of the take, in the format of the ring
+        wave: ImeWave mapped from the file of writer, see ImeWave.grow
+        peaks: ImePeaks of wave, made by ImePeaks.empty
+        grown: called with the number of frames on disk after each publish
+        finished: called with None, or the error message if writing failed,
+                  once the file is closed
+        block_frames: frames written per pass
+        period: seconds between publishes
+        """
+        super().__init__(name=self.__class__.__name__, daemon=True)
+        self.ring = ring
+        self.writer = writer
+        self.wave = wave
+        self.peaks = peaks
+        self.grown = grown
+        self.finished = finished
+        self.period = period
+        self.published = 0
+        self._block = numpy.empty((min(block_frames, ring.capacity), ring.channels),
+                                  dtype=ring.dtype)
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def __repr__(self):
+        return f"ImeRecordThread(published={self.published}, writer={self.writer})"
+
+    def wake(self):
+        """Tells the thread there are frames in the ring, called by the producer."""
+        self._wake.set()
+
+    def stop(self):
+        """Asks the thread to write what is left and close the file, once
+        the producer has stopped. Returns at once, finished is called when
+        the file is closed."""
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        error = None
+        try:
+            last = time.monotonic()
+            while True:
+                stopping = self._stopping.is_set()
+                timed = ImeMetrics.metrics.enabled
+                if timed:
+                    t0 = time.perf_counter_ns()
+                n = self.ring.read(self._block)
+                if n:
+                    self.writer.write_encoded(self._block[:n])
+                    if timed:
+                        ImeMetrics.metrics.histogram('record.write').observe(time.perf_counter_ns() - t0)
+                if n == len(self._block):
+                    # more is waiting
+                    continue
+                now = time.monotonic()
+                if stopping or now - last >= self.period:
+                    self._publish()
+                    last = now
+                if stopping:
+                    break
+                self._wake.wait(self.period)
+                self._wake.clear()
+        except (OSError, ValueError) as e:
+            error = str(e)
+        finally:
+            self.writer.close()
+        self.finished(error)
+
+    def _publish(self):
+        # make the frames on disk visible to the track
+        self.writer.flush()
+        nframes = self.writer.nframes
+        if nframes <= self.published:
+            return
+        self.wave.grow(nframes)
+        self.peaks.extend(self.wave.get_frames(self.published, nframes))
+        self.published = nframes
+        self.grown(nframes)
+
+
+class ImeRecorder(PySide6.QtCore.QObject):
+    # Records one take at a time, see the module docstring. The signals are
+    # emitted from the writer thread and delivered on the thread of the
+    # recorder.
+    grown_signal = PySide6.QtCore.Signal(int)
+    finished_signal = PySide6.QtCore.Signal(str)
+    failed_signal = PySide6.QtCore.Signal(str)
+
+    def __init__(self, parent, settings, framerate, buffer_frames=RECORD_BUFFER):
+        super().__init__(parent)
+        self.settings = settings
+        self.framerate = framerate
+        self.buffer_frames = buffer_frames
+        self.filename = None
+        self.wave = None
+        self.peaks = None
+        self.audio_source = None
+        self.io_device = None
+        self.ring = None
+        self._partial = b''
+        self.writer_thread = None
+
+    def audio_device(self):
+        """Returns the QAudioDevice of the settings, or the default input."""
+        device_id = self.settings.value("audio_input")
+        if device_id:
+            for device in PySide6.QtMultimedia.QMediaDevices.audioInputs():
+                if device.id() == device_id:
+                    return device
+        return PySide6.QtMultimedia.QMediaDevices.defaultAudioInput()
+
+    def audio_format(self, device):
+        """Returns the QAudioFormat of the settings at the project rate."""
+        audio_format = PySide6.QtMultimedia.QAudioFormat()
+        audio_format.setSampleRate(self.framerate)
+        audio_format.setChannelCount(int(self.settings.value("record_channels", DEFAULT_CHANNELS)))
+        sample_format = self.settings.value("record_sample_format", DEFAULT_SAMPLE_FORMAT)
+        audio_format.setSampleFormat(ImeAudioPlayer.SAMPLE_FORMATS.get(
+            sample_format, ImeAudioPlayer.SAMPLE_FORMATS[DEFAULT_SAMPLE_FORMAT]))
+        if not device.isNull() and not device.isFormatSupported(audio_format):
+            preferred = device.preferredFormat()
+            print(f"{device.description()} does not support {audio_format}, using the channels and sample format of {preferred}")
+            audio_format.setChannelCount(preferred.channelCount())
+            if preferred.sampleFormat() in ImeAudioPlayer.SAMPLE_FORMATS.values():
+                audio_format.setSampleFormat(preferred.sampleFormat())
+        return audio_format
+
+    def is_recording(self):
+        return self.writer_thread is not None
+
+    def start(self, filename):
+        """Starts recording a take to filename.
+
+        filename: path of the wav file to create
+
+        returns: the ImeWave of the take, it grows while recording, and its
+                 ImePeaks
+        """
+        if self.is_recording():
+            raise ValueError(f"{self.__class__.__name__} is already recording {self.filename}")
+        device = self.audio_device()
+        audio_format = self.audio_format(device)
+        dtype = ImeAudioIODevice.sample_dtypes[audio_format.sampleFormat()]
+        bits, is_float = _wav_formats[dtype]
+        channels = audio_format.channelCount()
+
+        writer = ImeWavWriter.ImeWavWriter(filename, self.framerate, channels, bits=bits, is_float=is_float)
+        writer.flush()
+        self.filename = filename
+        self.wave = ImeWave.ImeWave.from_file(filename, mmap=True)
+        self.peaks = ImePeaks.ImePeaks.empty(channels)
+        self.ring = ImeRingBuffer.ImeRingBuffer(self.buffer_frames, channels, dtype)
+        self._partial = b''
+        self.writer_thread = ImeRecordThread(self.ring, writer, self.wave, self.peaks,
+                                             self.grown_signal.emit, self._thread_finished)
+        self.writer_thread.start()
+        self.audio_source = PySide6.QtMultimedia.QAudioSource(device, audio_format, self)
+        self.audio_source.setBufferSize(int(SOURCE_BUFFER * self.framerate) * self.ring.bytes_per_frame)
+        self.io_device = self.audio_source.start()
+        self.io_device.readyRead.connect(self.capture)
+        return self.wave, self.peaks
+
+    @PySide6.QtCore.Slot()
+    def capture(self):
+        # Copies the whole frames the source has into the ring and keeps a
+        # partial frame for next time, nothing else happens on this thread.
+        data = self._partial + self.io_device.readAll().data()
+        nframes = len(data) // self.ring.bytes_per_frame
+        frames = numpy.frombuffer(data, dtype=self.ring.dtype, count=nframes * self.ring.channels)
+        written = self.ring.write(frames.reshape(nframes, self.ring.channels))
+        if written < nframes and ImeMetrics.metrics.enabled:
+            ImeMetrics.metrics.counter('record.overruns').add()
+        self._partial = data[nframes * self.ring.bytes_per_frame:]
+        self.writer_thread.wake()
+
+    def stop(self):
+        """Stops capturing, the writer thread finishes the file and then
+        emits finished_signal or failed_signal."""
+        if not self.is_recording():
+            return
+        self.io_device.readyRead.disconnect(self.capture)
+        self.capture()
+        self.audio_source.stop()
+        self.writer_thread.stop()
+
+    def _thread_finished(self, error):
+        # on the writer thread, the signals carry it to ours
+        self.writer_thread = None
+        if error:
+            self.failed_signal.emit(error)
+        else:
+            self.finished_signal.emit(self.filename)
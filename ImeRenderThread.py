@@ -0,0 +1,93 @@
+#!python3
+r""" ImeRenderThread.py
+
+    ImeRenderThread mixes the project ahead of the playhead into an
+    ImeRingBuffer, so the audio callback only copies frames that are already
+    rendered and a stall of the GUI thread no longer reaches the sink.
+
+    The thread keeps the ring topped up to its capacity, the read ahead, one
+    block at a time: mix, convert to the sink format, write. When the ring
+    is full it sleeps until the consumer wakes it after a read, or for half a
+    block at the most.
+
+    When the ring runs dry the consumer plays silence instead and adds the
+    frames to silence_frames. The thread skips the same number of frames
+    before rendering on, so the playhead and the rendered audio stay in
+    step. Both counters only grow and each has one writer.
+
+    A thread renders from the frame it was started at until the end of the
+    mix. Seeking stops it and starts a new one at the new position.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import threading
+import time
+
+import ImeMetrics
+
+
+# frames rendered ahead of the playhead, about 190 ms at 44.1 kHz
+READ_AHEAD = 8192
+# frames rendered per pass, a quarter of the default read ahead
+RENDER_FRAMES = 2048
+
+
+class ImeRenderThread(threading.Thread):
+    """Producer side of the playback ring."""
+
+    def __init__(self, engine, converter, ring, frame=0, framerate=44100):
+        """Prepares the thread, start() runs it.
+
+        engine: ImeMixEngine to mix with
+        converter: ImeSampleConverter to the sink format
+        ring: ImeRingBuffer shared with the consumer
+        frame: project frame to render from
+        framerate: frames per second of the sink, sets the sleep period
+        """
+        super().__init__(name=self.__class__.__name__, daemon=True)
+        self.engine = engine
+        self.converter = converter
+        self.ring = ring
+        self.frame = frame
+        self.block_frames = min(engine.block_frames, converter.block_frames, ring.capacity)
+        self.period = self.block_frames / framerate / 2
+        # set by the consumer
+        self.silence_frames = 0
+        # set by this thread
+        self._skipped_frames = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def __repr__(self):
+        return f"ImeRenderThread(frame={self.frame}, block_frames={self.block_frames}, ring={self.ring})"
+
+    def wake(self):
+        """Tells the thread there is room in the ring, called by the consumer."""
+        self._wake.set()
+
+    def stop(self):
+        """Stops the thread and waits for it to finish."""
+        self._stopping.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        while not self._stopping.is_set():
+            skip = self.silence_frames - self._skipped_frames
+            self._skipped_frames += skip
+            self.frame += skip
+            n = min(self.block_frames, self.engine.nframes() - self.frame)
+            if n <= 0 or self.ring.write_available() < n:
+                # full, or at the end of the mix for now, tracks may grow
+                self._wake.wait(self.period)
+                self._wake.clear()
+                continue
+            timed = ImeMetrics.metrics.enabled
+            if timed:
+                t0 = time.perf_counter_ns()
+            self.ring.write(self.converter.convert(self.engine.mix(self.frame, n)))
+            self.frame += n
+            if timed:
+                ImeMetrics.metrics.histogram('render.block').observe(time.perf_counter_ns() - t0)
+                ImeMetrics.metrics.counter('render.frames').add(n)
@@ -0,0 +1,227 @@
+#!python3
+r""" ImeResampler.py
+
+    ImeResampler converts the sample rate of a stream with a windowed-sinc
+    polyphase filter.
+
+    The ratio of the rates is reduced to up / down, 48000 / 44100 is
+    160 / 147. Output frame n sits at input position n * down / up, its
+    whole part i picks the input frames and its fractional part, one of up
+    phases, picks a row of precomputed filter taps:
+        y[n] = sum over m of taps[phase(n), m] * x[i(n) - half + 1 + m]
+    The taps are a sinc low-pass shaped by a Kaiser window, each row
+    normalized to unity gain at DC. A windowed sinc has its transition band
+    centered on the cutoff, so the cutoff sits below the lower of the two
+    Nyquist rates by half the transition band, which narrows as the filter
+    gets longer. With ZERO_CROSSINGS and ROLLOFF as set, 48 to 44.1 kHz is
+    flat to 20 kHz and attenuates 22.05 kHz and above by about 90 dB, and
+    44.1 to 48 kHz leaves images above 22.05 kHz at about -90 dB.
+
+    The outputs n, n + up, n + 2 * up, ... share a phase and their input
+    frames start down frames apart, so for each phase the input frames of
+    all its outputs are a strided view of the buffer, reduced with that
+    phase's row of taps in one matrix product. The loop runs over the
+    phases, not the frames. Ratios with more phases than a block has
+    outputs, e.g. 44100 to 48001, gather the input frames of every output
+    into a (frames, taps) matrix instead.
+
+    Equal rates pass the frames through untouched.
+
+    The same object works on a whole array or as a stream of blocks. A
+    stream carries the input frames the next outputs still need from block
+    to block, and flush pads the end with zeros so the output has
+    ceil(nframes * up / down) frames, as a whole-array conversion does.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import math
+
+import numpy
+
+
+# zero crossings of the sinc on each side of the center, more is a steeper
+# transition band and more taps per output frame, at 64 the transition band
+# is about 8% of the cutoff wide
+ZERO_CROSSINGS = 64
+# Kaiser window shape, about 85 dB of stopband attenuation
+KAISER_BETA = 8.6
+# the cutoff as a fraction of the lower Nyquist rate, low enough that the
+# upper half of the transition band ends at the Nyquist rate
+ROLLOFF = 0.94
+# output frames computed per vectorized pass, bounds the gather matrix
+CHUNK_FRAMES = 1 << 13
+# the phases are evaluated one by one while a block has at least this many
+# outputs per phase, see the module docstring
+MIN_PHASE_FRAMES = 8
+
+
+def polyphase_taps(up, down, zero_crossings=ZERO_CROSSINGS, beta=KAISER_BETA, rolloff=ROLLOFF):
+    """Designs the filter table of a conversion by up / down.
+
+    returns: array of shape (up, ntaps), row p holds the taps of the outputs
+             whose input position has the fractional part p / up
+    """
+    cutoff = rolloff * min(1.0, up / down)
+    half_width = zero_crossings / cutoff
+    half = int(math.ceil(half_width))
+    m = numpy.arange(2 * half)
+    # distance from each input frame to the output position, per phase
+    u = (numpy.arange(up) / up)[:, numpy.newaxis] + (half - 1 - m)
+    window = numpy.i0(beta * numpy.sqrt(numpy.clip(1.0 - (u / half_width) ** 2, 0.0, None))) / numpy.i0(beta)
+    window[numpy.abs(u) >= half_width] = 0.0
+    taps = cutoff * numpy.sinc(cutoff * u) * window
+    taps /= taps.sum(axis=1, keepdims=True)
+    return taps
+
+
+class ImeResampler:
+    """Windowed-sinc polyphase sample rate converter."""
+
+    def __init__(self, from_rate, to_rate, zero_crossings=ZERO_CROSSINGS, dtype=numpy.float32):
+        """Designs the filter.
+
+        from_rate: frames per second of the input
+        to_rate: frames per second of the output
+        zero_crossings: length of the filter on each side, see ZERO_CROSSINGS
+        dtype: float dtype of the taps and of the output
+        """
+        if from_rate <= 0 or to_rate <= 0:
+            raise ValueError(f"{from_rate=} and {to_rate=} must be positive")
+        g = math.gcd(int(from_rate), int(to_rate))
+        self.from_rate = from_rate
+        self.to_rate = to_rate
+        self.up = int(to_rate) // g
+        self.down = int(from_rate) // g
+        self.dtype = numpy.dtype(dtype)
+        self.taps = polyphase_taps(self.up, self.down, zero_crossings).astype(self.dtype)
+        self.half = self.taps.shape[1] // 2
+        self.reset()
+
+    def __repr__(self):
+        return f"ImeResampler({self.from_rate}, {self.to_rate}, ntaps={self.taps.shape[1]})"
+
+    def reset(self):
+        """Forgets the stream so another one can start."""
+        self._buffer = None     # input frames still needed, (channels, frames)
+        self._base = 0          # input index of the first frame in _buffer
+        self._consumed = 0      # input frames seen
+        self._produced = 0      # output frames returned
+        self._mono = False      # the blocks are 1-D
+
+    def nframes_out(self, nframes_in):
+        """Returns the length of the conversion of nframes_in frames."""
+        return -(-nframes_in * self.up // self.down)
+
+    def process(self, block):
+        """Converts the next block of a stream.
+
+        block: array of shape (frames,) or (channels, frames)
+
+        returns: the output frames the block completes, same number of
+                 dimensions as block
+        """
+        xs = numpy.asarray(block, dtype=self.dtype)
+        if self.up == self.down:
+            return xs
+        self._mono = xs.ndim == 1
+        xs = xs.reshape(-1, xs.shape[-1])
+        if self._buffer is None:
+            # the first outputs look half - 1 frames before the stream
+            self._buffer = numpy.zeros((len(xs), self.half - 1), dtype=self.dtype)
+            self._base = -(self.half - 1)
+        self._buffer = numpy.concatenate((self._buffer, xs), axis=-1)
+        self._consumed += xs.shape[-1]
+        ys = self._convert()
+        return ys[0] if self._mono else ys
+
+    def flush(self):
+        """Ends the stream.
+
+        returns: the last output frames, or None if there are none
+        """
+        if self._buffer is None:
+            return None
+        pad = numpy.zeros((len(self._buffer), self.half), dtype=self.dtype)
+        self._buffer = numpy.concatenate((self._buffer, pad), axis=-1)
+        ys = self._convert(self.nframes_out(self._consumed))
+        self._buffer = None
+        if not ys.shape[-1]:
+            return None
+        return ys[0] if self._mono else ys
+
+    def __call__(self, blocks):
+        """Converts a whole stream of blocks.
+
+        blocks: iterable of arrays, see process
+
+        returns: generator of the converted blocks, the flushed end included
+        """
+        self.reset()
+        for block in blocks:
+            ys = self.process(block)
+            if ys.shape[-1]:
+                yield ys
+        tail = self.flush()
+        if tail is not None:
+            yield tail
+
+    def resample(self, ys):
+        """Converts a whole array.
+
+        ys: array of shape (frames,) or (channels, frames)
+
+        returns: array of ceil(frames * up / down) frames
+        """
+        self.reset()
+        head = self.process(ys)
+        tail = self.flush()
+        self.reset()
+        if tail is None:
+            return head
+        return numpy.concatenate((head, tail), axis=-1)
+
+    def _convert(self, limit=None):
+        # The outputs whose last input frame, i(n) + half, is in the buffer.
+        # With a limit, the zero padded end of the stream, stop there.
+        last = self._base + self._buffer.shape[-1] - 1 - self.half
+        end = -(-(last + 1) * self.up // self.down)
+        if limit is not None:
+            end = min(end, limit)
+        start = self._produced
+        out = numpy.empty((len(self._buffer), max(0, end - start)), dtype=self.dtype)
+        if end - start >= MIN_PHASE_FRAMES * self.up:
+            self._convert_phases(out, start, end)
+        else:
+            self._convert_gather(out, start, end)
+        self._produced = max(start, end)
+        # keep what the next output still needs
+        keep = (self._produced * self.down) // self.up - (self.half - 1)
+        drop = min(self._buffer.shape[-1], max(0, keep - self._base))
+        self._buffer = self._buffer[:, drop:]
+        self._base += drop
+        return out
+
+    def _convert_phases(self, out, start, end):
+        # output start + r + m * up reads the input frames from
+        # i(start + r) - half + 1 + m * down, a strided view per phase
+        channel_stride, frame_stride = self._buffer.strides
+        ntaps = self.taps.shape[1]
+        for r in range(self.up):
+            n = start + r
+            position = n * self.down
+            i = position // self.up - self._base - (self.half - 1)
+            frames = numpy.lib.stride_tricks.as_strided(
+                self._buffer[:, i:], shape=(len(self._buffer), -(-(end - n) // self.up), ntaps),
+                strides=(channel_stride, self.down * frame_stride, frame_stride), writeable=False)
+            numpy.matmul(frames, self.taps[position % self.up], out=out[:, r::self.up])
+
+    def _convert_gather(self, out, start, end):
+        offsets = numpy.arange(self.taps.shape[1]) - (self.half - 1)
+        for n0 in range(start, end, CHUNK_FRAMES):
+            n = numpy.arange(n0, min(end, n0 + CHUNK_FRAMES))
+            position = n * self.down
+            i = position // self.up - self._base
+            phase = position % self.up
+            # (channels, frames, taps) input frames of each output frame
+            frames = self._buffer[:, i[:, numpy.newaxis] + offsets]
+            numpy.einsum('cnk,nk->cn', frames, self.taps[phase], out=out[:, n0 - start:n0 - start + len(n)])
@@ -0,0 +1,118 @@
+#!python3
+r""" ImeRingBuffer.py
+
+    ImeRingBuffer is a fixed size single-producer/single-consumer queue of
+    frames, used to hand rendered audio from the render thread to the audio
+    callback without either side ever waiting on the other, and captured
+    audio from the input callback to the thread that writes it to disk.
+
+    The frames live in one (capacity, channels) array allocated up front.
+    Each side owns one counter and only reads the other's:
+        _write_index    total frames ever written, only the producer sets it
+        _read_index     total frames ever read, only the consumer sets it
+    A side copies its frames first and publishes the new counter after, so
+    the other side never sees frames that are not there yet. The counters
+    only grow, frame i is stored at i % capacity, the frames available to
+    read are _write_index - _read_index. Assigning an int attribute is
+    atomic in CPython, so no lock is needed.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import numpy
+
+
+class ImeRingBuffer:
+    """Lock-free SPSC ring of frames."""
+
+    def __init__(self, capacity, channels, dtype):
+        """Allocates the ring.
+
+        capacity: number of frames the ring holds
+        channels: samples per frame
+        dtype: sample dtype
+        """
+        self.capacity = capacity
+        self._frames = numpy.zeros((capacity, channels), dtype=dtype)
+        self._write_index = 0
+        self._read_index = 0
+        # writes that did not fit, counted by the producer
+        self.overruns = 0
+        # reads that found the ring empty, counted by the consumer
+        self.underruns = 0
+
+    def __repr__(self):
+        return (f"ImeRingBuffer(capacity={self.capacity}, channels={self._frames.shape[1]}, "
+                f"dtype={self._frames.dtype}, available={self.read_available()})")
+
+    @property
+    def channels(self):
+        return self._frames.shape[1]
+
+    @property
+    def dtype(self):
+        return self._frames.dtype
+
+    @property
+    def bytes_per_frame(self):
+        return self._frames.shape[1] * self._frames.dtype.itemsize
+
+    def read_available(self):
+        return self._write_index - self._read_index
+
+    def write_available(self):
+        return self.capacity - (self._write_index - self._read_index)
+
+    def clear(self):
+        """Empties the ring, only while neither side is running."""
+        self._write_index = self._read_index = 0
+
+    def _spans(self, index, n):
+        # the one or two slices of the ring holding frames [index, index + n)
+        i = index % self.capacity
+        first = min(n, self.capacity - i)
+        return self._frames[i:i + first], self._frames[:n - first]
+
+    def write(self, frames):
+        """Appends frames, called only by the producer.
+
+        frames: array of shape (n, channels)
+
+        returns: number of frames written, less than n if the ring is full
+        """
+        n = min(len(frames), self.write_available())
+        if n < len(frames):
+            self.overruns += 1
+        head, tail = self._spans(self._write_index, n)
+        head[...] = frames[:len(head)]
+        tail[...] = frames[len(head):n]
+        self._write_index += n
+        return n
+
+    def read(self, out):
+        """Removes frames into out, called only by the consumer.
+
+        out: array of shape (n, channels) to copy to
+
+        returns: number of frames copied, fewer than n if the ring runs dry
+        """
+        n = min(len(out), self.read_available())
+        head, tail = self._spans(self._read_index, n)
+        out[:len(head)] = head
+        out[len(head):n] = tail
+        self._read_index += n
+        return n
+
+    def read_bytes(self, nframes):
+        """Removes frames and returns their bytes, called only by the consumer.
+
+        nframes: frames wanted
+
+        returns: bytes of up to nframes frames, fewer if the ring runs dry
+        """
+        n = min(nframes, self.read_available())
+        if n == 0 and nframes > 0:
+            self.underruns += 1
+        head, tail = self._spans(self._read_index, n)
+        data = head.tobytes() + tail.tobytes() if len(tail) else head.tobytes()
+        self._read_index += n
+        return data
@@ -0,0 +1,78 @@
+#!python3
+r""" ImeSampleConverter.py
+
+    ImeSampleConverter turns blocks of the float project mix into the
+    interleaved sample format of an audio sink.
+
+    The mix is planar (channels, frames) float in [-1.0, 1.0), a sink wants
+    interleaved frames of its own sample type. The conversion scales,
+    interleaves, clips and rounds in place in two scratch buffers allocated
+    once, so converting a block costs no allocation:
+        scaled  (block_frames, channels) float, the mix transposed and scaled
+        out     (block_frames, channels) sink dtype, the converted frames
+    Float sinks skip the scaling and clip straight into out.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import numpy
+
+
+# sample dtypes a sink can take, all in native byte order
+SAMPLE_DTYPES = (numpy.dtype(numpy.int16), numpy.dtype(numpy.int32), numpy.dtype(numpy.float32))
+
+
+class ImeSampleConverter:
+    """Converts planar float blocks to interleaved sink samples."""
+
+    def __init__(self, dtype, channels, block_frames):
+        """Allocates the scratch buffers.
+
+        dtype: sample dtype of the sink, one of SAMPLE_DTYPES
+        channels: channels of the sink
+        block_frames: the most frames converted per call
+        """
+        self.dtype = numpy.dtype(dtype)
+        if self.dtype not in SAMPLE_DTYPES:
+            raise ValueError(f"{self.dtype=} unsupported, expected one of {SAMPLE_DTYPES}")
+        self.channels = channels
+        self.block_frames = block_frames
+        self._out = numpy.empty((block_frames, channels), dtype=self.dtype)
+        self._scaled = None
+        if self.dtype.kind == 'i':
+            full_scale = 1 << (8 * self.dtype.itemsize - 1)
+            # float64 holds every int32 exactly, so the clipped value never
+            # rounds up past the largest sample
+            self._scaled = numpy.empty((block_frames, channels), dtype=numpy.float64)
+            self._full_scale = float(full_scale)
+            self._low = -float(full_scale)
+            self._high = float(full_scale - 1)
+
+    def __repr__(self):
+        return f"ImeSampleConverter({self.dtype}, channels={self.channels}, block_frames={self.block_frames})"
+
+    @property
+    def bytes_per_frame(self):
+        return self.channels * self.dtype.itemsize
+
+    def convert(self, block):
+        """Converts one block of the mix.
+
+        block: float array of shape (channels, frames), frames at most
+               block_frames
+
+        returns: view of the out buffer of shape (frames, channels), only
+                 valid until the next call
+        """
+        n = block.shape[-1]
+        out = self._out[:n]
+        if self._scaled is None:
+            numpy.clip(block.T, -1.0, 1.0, out=out)
+            return out
+        scaled = self._scaled[:n]
+        # writing the transpose into a C ordered buffer interleaves the
+        # channels in the same pass as the scaling
+        numpy.multiply(block.T, self._full_scale, out=scaled)
+        numpy.clip(scaled, self._low, self._high, out=scaled)
+        numpy.rint(scaled, out=scaled)
+        numpy.copyto(out, scaled, casting='unsafe')
+        return out
@@ -0,0 +1,221 @@
+#!python3
+r""" ImeSpectrogram.py
+
+    ImeSpectrogram computes short-time Fourier transforms and spectrograms
+    of a signal with NumPy alone, so the application draws spectral views
+    without librosa. The layout and defaults follow librosa.stft, the
+    result has shape (..., 1 + n_fft // 2, columns) and column t is the
+    spectrum of the window that starts at sample t * hop, centered on it
+    when center is set, with zeros padded beyond the ends.
+
+    The signal is never copied into frames. frame() makes a read-only view
+    of shape (..., columns, n_fft) with as_strided, whose rows overlap in
+    memory, the window multiplies the view and one batched rfft transforms
+    every row. Columns are computed chunk_columns at a time, so besides the
+    result the memory in use is one chunk of windowed frames and their
+    spectra. iter_stft reads the samples of each chunk through a function,
+    e.g. ImeWave.get_frames, so a mapped or encoded wave is decoded a chunk
+    at a time and a long file costs memory in proportion to the output.
+
+    The transforms run in float32 and return complex64 by default, half the
+    memory of float64, which is plenty for a display.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import numpy
+
+
+WINDOW_HANN = 'hann'
+WINDOW_HAMMING = 'hamming'
+WINDOW_BLACKMAN = 'blackman'
+WINDOW_RECTANGULAR = 'rectangular'
+
+# the defaults of librosa.stft, the hop defaults to n_fft // 4
+DEFAULT_NFFT = 2048
+# columns transformed per batch, bounds the windowed frames in memory
+CHUNK_COLUMNS = 256
+
+_windows = {
+    WINDOW_HANN: numpy.hanning,
+    WINDOW_HAMMING: numpy.hamming,
+    WINDOW_BLACKMAN: numpy.blackman,
+    WINDOW_RECTANGULAR: numpy.ones,
+}
+
+
+def get_window(window, n_fft, dtype=numpy.float32):
+    """Returns the analysis window.
+
+    The named windows are periodic, as for spectral analysis, rather than
+    symmetric like numpy.hanning.
+
+    window: one of the WINDOW_ names, or an array of n_fft values
+    n_fft: frames per window
+    dtype: float dtype of the window
+
+    returns: array of n_fft values
+    """
+    if isinstance(window, str):
+        if window not in _windows:
+            raise ValueError(f"{window=} unknown")
+        return _windows[window](n_fft + 1)[:n_fft].astype(dtype)
+    window = numpy.asarray(window, dtype=dtype)
+    if window.shape != (n_fft,):
+        raise ValueError(f"window has shape {window.shape}, expected ({n_fft},)")
+    return window
+
+
+def count_columns(nsamples, n_fft=DEFAULT_NFFT, hop=None, center=True):
+    """Returns the number of columns the STFT of nsamples samples has."""
+    hop = hop or n_fft // 4
+    if center:
+        nsamples += 2 * (n_fft // 2)
+    return 0 if nsamples < n_fft else 1 + (nsamples - n_fft) // hop
+
+
+def frame(ys, frame_length, hop):
+    """Slices a signal into overlapping frames without copying it.
+
+    ys: array of shape (..., samples)
+    frame_length: samples per frame
+    hop: samples between the starts of frames
+
+    returns: read-only view of shape (..., frames, frame_length) on ys
+    """
+    nframes = 0 if ys.shape[-1] < frame_length else 1 + (ys.shape[-1] - frame_length) // hop
+    return numpy.lib.stride_tricks.as_strided(
+        ys, shape=ys.shape[:-1] + (nframes, frame_length),
+        strides=ys.strides[:-1] + (hop * ys.strides[-1], ys.strides[-1]), writeable=False)
+
+
+def iter_stft(read, nsamples, n_fft=DEFAULT_NFFT, hop=None, window=WINDOW_HANN, center=True,
+              dtype=numpy.float32, chunk_columns=CHUNK_COLUMNS):
+    """Computes the STFT a chunk of columns at a time.
+
+    read: function of (start, end) that returns the samples in [start, end)
+          as an array of shape (..., end - start), e.g. ImeWave.get_frames
+    nsamples: length of the signal
+    n_fft: samples per window, the transform size
+    hop: samples between columns, default is n_fft // 4
+    window: see get_window
+    center: boolean, center column t on sample t * hop rather than start it there
+    dtype: float dtype of the transforms, float32 gives complex64
+    chunk_columns: columns per chunk
+
+    returns: generator of (first column, complex array of shape
+             (..., 1 + n_fft // 2, columns)), one chunk of no columns if
+             the signal is too short for any
+    """
+    hop = hop or n_fft // 4
+    dtype = numpy.dtype(dtype)
+    weights = get_window(window, n_fft, dtype)
+    pad = n_fft // 2 if center else 0
+    total = count_columns(nsamples, n_fft, hop, center)
+    if total == 0:
+        # transformed like the others, so it has their shape and dtype
+        xs = numpy.asarray(read(0, 0), dtype=dtype)
+        frames = numpy.empty(xs.shape[:-1] + (0, n_fft), dtype=dtype)
+        yield 0, numpy.swapaxes(numpy.fft.rfft(frames * weights, axis=-1), -1, -2)
+    for first in range(0, total, chunk_columns):
+        last = min(total, first + chunk_columns)
+        # the samples under the windows of the chunk, zeros beyond the ends
+        start = first * hop - pad
+        end = (last - 1) * hop + n_fft - pad
+        xs = numpy.asarray(read(max(0, start), min(nsamples, end)), dtype=dtype)
+        if start < 0 or end > nsamples:
+            before = max(0, -start)
+            after = end - start - before - xs.shape[-1]
+            xs = numpy.pad(xs, [(0, 0)] * (xs.ndim - 1) + [(before, after)])
+        spectra = numpy.fft.rfft(frame(xs, n_fft, hop) * weights, axis=-1)
+        yield first, numpy.swapaxes(spectra, -1, -2)
+
+
+def collect(chunks, total, convert=None):
+    """Copies the chunks of iter_stft into one array.
+
+    chunks: iterable of (first column, block), see iter_stft
+    total: number of columns, see count_columns
+    convert: optional function applied to each block first, e.g. magnitude
+
+    returns: array of shape (..., bins, total), None if there are no chunks
+    """
+    out = None
+    for first, block in chunks:
+        if convert is not None:
+            block = convert(block)
+        if out is None:
+            out = numpy.empty(block.shape[:-1] + (total,), dtype=block.dtype)
+        out[..., first:first + block.shape[-1]] = block
+    return out
+
+
+def stft(ys, n_fft=DEFAULT_NFFT, hop=None, window=WINDOW_HANN, center=True,
+         dtype=numpy.float32, chunk_columns=CHUNK_COLUMNS):
+    """Computes the short-time Fourier transform, like librosa.stft.
+
+    ys: array of shape (samples,) or (channels, samples)
+    other parameters: see iter_stft
+
+    returns: complex array of shape (..., 1 + n_fft // 2, columns)
+    """
+    ys = numpy.asarray(ys)
+    n = ys.shape[-1]
+    return collect(iter_stft(lambda i, j: ys[..., i:j], n, n_fft, hop, window, center, dtype, chunk_columns),
+                   count_columns(n, n_fft, hop, center))
+
+
+def spectrogram(ys, n_fft=DEFAULT_NFFT, hop=None, window=WINDOW_HANN, center=True, power=2.0,
+                dtype=numpy.float32, chunk_columns=CHUNK_COLUMNS):
+    """Computes the magnitude spectrogram, |stft| ** power.
+
+    Only the real result is kept, the complex spectra of a chunk are
+    dropped as soon as they are converted.
+
+    ys: array of shape (samples,) or (channels, samples)
+    power: 1.0 for magnitude, 2.0 for power
+    other parameters: see iter_stft
+
+    returns: float array of shape (..., 1 + n_fft // 2, columns)
+    """
+    ys = numpy.asarray(ys)
+    n = ys.shape[-1]
+    return collect(iter_stft(lambda i, j: ys[..., i:j], n, n_fft, hop, window, center, dtype, chunk_columns),
+                   count_columns(n, n_fft, hop, center), lambda block: magnitude(block, power))
+
+
+def magnitude(spectra, power=1.0):
+    """Returns |spectra| ** power in the real dtype of spectra."""
+    if power == 2.0:
+        return spectra.real ** 2 + spectra.imag ** 2
+    ys = numpy.abs(spectra)
+    return ys if power == 1.0 else ys ** ys.dtype.type(power)
+
+
+def power_to_db(S, ref=1.0, amin=1e-10, top_db=80.0):
+    """Converts a power spectrogram to decibels, like librosa.power_to_db.
+
+    S: power spectrogram
+    ref: the power of 0 dB, or a function of S, e.g. numpy.max
+    amin: the smallest power, avoids the log of zero
+    top_db: the range below the maximum that is kept, None keeps everything
+
+    returns: array of dB, the shape of S
+    """
+    S = numpy.asarray(S)
+    ref = ref(S) if callable(ref) else ref
+    db = 10 * numpy.log10(numpy.maximum(amin, S))
+    db -= 10 * numpy.log10(numpy.maximum(amin, ref))
+    if top_db is not None:
+        db = numpy.maximum(db, db.max() - top_db)
+    return db
+
+
+def amplitude_to_db(S, ref=1.0, amin=1e-5, top_db=80.0):
+    """Converts a magnitude spectrogram to decibels, like librosa.amplitude_to_db.
+
+    ref: the magnitude of 0 dB, or a function of S, e.g. numpy.max
+    other parameters: see power_to_db
+    """
+    S = numpy.asarray(S)
+    ref = ref(S) if callable(ref) else ref
+    return power_to_db(numpy.square(S), ref ** 2, amin ** 2, top_db)
@@ -9,29 +9,40 @@ r""" ImeTrack.py
     Copyright (c) 2024 Chip Ueltschey All rights reserved.
 """
 import typing
-import wave
 
 import numpy
 
 import PySide6
+import PySide6.QtGui
 import PySide6.QtWidgets
 
+import ImeClip
+import ImeIntervalTree
+import ImeMeter
+import ImePeaks
 import ImeWave
 
 class ImeTrack(PySide6.QtCore.QObject):
     name_changed_signal = PySide6.QtCore.Signal(str)
+    # the clips or their frames changed, e.g. a recording grew
+    data_changed_signal = PySide6.QtCore.Signal()
 
     def __init__(self, name=None):
         super().__init__()
         self._name = name
-        # maybe a list or dict of wav files
-        # and some way to process that list to produce a signal at the project time
+        # source waves by filename, the clips refer to these
         self.ws = dict()
+        # ImePeaks for each entry in ws, used to draw the track
+        self.peaks = dict()
+        # ImeClip objects by the project frames they cover
+        self.clips = ImeIntervalTree.ImeIntervalTree()
         # bugbug: connect these to the ImeTrackHandle and ImeTrackMixer
         self.mute = False
         self.solo = False
         self.volume = 1.0
         self.pan = 0
+        # post fader level, fed by the mix engine of the player
+        self.meter = ImeMeter.ImeMeter()
 
     @PySide6.QtCore.Property(str, notify=name_changed_signal)
     def name(self):
@@ -42,29 +53,85 @@ class ImeTrack(PySide6.QtCore.QObject):
         self._name = value
         self.name_changed_signal.emit(value)
 
-    def add_wav(self, filename):
-        self.ws[filename] = ImeWave.ImeWave.from_file(filename)
+    def add_wav(self, filename, precision=None, cache=None, position=0, framerate=None):
+        # memory map the file so opening is cheap and only the frames that
+        # are played or drawn are ever read from disk, with a cache the
+        # decoded copy is mapped instead
+        # A file at another rate than the project's is resampled, once if
+        # there is a cache.
+        w = ImeWave.ImeWave.from_file(filename, mmap=True, precision=precision, cache=cache, framerate=framerate)
+        return self.add_wave(filename, w, ImePeaks.ImePeaks.for_file(filename, w), position)
+
+    def add_wave(self, filename, w, peaks=None, position=0):
+        # for waves that were already loaded, e.g. by ImeFileLoader
+        # The whole wave becomes one clip at position.
+        self.ws[filename] = w
+        self.peaks[filename] = peaks if peaks else ImePeaks.ImePeaks.from_wave(w)
+        clip = ImeClip.ImeClip(w, position, name=filename)
+        self.add_clip(clip)
+        return clip
+
+    def add_clip(self, clip):
+        # also re-indexes a clip that is already on the track after its
+        # position or length was changed
+        self.clips.add(clip, clip.position, clip.end)
+
+    def remove_clip(self, clip):
+        self.clips.remove(clip)
+
+    def segments(self, start, end):
+        """Finds the clips that play in the project frames [start, end).
+
+        returns: list of (clip, source_start, source_end, at), see
+                 ImeClip.overlap
+        """
+        return [(clip, *clip.overlap(start, end)) for _, _, clip in self.clips.query(start, end)]
 
     def getData(self, start, end):
-        # bugbug: what we should be doing is looking up the start and end
-        # frames in an as yet non-existing mapping from project time to wave
-        # data to see which of the ImeWave objects and which location in that
-        # object we should return data from
-        w = next(iter(self.ws.values()))
-        return w.ys[start:end]
+        # The clips in [start, end) summed with their gains into a new
+        # array, 1-D for a mono track or (nchannels, frames). ImeMixEngine
+        # mixes the segments itself rather than calling this.
+        nchannels = self.channelCount()
+        out = numpy.zeros((max(1, nchannels), max(0, end - start)), dtype=numpy.float32)
+        for clip, source_start, source_end, at in self.segments(start, end):
+            out[:, at:at + source_end - source_start] += clip.wave.get_frames(source_start, source_end) * clip.gain
+        return out[0] if nchannels <= 1 else out
+
+    def getPeaks(self, start, end, nbins):
+        # The channels are folded together, the overview shows their envelope.
+        # Each clip fills the bins it covers from the peaks of its source,
+        # the gaps between clips are silence.
+        if not self.clips or end <= start or nbins < 1:
+            return None
+        mins = numpy.full(nbins, numpy.inf, dtype=numpy.float32)
+        maxs = numpy.full(nbins, -numpy.inf, dtype=numpy.float32)
+        rms = numpy.zeros(nbins, dtype=numpy.float32)
+        scale = nbins / (end - start)
+        for clip, source_start, source_end, at in self.segments(start, end):
+            p = self.peaks.get(clip.name)
+            if p is None:
+                continue
+            b0 = min(nbins - 1, int(at * scale))
+            b1 = max(b0 + 1, min(nbins, int(numpy.ceil((at + source_end - source_start) * scale))))
+            lo, hi, r = p.query(source_start, source_end, b1 - b0, clip.wave.gain)
+            numpy.minimum(mins[b0:b1], lo.min(axis=0) * clip.gain, out=mins[b0:b1])
+            numpy.maximum(maxs[b0:b1], hi.max(axis=0) * clip.gain, out=maxs[b0:b1])
+            numpy.maximum(rms[b0:b1], r.max(axis=0) * clip.gain, out=rms[b0:b1])
+        silent = mins > maxs
+        mins[silent] = 0
+        maxs[silent] = 0
+        return mins, maxs, rms
+
+    def frameCount(self):
+        # project frame one past the end of the last clip
+        return self.clips.span()[1]
+
+    def channelCount(self):
+        return max((w.nchannels for w in self.ws.values()), default=0)
 
     def totalSize(self):
-        # bugbug: update when implementing map of project time to wav data
-        print(f"ImeTrack({self.name}).totalSize()")
-        w = next(iter(self.ws.values()))
-        return w.totalSize()
-
-
-
-    # bugbug: add method for extracting the series data
-    #         Eventually we will need some sort of control structure
-    #         that maps from the ws dict to project time,
-    #         but as a first step, assume one file and provide its data.
+        # bytes of the source waves the clips play from
+        return sum(w.totalSize() for w in self.ws.values())
 
 
 class ImeTrackHandle(PySide6.QtWidgets.QWidget):
@@ -99,12 +166,80 @@ class ImeTrackHandle(PySide6.QtWidgets.QWidget):
         self.track_name.setText(value)
 
 
-# newrel: add class for track content widget
-#         update ImeMixerView.update_track_table to instantiate this class and
-#         add it to the table
+class ImeTrackContent(PySide6.QtWidgets.QWidget):
+    # Draws the waveform overview of a track from its ImePeaks, so a repaint
+    # costs a few bins per pixel no matter how long the track is.
+    # The wheel scrolls, ctrl+wheel zooms around the mouse.
+
+    def __init__(self, parent, track):
+        if not parent:
+            raise ValueError(f"{self.__class__.__name__} must have valid {parent=}")
+        if not isinstance(track, ImeTrack):
+            raise ValueError(f"{self.__class__.__name__} {track=} must be an instance of ImeTrack")
+        super().__init__(parent)
+        self.track = track
+        self.start = 0                  # first frame at the left edge
+        self.frames_per_pixel = None    # None fits the whole track
+        self.setMinimumHeight(40)
+        self.track.data_changed_signal.connect(self.update)
+
+    def _frames_per_pixel(self):
+        if self.frames_per_pixel:
+            return self.frames_per_pixel
+        return max(1.0, self.track.frameCount() / max(1, self.width()))
+
+    def paintEvent(self, event):
+        painter = PySide6.QtGui.QPainter(self)
+        width, height = self.width(), self.height()
+        fpp = self._frames_per_pixel()
+        end = self.start + int(fpp * width)
+        peaks = self.track.getPeaks(self.start, end, width)
+        if peaks is None:
+            return
+        mins, maxs, rms = peaks
+        mid = height / 2
+        painter.setPen(self.palette().color(PySide6.QtGui.QPalette.WindowText))
+        painter.drawLines([PySide6.QtCore.QLineF(x, mid - hi * mid, x, mid - lo * mid)
+                           for x, (lo, hi) in enumerate(zip(mins.tolist(), maxs.tolist()))])
+        painter.setPen(self.palette().color(PySide6.QtGui.QPalette.Highlight))
+        painter.drawLines([PySide6.QtCore.QLineF(x, mid - r * mid, x, mid + r * mid)
+                           for x, r in enumerate(rms.tolist())])
+
+    def wheelEvent(self, event):
+        fpp = self._frames_per_pixel()
+        steps = event.angleDelta().y() / 120
+        if event.modifiers() & PySide6.QtCore.Qt.ControlModifier:
+            # keep the frame under the mouse where it is
+            x = event.position().x()
+            anchor = self.start + x * fpp
+            fpp = max(1.0, fpp * 0.5 ** steps)
+            self.frames_per_pixel = fpp
+            self.start = int(anchor - x * fpp)
+        else:
+            self.start -= int(steps * fpp * self.width() / 10)
+        self.start = max(0, min(self.start, self.track.frameCount() - 1))
+        self.update()
+        event.accept()
+
+
 class ImeTrackMixer(PySide6.QtWidgets.QWidget):
+    # The channel strip of a track in the mixer view, for now the name over
+    # the level meter. update_meter is called by the view's meter timer.
+
     def __init__(self, parent, track):
         super().__init__(parent)
+        self.track = track
+        layout = PySide6.QtWidgets.QVBoxLayout(self)
+        layout.setContentsMargins(2, 2, 2, 2)
+        self.name = PySide6.QtWidgets.QLabel(track.name)
+        self.name.setAlignment(PySide6.QtCore.Qt.AlignCenter)
+        track.name_changed_signal.connect(self.name.setText)
+        layout.addWidget(self.name)
+        self.meter = ImeMeter.ImeMeterWidget(self, track.meter)
+        layout.addWidget(self.meter, alignment=PySide6.QtCore.Qt.AlignHCenter)
+
+    def update_meter(self):
+        self.meter.update()
 
 
 class ImeTrackCollection(PySide6.QtCore.QObject):
@@ -112,9 +247,19 @@ class ImeTrackCollection(PySide6.QtCore.QObject):
 
     # This is a list-like container that emits a signal when the list changes.
 
-    def __init__(self, initial_tracks: typing.Iterable[typing.Any] = ()):
+    def __init__(self, initial_tracks: typing.Iterable[typing.Any] = (), precision: str = ImeWave.PRECISION_FLOAT32,
+                 cache: typing.Optional[typing.Any] = None, framerate: int = 44100):
         super().__init__()
         self._tracks: typing.List[typing.Any] = list(initial_tracks)
+        # project wide sample precision policy for the waves in these tracks
+        # newrel: move this to the project data structure when we have one
+        self.precision = precision
+        # ImeWaveCache of decoded waves, None opens the files directly
+        self.cache = cache
+        # project frame rate, waves are resampled to it when they are opened
+        self.framerate = framerate
+        # level of the master bus, fed by the mix engine of the player
+        self.meter = ImeMeter.ImeMeter()
 
     def __len__(self) -> int:
         """Returns the number of elements in the list."""
@@ -0,0 +1,257 @@
+#!python3
+r""" ImeWavFile.py
+
+    ImeWavFile parses RIFF/WAVE files without the stdlib wave module.
+
+    The wave module only understands integer PCM and it reads the whole data
+    chunk into a bytes object before we ever see it. This module walks the
+    chunks itself, remembers where the sample data lives and decodes it in
+    blocks straight from the file into the caller's numpy array.
+
+    Supported sample formats
+        Integer PCM                 8, 16, 24, 32 bits
+        Floating Point PCM          32, 64 bits
+        WAVE_FORMAT_EXTENSIBLE      with either of the above as SubFormat
+
+    Reaper does not follow the specification for some of the formats it
+    writes. Float files come with a 16 byte fmt chunk, so there is neither the
+    "Extension Size" field nor a "fact" chunk. Neither is needed to decode the
+    data, so we accept fmt chunks of 16, 18 and 40 bytes and ignore "fact".
+
+    References
+        https://wavefilegem.com/how_wave_files_work.html
+        http://www-mmsp.ece.mcgill.ca/Documents/AudioFormats/WAVE/WAVE.html
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import os
+import struct
+
+import numpy
+
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Frames decoded per file read. Large enough to amortize the python overhead
+# of the loop, small enough that the scratch buffers stay in cache.
+BLOCK_FRAMES = 1 << 16
+
+# numpy dtype of one stored sample, keyed by (format tag, bits per sample).
+# 24 bit samples have no numpy dtype and are assembled by _decode_24.
+_storage_dtypes = {
+    (WAVE_FORMAT_PCM, 8): numpy.dtype(numpy.uint8),
+    (WAVE_FORMAT_PCM, 16): numpy.dtype('<i2'),
+    (WAVE_FORMAT_PCM, 24): None,
+    (WAVE_FORMAT_PCM, 32): numpy.dtype('<i4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): numpy.dtype('<f4'),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): numpy.dtype('<f8'),
+}
+
+
+class ImeWavFile:
+    """The header of a WAV file and the location of its sample data."""
+
+    def __init__(self, filename):
+        """Parses the chunks of filename.
+
+        Only the headers are read, the sample data is left on disk.
+
+        filename: path of the wav file
+        """
+        self.filename = filename
+        self.format_tag = None
+        self.nchannels = None
+        self.framerate = None
+        self.bits = None        # container size of one sample
+        self.valid_bits = None  # meaningful bits, only differs for EXTENSIBLE
+        self.block_align = None
+        self.data_offset = None
+        self.data_size = None
+        with open(filename, 'rb') as f:
+            self._parse(f, os.fstat(f.fileno()).st_size)
+
+    def __repr__(self):
+        return (f"ImeWavFile({self.filename!r}, format_tag={self.format_tag}, "
+                f"nchannels={self.nchannels}, framerate={self.framerate}, "
+                f"bits={self.bits}, nframes={self.nframes})")
+
+    def _parse(self, f, file_size):
+        riff = f.read(12)
+        if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            raise ValueError(f"{self.filename} is not a RIFF/WAVE file")
+
+        offset = 12
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+            offset += 8
+            if chunk_id == b'fmt ':
+                self._parse_fmt(f.read(chunk_size))
+            elif chunk_id == b'data':
+                # Writers that stream to disk may leave the size at 0 or
+                # 0xFFFFFFFF, and a crashed recording can be truncated, so
+                # never trust the size beyond the end of the file.
+                if chunk_size in (0, 0xFFFFFFFF) or offset + chunk_size > file_size:
+                    chunk_size = file_size - offset
+                self.data_offset = offset
+                self.data_size = chunk_size
+                if self.format_tag is not None:
+                    # everything we need comes before the data
+                    break
+            # chunks are word aligned, odd sizes have a pad byte
+            offset += chunk_size + (chunk_size & 1)
+
+        if self.format_tag is None:
+            raise ValueError(f"{self.filename} has no fmt chunk")
+        if self.data_offset is None:
+            raise ValueError(f"{self.filename} has no data chunk")
+        # drop a trailing partial frame
+        self.data_size -= self.data_size % self.block_align
+
+    def _parse_fmt(self, chunk):
+        if len(chunk) < 16:
+            raise ValueError(f"{self.filename} fmt chunk is too short ({len(chunk)} bytes)")
+        (format_tag, self.nchannels, self.framerate, _byte_rate,
+         self.block_align, self.bits) = struct.unpack('<HHIIHH', chunk[:16])
+        self.valid_bits = self.bits
+
+        if format_tag == WAVE_FORMAT_EXTENSIBLE:
+            # cbSize(2) validBits(2) channelMask(4) SubFormat GUID(16), the
+            # first two bytes of the GUID are the real format tag
+            if len(chunk) < 40:
+                raise ValueError(f"{self.filename} EXTENSIBLE fmt chunk is too short ({len(chunk)} bytes)")
+            self.valid_bits = struct.unpack('<H', chunk[18:20])[0] or self.bits
+            format_tag = struct.unpack('<H', chunk[24:26])[0]
+        self.format_tag = format_tag
+
+        if (format_tag, self.bits) not in _storage_dtypes:
+            raise ValueError(f"{self.filename} unsupported {format_tag=} with {self.bits} bits per sample")
+        if self.nchannels < 1 or self.block_align != self.nchannels * self.bits // 8:
+            raise ValueError(f"{self.filename} inconsistent {self.nchannels=} {self.block_align=} {self.bits=}")
+
+    @property
+    def nframes(self):
+        return self.data_size // self.block_align
+
+    @property
+    def sampwidth(self):
+        """Bytes per sample, as reported by the wave module."""
+        return self.bits // 8
+
+    @property
+    def is_float(self):
+        return self.format_tag == WAVE_FORMAT_IEEE_FLOAT
+
+    @property
+    def storage_dtype(self):
+        """numpy dtype of one stored sample, None for 24 bit."""
+        return _storage_dtypes[(self.format_tag, self.bits)]
+
+    def read(self, dtype=numpy.float64, start=0, nframes=None, out=None, planar=False):
+        """Decodes frames into a float array scaled to [-1.0, 1.0).
+
+        The file is read block by block into a reusable scratch buffer and
+        each block is converted directly into its slice of the result, so
+        the peak memory is the result plus one block. With planar the
+        conversion also deinterleaves, in the same pass.
+
+        dtype: float dtype of the result
+        start: first frame to read
+        nframes: number of frames, default is to the end of the data
+        out: optional array of the result's shape to decode into
+        planar: boolean, return (nchannels, nframes) instead
+
+        returns: array of shape (nframes, nchannels)
+        """
+        start = min(max(0, start), self.nframes)
+        if nframes is None:
+            nframes = self.nframes - start
+        nframes = min(nframes, self.nframes - start)
+        if out is None:
+            shape = (self.nchannels, nframes) if planar else (nframes, self.nchannels)
+            out = numpy.empty(shape, dtype=dtype)
+        # decode writes frames by channels, a transposed view deinterleaves
+        frames = out.T if planar else out
+
+        block_frames = min(BLOCK_FRAMES, nframes)
+        scratch = bytearray(block_frames * self.block_align)
+        with open(self.filename, 'rb') as f:
+            f.seek(self.data_offset + start * self.block_align)
+            i = 0
+            while i < nframes:
+                n = min(block_frames, nframes - i)
+                view = memoryview(scratch)[:n * self.block_align]
+                got = f.readinto(view)
+                if got != len(view):
+                    raise ValueError(f"{self.filename} data chunk ends early at frame {start + i + got // self.block_align}")
+                raw = numpy.frombuffer(scratch, dtype=numpy.uint8, count=len(view))
+                self.decode(raw, frames[i:i + n])
+                i += n
+        return out
+
+    def read_raw(self):
+        """Reads the data chunk without decoding it.
+
+        The bytes go straight from the file into the returned array.
+
+        returns: uint8 array of shape (nframes, block_align)
+        """
+        with open(self.filename, 'rb') as f:
+            f.seek(self.data_offset)
+            raw = numpy.fromfile(f, dtype=numpy.uint8, count=self.data_size)
+        if len(raw) != self.data_size:
+            raise ValueError(f"{self.filename} data chunk ends early at frame {len(raw) // self.block_align}")
+        return raw.reshape(self.nframes, self.block_align)
+
+    def memmap(self):
+        """Maps the data chunk into memory without reading it.
+
+        Nothing is read from disk until the returned array is indexed, and
+        then only the pages that back the indexed frames.
+
+        returns: read-only uint8 array of shape (nframes, block_align)
+        """
+        if self.nframes == 0:
+            # mmap refuses to map an empty range
+            return numpy.zeros((0, self.block_align), dtype=numpy.uint8)
+        return numpy.memmap(self.filename, dtype=numpy.uint8, mode='r',
+                            offset=self.data_offset, shape=(self.nframes, self.block_align))
+
+    def decode(self, raw, out, channels=slice(None)):
+        """Converts stored samples to floats scaled to [-1.0, 1.0).
+
+        out may be any strided view, e.g. the transpose of a planar
+        (channels, frames) array, which deinterleaves while converting.
+
+        raw: uint8 array of whole frames exactly as stored in the data chunk
+        out: float array of shape (frames, selected channels) to write to
+        channels: slice selecting the channels to decode
+        """
+        dtype = self.storage_dtype
+        if dtype is None:
+            _decode_24(raw.reshape(-1, self.nchannels, 3)[:, channels], out)
+            return
+        samples = raw.view(dtype).reshape(-1, self.nchannels)[:, channels]
+        if self.is_float:
+            out[...] = samples
+        elif dtype == numpy.uint8:
+            # 8 bit PCM is the only unsigned format
+            numpy.subtract(samples, 128.0, out=out, casting='unsafe')
+            out *= 1.0 / 128
+        else:
+            numpy.multiply(samples, 1.0 / (1 << (self.bits - 1)), out=out, casting='unsafe')
+
+
+def _decode_24(raw, out):
+    """Converts packed little endian 24 bit samples to floats.
+
+    raw: uint8 array of shape (frames, nchannels, 3)
+    out: float array of shape (frames, nchannels)
+    """
+    # Place the three bytes in the top of an int32 so the sign comes along for
+    # free, the extra factor of 256 is folded into the scale below.
+    wide = numpy.zeros(raw.shape[:-1] + (4,), dtype=numpy.uint8)
+    wide[..., 1:] = raw
+    numpy.multiply(wide.view('<i4')[..., 0], 1.0 / (1 << 31), out=out, casting='unsafe')
@@ -0,0 +1,194 @@
+#!python3
+r""" ImeWavWriter.py
+
+    ImeWavWriter encodes float blocks to a WAV file as they arrive.
+
+    The header is written with placeholder sizes when the file is opened and
+    patched when it is closed, so a render never has to hold more than the
+    block being encoded. Until then the data size is 0, which ImeWavFile
+    reads as "to the end of the file", so a file still being written can be
+    opened and mapped, e.g. a recording. The formats are the ones found in
+    reaper/ and read by ImeWavFile
+        Integer PCM                 8, 16, 24, 32 bits
+        Floating Point PCM          32, 64 bits
+    More than two channels are written as WAVE_FORMAT_EXTENSIBLE.
+
+    When the output has fewer bits than the float input, TPDF dither can be
+    added before rounding: the sum of two independent uniform random values
+    of one LSB each, which decorrelates the quantization error from the
+    signal.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import struct
+
+import numpy
+
+import ImeWavFile
+
+
+# RIFF sizes are 32 bits
+MAX_DATA_SIZE = 0xFFFFFFFF - 36
+
+_integer_dtypes = {8: numpy.uint8, 16: numpy.dtype('<i2'), 24: numpy.dtype('<i4'), 32: numpy.dtype('<i4')}
+_float_dtypes = {32: numpy.dtype('<f4'), 64: numpy.dtype('<f8')}
+
+# KSDATAFORMAT_SUBTYPE_PCM / _IEEE_FLOAT without their first two bytes
+_guid_tail = b'\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+
+class ImeWavWriter:
+    """Writes a WAV file incrementally from blocks of float samples."""
+
+    def __init__(self, filename, framerate, nchannels=1, bits=16, is_float=False, dither=False, seed=None):
+        """Creates the file and writes a header with placeholder sizes.
+
+        filename: path of the wav file to create
+        framerate: samples per second
+        nchannels: number of channels
+        bits: bits per sample, 8, 16, 24 or 32 for integer, 32 or 64 for float
+        is_float: boolean, write floating point PCM
+        dither: boolean, add TPDF dither when writing integer samples
+        seed: seed for the dither noise, for reproducible renders
+        """
+        if is_float and bits not in _float_dtypes:
+            raise ValueError(f"{bits=} unsupported for floating point PCM")
+        if not is_float and bits not in _integer_dtypes:
+            raise ValueError(f"{bits=} unsupported for integer PCM")
+        self.filename = filename
+        self.framerate = framerate
+        self.nchannels = nchannels
+        self.bits = bits
+        self.is_float = is_float
+        self.dither = dither and not is_float
+        self.block_align = nchannels * bits // 8
+        self.nframes = 0
+        self._rng = numpy.random.default_rng(seed)
+        self._file = open(filename, 'wb')
+        self._write_header()
+
+    def __repr__(self):
+        return (f"ImeWavWriter({self.filename!r}, framerate={self.framerate}, "
+                f"nchannels={self.nchannels}, bits={self.bits}, is_float={self.is_float})")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def format_tag(self):
+        return ImeWavFile.WAVE_FORMAT_IEEE_FLOAT if self.is_float else ImeWavFile.WAVE_FORMAT_PCM
+
+    def _write_header(self):
+        # The fmt chunk matches what the spec asks for: 16 bytes for integer
+        # PCM, 18 bytes and a fact chunk for float, EXTENSIBLE above stereo.
+        byte_rate = self.framerate * self.block_align
+        fmt = struct.pack('<HHIIHH', self.format_tag, self.nchannels, self.framerate,
+                          byte_rate, self.block_align, self.bits)
+        if self.nchannels > 2:
+            fmt = struct.pack('<HHIIHH', ImeWavFile.WAVE_FORMAT_EXTENSIBLE, self.nchannels,
+                              self.framerate, byte_rate, self.block_align, self.bits)
+            fmt += struct.pack('<HHI', 22, self.bits, 0) + struct.pack('<H', self.format_tag) + _guid_tail
+        elif self.is_float:
+            fmt += struct.pack('<H', 0)
+
+        header = b'RIFF' + struct.pack('<I', 0) + b'WAVE'
+        header += b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+        self._fact_offset = None
+        if self.is_float:
+            self._fact_offset = len(header) + 8
+            header += b'fact' + struct.pack('<II', 4, 0)
+        header += b'data' + struct.pack('<I', 0)
+        self._data_offset = len(header)
+        self._file.write(header)
+
+    def encode(self, block):
+        """Converts float samples to the stored format.
+
+        block: float array of shape (frames,) or (frames, nchannels)
+
+        returns: array whose bytes are the frames as stored in the data chunk
+        """
+        block = numpy.asarray(block)
+        if block.ndim == 1:
+            block = block.reshape(-1, 1)
+        if block.shape[1] != self.nchannels:
+            raise ValueError(f"block has {block.shape[1]} channels, expected {self.nchannels}")
+
+        if self.is_float:
+            return block.astype(_float_dtypes[self.bits], order='C')
+
+        full_scale = float(1 << (self.bits - 1))
+        # order='C' interleaves a transposed planar block in the same pass
+        zs = numpy.multiply(block, full_scale, order='C')
+        if self.dither:
+            zs += self._rng.random(zs.shape)
+            zs -= self._rng.random(zs.shape)
+        numpy.rint(zs, out=zs)
+        numpy.clip(zs, -full_scale, full_scale - 1, out=zs)
+        if self.bits == 8:
+            zs += 128
+        zs = zs.astype(_integer_dtypes[self.bits])
+        if self.bits == 24:
+            # keep the low three bytes of each little endian int32
+            zs = zs.view(numpy.uint8).reshape(zs.shape + (4,))[..., :3]
+        return zs
+
+    def write(self, block):
+        """Encodes and appends one block of frames.
+
+        block: float array of shape (frames,) or (frames, nchannels)
+        """
+        data = numpy.ascontiguousarray(self.encode(block))
+        if self._file.tell() - self._data_offset + data.nbytes > MAX_DATA_SIZE:
+            raise ValueError(f"{self.filename} would exceed the 4 GiB RIFF limit")
+        self._file.write(data.data)
+        self.nframes += len(data)
+
+    def write_encoded(self, frames):
+        """Appends frames that are already in the stored format, e.g.
+        samples captured from a device in the format of the file.
+
+        frames: array of shape (frames, nchannels) of the storage dtype, or
+                uint8 of shape (frames, block_align)
+        """
+        data = numpy.ascontiguousarray(frames)
+        if data.nbytes != len(data) * self.block_align:
+            raise ValueError(f"frames of {data.nbytes // max(1, len(data))} bytes, expected {self.block_align}")
+        if self._file.tell() - self._data_offset + data.nbytes > MAX_DATA_SIZE:
+            raise ValueError(f"{self.filename} would exceed the 4 GiB RIFF limit")
+        self._file.write(data.data)
+        self.nframes += len(data)
+
+    def flush(self):
+        """Pushes the frames written so far to the file, so a reader that
+        maps it, see ImeWave.grow, can see them."""
+        self._file.flush()
+
+    def write_blocks(self, blocks):
+        """Encodes and appends every block from an iterable or generator.
+
+        blocks: iterable of float arrays, see write
+        """
+        for block in blocks:
+            self.write(block)
+
+    def close(self):
+        """Pads the data chunk and patches the sizes in the header."""
+        if self._file is None:
+            return
+        data_size = self.nframes * self.block_align
+        if data_size & 1:
+            self._file.write(b'\x00')
+        riff_size = self._file.tell() - 8
+        self._file.seek(4)
+        self._file.write(struct.pack('<I', riff_size))
+        if self._fact_offset is not None:
+            self._file.seek(self._fact_offset)
+            self._file.write(struct.pack('<I', self.nframes))
+        self._file.seek(self._data_offset - 4)
+        self._file.write(struct.pack('<I', data_size))
+        self._file.close()
+        self._file = None
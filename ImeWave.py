@@ -4,42 +4,14 @@ r""" ImeWave.py
     The ImeWave is the internal representation of wave data,
     suitable for DSP operations.
 
-    newrel: not all wave files are openable using the wave module.
-            We need to be able to open all wav formats, and we would like to
-            also support making wav data from with mp3 or m4a and possibly
-            other formats. In each case we want to convert to a NumPy array
-            This traceback shows where the problem is in the wave module:
-                Traceback (most recent call last):
-                  File "D:\_code\pymusic\actions\file_open.py", line 39, in file_open_dialog
-                    new_track.add_wav(filename)
-                  File "D:\_code\pymusic\ImeTrack.py", line 45, in add_wav
-                    with wave.open(filename, 'rb') as f:
-                         ^^^^^^^^^^^^^^^^^^^^^^^^^
-                  File "C:\Python312\Lib\wave.py", line 649, in open
-                    return Wave_read(f)
-                           ^^^^^^^^^^^^
-                  File "C:\Python312\Lib\wave.py", line 286, in __init__
-                    self.initfp(f)
-                  File "C:\Python312\Lib\wave.py", line 266, in initfp
-                    self._read_fmt_chunk(chunk)
-                  File "C:\Python312\Lib\wave.py", line 383, in _read_fmt_chunk
-                    raise Error('unknown format: %r' % (wFormatTag,))
-                wave.Error: unknown format: 3
-            We might want to implement the wave file parsing ourselves so we
-            can cover these formats without needing to install other software
-            or codecs.
-                Integer PCM Data Chunk
-                    8
-                    16
-                    24
-                    32
-                Floating Point PCM Data Chunk
-                    32
-                    64
-            Note that Reaper does not seem to be following the specification
-            when it generates some WAV formats. For example it left out the
-            "fact" and it looks like it left out "Extension Size" which should
-            have been present and set to zero for type 3, the FP PCM
+    WAV files are parsed by ImeWavFile rather than the stdlib wave module,
+    which fails on floating point PCM ("wave.Error: unknown format: 3") and
+    on WAVE_FORMAT_EXTENSIBLE headers. See ImeWavFile for the list of formats
+    and for the ways Reaper deviates from the specification.
+
+    newrel: we would like to also support making wav data from mp3 or m4a
+            and possibly other formats. In each case we want to convert to a
+            NumPy array.
 
     This object was based on the Wave class published in
         https://github.com/AllenDowney/ThinkDSP/blob/master/code/thinkdsp.py
@@ -50,96 +22,403 @@ r""" ImeWave.py
     Copyright (c) 2024 Chip Ueltschey All rights reserved.
 """
 import copy
-import wave
+import warnings
 
 import numpy
 
+import ImeConvolver
+import ImeLazyWave
+import ImeResampler
+import ImeSpectrogram
+import ImeWavFile
+import ImeWavWriter
 
-class ImeWave:
-    """Represents a discrete-time waveform."""
 
-    def __init__(self, ys, ts=None, framerate=11025, nchannels=1, nframes=0, sampwidth=None):
+# Sample precision policies, see ImeWave.precision
+PRECISION_FLOAT64 = 'float64'   # decode to float64
+PRECISION_FLOAT32 = 'float32'   # decode to float32, half the memory of float64
+PRECISION_NATIVE = 'native'     # keep the samples as stored in the file and
+                                # decode to float32 a block at a time
+
+_working_dtypes = {
+    PRECISION_FLOAT64: numpy.dtype(numpy.float64),
+    PRECISION_FLOAT32: numpy.dtype(numpy.float32),
+    PRECISION_NATIVE: numpy.dtype(numpy.float32),
+}
+
+
+class _Shared:
+    # The number of waves whose ys are views of one buffer, see ImeWave._own.
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 1
+
+
+def _read_only(ys):
+    # a view of ys that cannot be written through, ys itself is untouched
+    view = ys.view()
+    view.flags.writeable = False
+    return view
+
+
+class ImeWave:
+    """Represents a discrete-time waveform.
+
+    A mono wave has a 1-D ys. A wave with more channels has a planar ys of
+    shape (nchannels, frames), frames are always indexed on the last axis and
+    the DSP methods broadcast over the channels.
+
+    copy, slice, segment and channel share ys with the original wave
+    instead of copying it. The shared ys are read-only views, and a method
+    that modifies ys in place, e.g. scale, window or normalize, first
+    copies it for the wave it was called on, see _own. Only the wave that
+    is edited pays for its samples, and only when it is edited, so a
+    duplicated track or a region taken for editing costs no memory until
+    then. Assigning ys, as roll, apodize or unbias do, replaces the view.
+    Code that writes into ys directly should call _own first.
+    """
+
+    # The default precision policy, projects and individual waves can
+    # override it. It decides the dtype of ys and of the blocks returned by
+    # get_frames. Under PRECISION_NATIVE the samples stay encoded, scale and
+    # normalize only change gain, and anything that needs the whole signal
+    # as floats decodes it at that point.
+    precision = PRECISION_FLOAT64
+
+    def __init__(self, ys, ts=None, framerate=11025, nchannels=1, nframes=0, sampwidth=None, start=0.0, precision=None):
         """Initializes the wave.
 
-        ys: wave array
-        ts: array of times
+        Time is not stored per sample. The frame at index i is at time
+        start + i / framerate, the ts property computes that on demand.
+
+        ys: wave array, 1-D for mono or (nchannels, frames)
+        ts: array of times, only its first element is used
         framerate: samples per second
+        start: float time of the first frame in seconds
+        precision: one of the PRECISION_ policies, default is ImeWave.precision
         """
-        self.ys = numpy.asanyarray(ys)
+        self._ys = None if ys is None else numpy.asanyarray(ys)
         self.framerate = framerate
 
-        if ts is None:
-            self.ts = numpy.arange(len(ys)) / self.framerate
-        else:
-            self.ts = numpy.asanyarray(ts)
+        if precision is not None:
+            if precision not in _working_dtypes:
+                raise ValueError(f"{precision=} unknown")
+            self.precision = precision
 
-        self.nchannels = nchannels
+        # A wave made by from_file(mmap=True) or with PRECISION_NATIVE has no
+        # ys of its own, frames are decoded from the data chunk as stored in
+        # the file when they are asked for and then multiplied by gain.
+        # See get_frames and the ys property.
+        self._source = None     # ImeWavFile describing the encoded data
+        self._raw = None        # uint8 array or memmap (nframes, block_align)
+        self._channels = slice(None)    # the channels of _raw this wave uses
+        self.gain = 1.0
+        self._shared = None     # _Shared while ys is a view other waves share
+
+        self._start = start if ts is None or len(ts) == 0 else float(ts[0])
+
+        self.nchannels = nchannels if self._ys is None or self._ys.ndim == 1 else len(self._ys)
         self.nframes = nframes # should be the same as len(ys)...should we assert that?
         self.sampwidth = sampwidth # in bits - can we get this from inspecting ys?
 
     @classmethod
-    def from_file(cls, filename):
-        # bugbug: this is slow for large files, and files are expected to be
-        #         large, so we need to either use some multithreading here or
-        #         defer this work. We could consider doing the file read later.
-
-        with wave.open(filename, 'rb') as f:
-            nchannels = f.getnchannels()
-            nframes = f.getnframes()
-            sampwidth = f.getsampwidth()
-            framerate = f.getframerate()
-            z_str = f.readframes(nframes)
-        print(f"{nchannels=}, {nframes=}, {sampwidth=}, {framerate=}")
-
-        dtype_map = {1: numpy.int8, 2: numpy.int16, 3: "special", 4: numpy.int32}
-        if sampwidth not in dtype_map:
-            raise ValueError(f"{sampwidth=} unknown")
-        if sampwidth == 3:
-            xs = numpy.fromstring(z_str, dtype=numpy.int8).astype(numpy.int32)
-            ys = (xs[2::3] * 256 + xs[1::3]) * 256 + xs[0::3]
+    def zeros(cls, nframes, nchannels=1, framerate=11025, start=0.0, precision=None):
+        """Makes a silent wave, e.g. a bus that clips are added into with +=.
+
+        nframes: number of frames
+        nchannels: number of channels, 1 makes a 1-D ys
+        framerate: frames per second
+        start: float time of the first frame in seconds
+        precision: one of the PRECISION_ policies, default is ImeWave.precision
+
+        returns: new ImeWave
+        """
+        dtype = _working_dtypes[precision or cls.precision]
+        shape = (nframes,) if nchannels == 1 else (nchannels, nframes)
+        return cls(numpy.zeros(shape, dtype=dtype), framerate=framerate, start=start, precision=precision)
+
+    @classmethod
+    def from_file(cls, filename, mmap=False, precision=None, cache=None, framerate=None):
+        """Reads a wav file.
+
+        Loading never normalizes, whatever the mode. Every mode returns the
+        samples at the level they are stored at, integer PCM scaled so full
+        scale is 1.0, so a file plays and renders the same however it was
+        opened. A mapped wave could not be normalized without reading the
+        whole file. Call normalize to change the level.
+
+        With mmap the data chunk is memory mapped instead of read, which makes
+        opening O(1) in the size of the file. Frames are decoded when they are
+        accessed, so only the pages that get played or drawn are ever
+        resident.
+
+        With a cache the decoded wave is served from an ImeWaveCache, memory
+        mapped, and decoded into it first on a miss. PRECISION_NATIVE waves
+        are already served from the file itself and do not use the cache.
+
+        With a framerate that differs from the file's, the wave is resampled
+        to it, which decodes it. Through a cache the conversion is done once
+        and kept with the decoded copy.
+
+        filename: path of the wav file
+        mmap: boolean, map the file rather than reading it
+        precision: one of the PRECISION_ policies, default is ImeWave.precision
+        cache: optional ImeWaveCache
+        framerate: optional frames per second the wave must have
+
+        returns: new ImeWave
+        """
+        if cache is not None and (precision or cls.precision) != PRECISION_NATIVE:
+            return cache.open(filename, precision, framerate)
+
+        info = ImeWavFile.ImeWavFile(filename)
+        if framerate and framerate != info.framerate:
+            return cls.from_file(filename, mmap=mmap, precision=precision).resample(framerate)
+
+        if mmap or precision == PRECISION_NATIVE or (precision is None and cls.precision == PRECISION_NATIVE):
+            w = cls(None, framerate=info.framerate, nchannels=info.nchannels, nframes=info.nframes, sampwidth=info.bits, precision=precision)
+            w._source = info
+            if mmap:
+                w._raw = info.memmap()
+                return w
+            w._raw = info.read_raw()
+            return w
+
+        # This is slow for large files, the GUI opens files with mmap or
+        # through ImeFileLoader so it never waits on this read.
+        precision = precision or cls.precision
+        ys = info.read(dtype=_working_dtypes[precision], planar=True)
+        if info.nchannels == 1:
+            ys = ys[0]
+
+        return cls(ys, framerate=info.framerate, nframes=info.nframes, sampwidth=info.bits, precision=precision)
+
+    @property
+    def working_dtype(self):
+        """The float dtype that the precision policy decodes to."""
+        return _working_dtypes[self.precision]
+
+    @property
+    def ys(self):
+        """The signal as a float array.
+
+        For an encoded wave this decodes the whole signal and drops the
+        encoded data, so DSP methods that need every sample keep working.
+        Playback and drawing should use get_frames instead.
+        """
+        if self._ys is None and self._raw is not None:
+            self._ys = self.get_frames(0, len(self))
+            self._source = None
+            self._raw = None
+            self.gain = 1.0
+        return self._ys
+
+    @ys.setter
+    def ys(self, ys):
+        ys = numpy.asanyarray(ys)
+        # a view of the shared buffer, e.g. from truncate, stays shared
+        if self._shared is not None and not numpy.may_share_memory(ys, self._ys):
+            self._release()
+        self._ys = ys
+        self._source = None
+        self._raw = None
+        self.gain = 1.0
+
+    @property
+    def ts(self):
+        """Array of times, computed from start and framerate on each use."""
+        return self._start + numpy.arange(len(self)) / self.framerate
+
+    @property
+    def is_encoded(self):
+        """True while the frames are still decoded from the file's data."""
+        return self._raw is not None
+
+    @property
+    def is_mapped(self):
+        """True while the frames are still decoded from the mapped file."""
+        return isinstance(self._raw, numpy.memmap)
+
+    def get_frames(self, start, end, dtype=None, out=None):
+        """Returns the frames in [start, end).
+
+        An encoded wave decodes only the requested frames, so for a mapped
+        wave only the pages of the file backing them are touched. Otherwise
+        this is a view of ys.
+
+        start: first frame index
+        end: frame index one past the last frame
+        dtype: float dtype used when decoding, default is working_dtype
+        out: optional float array of shape (nchannels or more, end - start or
+             more) an encoded wave decodes into instead of a new array
+
+        returns: NumPy array
+        """
+        if self._raw is None:
+            return self._ys[..., start:end]
+        raw = self._raw[start:end]
+        if out is None:
+            out = numpy.empty((self.nchannels, len(raw)), dtype=dtype or self.working_dtype)
         else:
-            ys = numpy.fromstring(z_str, dtype=dtype_map[sampwidth])
+            out = out[:self.nchannels, :len(raw)]
+        self._source.decode(raw, out.T, self._channels)
+        if self.gain != 1.0:
+            out *= self.gain
+        return out[0] if self.nchannels == 1 else out
 
-        # If stereo...
-        # bugbug: maybe mix it down? Or allow stereo signals?
-        #         for now we force nchannels to 1 in the constructor below.
-        #         We could either provice the stereo data, which will require
-        #         a review of all functions to handle stereo or we can mix it
-        #         down to mono, in which case we could possibly drop the
-        #         nchannels from this __init__
-        if nchannels == 2:
-            ys = ys[::2]
+    def grow(self, nframes):
+        """Maps the frames of a wav file that is still being written.
 
-        w = cls(ys, framerate=framerate, nchannels=1, nframes=nframes, sampwidth=sampwidth)
+        For a wave made by from_file(mmap=True) on a file that an
+        ImeWavWriter is appending to, e.g. a recording. The frames must be
+        flushed to the file already. Readers on other threads see either the
+        old or the new mapping, never a mix.
 
-        # bugbug: do we really want to automatically normalize?
-        #         Remove this comment if the answer is yes.
-        #         Remove the following line of code if the answer is no.
-        w.normalize()
+        nframes: number of frames in the file now
+        """
+        if self._source is None or self._ys is not None:
+            raise ValueError(f"{self.__class__.__name__} is not mapped from a file")
+        self._source.data_size = nframes * self._source.block_align
+        self._raw = self._source.memmap()
+        self.nframes = nframes
 
+    def channel(self, i):
+        """Returns one channel as a mono wave.
+
+        The new wave shares its samples with this one, nothing is copied.
+
+        i: channel index
+
+        returns: new ImeWave
+        """
+        if not 0 <= i < self.nchannels:
+            raise ValueError(f"{i=} out of range for {self.nchannels} channels")
+        if self._raw is not None:
+            w = self.__class__(None, framerate=self.framerate, nchannels=1, nframes=self.nframes,
+                               sampwidth=self.sampwidth, start=self.start, precision=self.precision)
+            w._source = self._source
+            w._raw = self._raw
+            first = self._channels.indices(self._source.nchannels)[0] + i
+            w._channels = slice(first, first + 1)
+            w.gain = self.gain
+            return w
+        ys = self._ys if self._ys.ndim == 1 else self._ys[i]
+        w = self.__class__(None, framerate=self.framerate, sampwidth=self.sampwidth,
+                           start=self.start, precision=self.precision)
+        self._share_ys(w, ys)
         return w
 
+    def iter_blocks(self, block_size=ImeWavFile.BLOCK_FRAMES, hop=None):
+        """Generates the frames a block at a time.
+
+        Blocks come from get_frames, so an encoded wave decodes one block at
+        a time and a decoded wave yields views of ys. The last block may be
+        short. See ImePipeline for processing the blocks as a stream.
+
+        block_size: frames per block
+        hop: frames between the starts of blocks, default is block_size
+
+        returns: generator of NumPy arrays, 1-D or (nchannels, frames)
+        """
+        hop = hop or block_size
+        for i in range(0, len(self), hop):
+            yield self.get_frames(i, i + block_size)
+
+    def _peak(self):
+        """Returns the largest absolute sample value."""
+        if self._raw is None:
+            if len(self._ys) == 0:
+                return 0.0
+            return max(abs(numpy.max(self._ys)), abs(numpy.min(self._ys)))
+        # decode a block at a time so the whole signal is never in memory
+        peak = 0.0
+        for i in range(0, len(self), ImeWavFile.BLOCK_FRAMES):
+            ys = self.get_frames(i, i + ImeWavFile.BLOCK_FRAMES)
+            peak = max(peak, abs(numpy.max(ys)), abs(numpy.min(ys)))
+        return peak
+
     def totalSize(self):
-        print(f"ImeWave().totalSize() = {self.ys.nbytes}")
-        return self.ys.nbytes
+        nbytes = len(self) * self.nchannels * (self.working_dtype.itemsize if self._ys is None else self._ys.itemsize)
+        return nbytes
 
     def copy(self):
         """Makes a copy.
 
-        Returns: new Wave
+        The copy shares ys with this wave until one of them is modified, see
+        _own, so copying costs no memory up front. An encoded wave shares
+        its encoded data, which is never written.
+
+        Returns: new ImeWave
+        """
+        w = copy.copy(self)
+        w._shared = None
+        # grow changes the description of the data, the copy keeps its own
+        w._source = copy.copy(self._source)
+        if self._ys is not None:
+            self._share_ys(w, self._ys)
+        return w
+
+    def _share_ys(self, w, ys):
+        """Gives wave w a view of this wave's ys, copy-on-write.
+
+        w: ImeWave that does not share a buffer yet
+        ys: this wave's ys or a view of it
+        """
+        if self._shared is None:
+            self._shared = _Shared()
+            self._ys = _read_only(self._ys)
+        self._shared.count += 1
+        w._ys = _read_only(ys)
+        w._shared = self._shared
+        w.nchannels = 1 if w._ys.ndim == 1 else len(w._ys)
+
+    def _own(self):
+        """Makes ys writable before it is modified in place.
+
+        If other waves share ys, this wave gets a copy of it and the others
+        keep the buffer. The last wave that holds a shared buffer writes to
+        it without copying.
         """
-        return copy.deepcopy(self)
+        if self._shared is None:
+            return
+        if self._shared.count > 1:
+            self._release()
+            self._ys = self._ys.copy()
+            return
+        self._shared = None
+        try:
+            self._ys.flags.writeable = True
+        except ValueError:
+            # the buffer itself is read-only, e.g. mapped from ImeWaveCache
+            self._ys = self._ys.copy()
+
+    def _release(self):
+        """Stops sharing ys, the other waves are told there is one fewer."""
+        self._shared.count -= 1
+        self._shared = None
+
+    def __del__(self):
+        if getattr(self, '_shared', None) is not None:
+            self._release()
 
     def __len__(self):
-        return len(self.ys)
+        if self._ys is None and self._raw is not None:
+            return len(self._raw)
+        return self._ys.shape[-1]
 
     @property
     def start(self):
-        return self.ts[0]
+        return self._start
 
     @property
     def end(self):
-        return self.ts[-1]
+        return self._start + (len(self) - 1) / self.framerate
+
+    @property
+    def offset(self):
+        """The start time as a (possibly fractional) count of frames."""
+        return self._start * self.framerate
 
     @property
     def duration(self):
@@ -147,78 +426,204 @@ class ImeWave:
 
         returns: float duration in seconds
         """
-        return len(self.ys) / self.framerate
+        return len(self) / self.framerate
+
+    def _frame_shape(self):
+        """Returns the shape of ys without the frames axis."""
+        if self._ys is not None:
+            return self._ys.shape[:-1]
+        return () if self.nchannels == 1 else (self.nchannels,)
+
+    def _dtype(self):
+        """Returns the dtype of the frames get_frames returns."""
+        return self.working_dtype if self._ys is None else self._ys.dtype
+
+    def _share(self, start=None):
+        """Returns a new wave on the same samples, nothing is copied."""
+        w = self.__class__(None, framerate=self.framerate, nchannels=self.nchannels, nframes=self.nframes,
+                           sampwidth=self.sampwidth, start=self.start if start is None else start,
+                           precision=self.precision)
+        w._source = self._source
+        w._raw = self._raw
+        w._channels = self._channels
+        w.gain = self.gain
+        if self._ys is not None:
+            self._share_ys(w, self._ys)
+        return w
 
-    def __add__(self, other):
-        """Adds two waves elementwise.
+    def _frames_into(self, ys, lo, add=True):
+        """Adds or copies the frames of this wave into a buffer.
 
-        other: Wave
+        Only the frames that fall in the buffer are used. An encoded wave
+        is decoded a block at a time, never as a whole.
 
-        returns: new Wave
+        ys: array of shape (..., frames), its frame 0 is frame lo from time zero
+        lo: integer frame offset of ys
+        add: boolean, add to ys rather than overwrite it
         """
-        if other == 0:
-            return self
+        i = self._frame_offset() - lo
+        first = max(0, -i)
+        last = min(len(self), ys.shape[-1] - i)
+        step = len(self) if self._raw is None else ImeWavFile.BLOCK_FRAMES
+        for k in range(first, last, max(1, step)):
+            end = min(last, k + step)
+            out = ys[..., i + k:i + end]
+            if add:
+                out += self.get_frames(k, end)
+            else:
+                out[...] = self.get_frames(k, end)
 
-        assert self.framerate == other.framerate
+    def __add__(self, other):
+        """Adds two waves elementwise.
+
+        The waves are lined up on whole frames counted from time zero, the
+        result spans both. Each wave is copied or added into the result
+        once and only the frames neither covers are zeroed.
 
-        # make an array of times that covers both waves
-        start = min(self.start, other.start)
-        end = max(self.end, other.end)
-        n = int(round((end - start) * self.framerate)) + 1
-        ys = numpy.zeros(n)
-        ts = start + numpy.arange(n) / self.framerate
+        other: ImeWave, or 0 so that sum() works
 
-        def add_ys(wave):
-            i = find_index(wave.start, ts)
+        returns: new ImeWave
+        """
+        if not isinstance(other, ImeWave):
+            if other == 0:
+                return self
+            return NotImplemented
+        if self.framerate != other.framerate:
+            raise ValueError(f"cannot add waves at {self.framerate} and {other.framerate} frames per second")
+
+        i = self._frame_offset()
+        j = other._frame_offset()
+        lo = min(i, j)
+        hi = max(i + len(self), j + len(other))
+        shape = numpy.broadcast_shapes(self._frame_shape(), other._frame_shape()) + (hi - lo,)
+        ys = numpy.empty(shape, dtype=numpy.result_type(self._dtype(), other._dtype()))
+        # self is copied over its span, the rest starts out silent
+        ys[..., :i - lo] = 0
+        ys[..., i - lo + len(self):] = 0
+        self._frames_into(ys, lo, add=False)
+        other._frames_into(ys, lo)
+
+        return self.__class__(ys, framerate=self.framerate, start=lo / self.framerate)
 
-            # make sure the arrays line up reasonably well
-            diff = ts[i] - wave.start
-            dt = 1 / wave.framerate
-            if (diff / dt) > 0.1:
-                warnings.warn(
-                    "Can't add these waveforms; their " "time arrays don't line up."
-                )
+    __radd__ = __add__
 
-            j = i + len(wave)
-            ys[i:j] += wave.ys
+    def __iadd__(self, other):
+        """Adds another wave into this one in place.
 
-        add_ys(self)
-        add_ys(other)
+        When other lies within the frames of this wave and its channels fit,
+        its frames are accumulated into ys with no new array, e.g. clips
+        summed into a bus made by ImeWave.zeros. Otherwise this is the same
+        as self + other. An encoded wave is decoded first.
 
-        return Wave(ys, ts, self.framerate)
+        other: ImeWave
 
-    __radd__ = __add__
+        returns: this ImeWave, or a new one when it had to grow
+        """
+        if not isinstance(other, ImeWave):
+            if other == 0:
+                return self
+            return NotImplemented
+        if self.framerate != other.framerate:
+            raise ValueError(f"cannot add waves at {self.framerate} and {other.framerate} frames per second")
+
+        i = self._frame_offset()
+        j = other._frame_offset()
+        ys = self.ys
+        fits = (i <= j and j + len(other) <= i + len(self)
+                and numpy.broadcast_shapes(ys.shape[:-1], other._frame_shape()) == ys.shape[:-1]
+                and numpy.can_cast(other._dtype(), ys.dtype, 'same_kind'))
+        if fits:
+            self._own()
+        if not fits or not self._ys.flags.writeable:
+            return self + other
+        other._frames_into(self._ys, i)
+        return self
 
     def __or__(self, other):
         """Concatenates two waves.
 
-        other: Wave
+        The result starts at the start of self. When either wave is empty
+        the result shares the samples of the other one.
 
-        returns: new Wave
+        other: ImeWave
+
+        returns: new ImeWave
         """
         if self.framerate != other.framerate:
-            raise ValueError("Wave.__or__: framerates do not agree")
+            raise ValueError("ImeWave.__or__: framerates do not agree")
+        if len(other) == 0:
+            return self._share()
+        if len(self) == 0:
+            return other._share(start=self.start)
 
-        ys = numpy.concatenate((self.ys, other.ys))
-        # ts = numpy.arange(len(ys)) / self.framerate
-        return Wave(ys, framerate=self.framerate)
+        ys = numpy.concatenate((self.get_frames(0, len(self)), other.get_frames(0, len(other))), axis=-1)
+        return self.__class__(ys, framerate=self.framerate, start=self.start)
 
     def __mul__(self, other):
-        """Multiplies two waves elementwise.
+        """Multiplies two waves elementwise, or a wave by a number.
 
-        Note: this operation ignores the timestamps; the result
-        has the timestamps of self.
+        Waves are lined up on whole frames counted from time zero, the
+        result spans the frames they have in common, everywhere else the
+        product is silence. Multiplying an encoded wave by a number only
+        changes the gain of a new wave on the same samples.
 
-        other: Wave
+        other: ImeWave or number
 
-        returns: new Wave
+        returns: new ImeWave
         """
-        # the spectrums have to have the same framerate and duration
-        assert self.framerate == other.framerate
-        assert len(self) == len(other)
+        if not isinstance(other, ImeWave):
+            if self._raw is not None:
+                w = self._share()
+                w.gain *= other
+                return w
+            return self.__class__(self.ys * self.ys.dtype.type(other), framerate=self.framerate, start=self.start,
+                                  sampwidth=self.sampwidth, precision=self.precision)
+        if self.framerate != other.framerate:
+            raise ValueError(f"cannot multiply waves at {self.framerate} and {other.framerate} frames per second")
+
+        i = self._frame_offset()
+        j = other._frame_offset()
+        lo = max(i, j)
+        hi = max(lo, min(i + len(self), j + len(other)))
+        ys = self.get_frames(lo - i, hi - i) * other.get_frames(lo - j, hi - j)
+        return self.__class__(ys, framerate=self.framerate, start=lo / self.framerate)
+
+    def __rmul__(self, other):
+        return self * other
+
+    def __imul__(self, other):
+        """Multiplies this wave in place by another one or by a number.
+
+        By a number an encoded wave only changes its gain. By a wave, the
+        frames of self that other does not cover become silence and self
+        keeps its span. An encoded wave is decoded first.
 
-        ys = self.ys * other.ys
-        return Wave(ys, self.ts, self.framerate)
+        other: ImeWave or number
+
+        returns: this ImeWave
+        """
+        if not isinstance(other, ImeWave):
+            self.scale(other)
+            return self
+        if self.framerate != other.framerate:
+            raise ValueError(f"cannot multiply waves at {self.framerate} and {other.framerate} frames per second")
+
+        i = self._frame_offset()
+        j = other._frame_offset()
+        ys = self.ys
+        if numpy.broadcast_shapes(ys.shape[:-1], other._frame_shape()) != ys.shape[:-1]:
+            raise ValueError(f"cannot multiply {self.nchannels} channels by {other.nchannels} in place")
+        self._own()
+        ys = self._ys
+        lo = max(0, j - i)
+        hi = max(lo, min(len(self), j - i + len(other)))
+        ys[..., :lo] = 0
+        ys[..., hi:] = 0
+        step = len(other) if other._raw is None else ImeWavFile.BLOCK_FRAMES
+        for k in range(lo, hi, max(1, step)):
+            end = min(hi, k + step)
+            ys[..., k:end] *= other.get_frames(k + i - j, end + i - j)
+        return self
 
     def max_diff(self, other):
         """Computes the maximum absolute difference between waves.
@@ -233,25 +638,65 @@ class ImeWave:
         ys = self.ys - other.ys
         return numpy.max(numpy.abs(ys))
 
-    def convolve(self, other):
+    def convolve(self, other, method=ImeConvolver.METHOD_AUTO):
         """Convolves two waves.
 
         Note: this operation ignores the timestamps; the result
-        has the timestamps of self.
+        has the timestamps of self. Long windows, e.g. a reverb impulse
+        response, are convolved through the FFT, see ImeConvolver.
 
-        other: Wave or NumPy array
+        other: ImeWave or NumPy array
+        method: one of the ImeConvolver.METHOD_ constants, picked by the
+                sizes by default
 
-        returns: Wave
+        returns: ImeWave
         """
-        if isinstance(other, Wave):
+        if isinstance(other, ImeWave):
             assert self.framerate == other.framerate
             window = other.ys
         else:
             window = other
 
-        ys = numpy.convolve(self.ys, window, mode="full")
-        # ts = numpy.arange(len(ys)) / self.framerate
-        return Wave(ys, framerate=self.framerate)
+        ys = ImeConvolver.convolve(self.ys, window, method)
+        return self.__class__(ys, framerate=self.framerate)
+
+    def stft(self, n_fft=ImeSpectrogram.DEFAULT_NFFT, hop=None, window=ImeSpectrogram.WINDOW_HANN, center=True,
+             dtype=numpy.float32, chunk_columns=ImeSpectrogram.CHUNK_COLUMNS):
+        """Computes the short-time Fourier transform, see ImeSpectrogram.
+
+        The frames are read through get_frames a chunk of columns at a time,
+        so an encoded or mapped wave is never decoded as a whole.
+
+        n_fft: frames per window, the transform size
+        hop: frames between columns, default is n_fft // 4
+        window: one of the ImeSpectrogram.WINDOW_ names or an array
+        center: boolean, center column t on frame t * hop
+        dtype: float dtype of the transforms, float32 gives complex64
+        chunk_columns: columns transformed per batch
+
+        returns: complex array of shape (1 + n_fft // 2, columns), or
+                 (nchannels, 1 + n_fft // 2, columns)
+        """
+        return ImeSpectrogram.collect(
+            ImeSpectrogram.iter_stft(self.get_frames, len(self), n_fft, hop, window, center, dtype, chunk_columns),
+            ImeSpectrogram.count_columns(len(self), n_fft, hop, center))
+
+    def spectrogram(self, n_fft=ImeSpectrogram.DEFAULT_NFFT, hop=None, window=ImeSpectrogram.WINDOW_HANN, center=True,
+                    power=2.0, dtype=numpy.float32, chunk_columns=ImeSpectrogram.CHUNK_COLUMNS):
+        """Computes the magnitude spectrogram, |stft| ** power.
+
+        Like stft, only a chunk of the complex spectra is ever in memory.
+
+        power: 1.0 for magnitude, 2.0 for power
+        other parameters: see stft
+
+        returns: float array of shape (1 + n_fft // 2, columns), or
+                 (nchannels, 1 + n_fft // 2, columns)
+        """
+        return ImeSpectrogram.collect(
+            ImeSpectrogram.iter_stft(self.get_frames, len(self), n_fft, hop, window, center, dtype, chunk_columns),
+            ImeSpectrogram.count_columns(len(self), n_fft, hop, center),
+            lambda block: ImeSpectrogram.magnitude(block, power))
 
     def diff(self):
         """Computes the difference between successive elements.
@@ -259,17 +704,36 @@ class ImeWave:
         returns: new Wave
         """
         ys = numpy.diff(self.ys)
-        ts = self.ts[1:].copy()
-        return Wave(ys, ts, self.framerate)
+        return self.__class__(ys, framerate=self.framerate, start=self.start + 1 / self.framerate)
 
     def cumsum(self):
         """Computes the cumulative sum of the elements.
 
         returns: new Wave
         """
-        ys = numpy.cumsum(self.ys)
-        ts = self.ts.copy()
-        return Wave(ys, ts, self.framerate)
+        ys = numpy.cumsum(self.ys, axis=-1)
+        return self.__class__(ys, framerate=self.framerate, start=self.start)
+
+    def resample(self, framerate, block_frames=ImeWavFile.BLOCK_FRAMES):
+        """Converts the wave to another frame rate.
+
+        The frames stream through an ImeResampler a block at a time into the
+        new array, so an encoded or mapped wave is never decoded as a whole.
+
+        framerate: frames per second of the new wave
+        block_frames: frames converted per block
+
+        returns: new Wave
+        """
+        resampler = ImeResampler.ImeResampler(self.framerate, framerate, dtype=self.working_dtype)
+        ys = numpy.empty((self.nchannels, resampler.nframes_out(len(self))), dtype=self.working_dtype)
+        i = 0
+        for block in resampler(self.iter_blocks(block_frames)):
+            block = block.reshape(self.nchannels, -1)
+            ys[:, i:i + block.shape[-1]] = block
+            i += block.shape[-1]
+        return self.__class__(ys[0] if self.nchannels == 1 else ys, framerate=framerate, start=self.start,
+                              sampwidth=self.sampwidth, precision=self.precision)
 
     def quantize(self, bound, dtype):
         """Maps the waveform to quanta.
@@ -281,6 +745,36 @@ class ImeWave:
         """
         return quantize(self.ys, bound, dtype)
 
+    def to_file(self, filename, bits=16, is_float=False, dither=False, block_frames=ImeWavFile.BLOCK_FRAMES):
+        """Writes the wave to a wav file.
+
+        The frames are encoded a block at a time, an encoded or mapped wave
+        is never decoded as a whole.
+
+        filename: path of the wav file to create
+        bits: bits per sample, see ImeWavWriter
+        is_float: boolean, write floating point PCM
+        dither: boolean, add TPDF dither when writing integer samples
+        block_frames: frames encoded per write
+        """
+        with ImeWavWriter.ImeWavWriter(filename, self.framerate, nchannels=self.nchannels, bits=bits,
+                                       is_float=is_float, dither=dither) as writer:
+            # the writer wants interleaved (frames, nchannels) blocks
+            writer.write_blocks(
+                self.get_frames(i, i + block_frames).T for i in range(0, len(self), block_frames))
+
+    def lazy(self):
+        """Starts a chain of transforms that are evaluated later, fused.
+
+        The ImeLazyWave has scale, apodize, hamming, window, unbias and
+        normalize, which record the transform instead of applying it, and
+        evaluate, which applies them all a block at a time into a new wave.
+        This wave is not modified.
+
+        returns: new ImeLazyWave
+        """
+        return ImeLazyWave.ImeLazyWave(self)
+
     def apodize(self, denom=20, duration=0.1):
         """Tapers the amplitude at the beginning and end of the signal.
 
@@ -294,20 +788,28 @@ class ImeWave:
 
     def hamming(self):
         """Apply a Hamming window to the wave."""
-        self.ys *= numpy.hamming(len(self.ys))
+        self._own()
+        self.ys *= numpy.hamming(len(self))
 
     def window(self, window):
         """Apply a window to the wave.
 
-        window: sequence of multipliers, same length as self.ys
+        window: sequence of multipliers, same length as the wave
         """
+        self._own()
         self.ys *= window
 
     def scale(self, factor):
         """Multplies the wave by a factor.
 
+        An encoded wave only changes its gain.
+
         factor: scale factor
         """
+        if self._raw is not None:
+            self.gain *= factor
+            return
+        self._own()
         self.ys *= factor
 
     def shift(self, shift):
@@ -315,12 +817,11 @@ class ImeWave:
 
         shift: float time shift
         """
-        # TODO: track down other uses of this function and check them
-        self.ts += shift
+        self._start += shift
 
     def roll(self, roll):
         """Rolls this wave by the given number of locations."""
-        self.ys = numpy.roll(self.ys, roll)
+        self.ys = numpy.roll(self.ys, roll, axis=-1)
 
     def truncate(self, n):
         """Trims this wave to the given length.
@@ -328,7 +829,6 @@ class ImeWave:
         n: integer index
         """
         self.ys = truncate(self.ys, n)
-        self.ts = truncate(self.ts, n)
 
     def zero_pad(self, n):
         """Trims this wave to the given length.
@@ -336,15 +836,22 @@ class ImeWave:
         n: integer index
         """
         self.ys = zero_pad(self.ys, n)
-        self.ts = self.start + numpy.arange(n) / self.framerate
 
     def normalize(self, amp=1.0):
         """Normalizes the signal to the given amplitude.
 
         amp: float amplitude
         """
-        high, low = abs(max(self.ys)), abs(min(self.ys))
-        self.ys = amp * self.ys / max(high, low)
+        peak = self._peak()
+        if not peak:
+            return
+        if self._raw is not None:
+            self.gain *= amp / peak
+        elif self._ys.dtype.kind == 'f':
+            self._own()
+            self._ys *= amp / peak
+        else:
+            self.ys = self._ys * self.working_dtype.type(amp / peak)
 
     def unbias(self):
         """Unbiases the signal."""
@@ -352,11 +859,17 @@ class ImeWave:
 
     def find_index(self, t):
         """Find the index corresponding to a given time."""
-        n = len(self)
-        start = self.start
-        end = self.end
-        i = round((n - 1) * (t - start) / (end - start))
-        return int(i)
+        return int(round((t - self._start) * self.framerate))
+
+    def _frame_offset(self):
+        """Returns the start as a whole number of frames from time zero."""
+        offset = self.offset
+        i = int(round(offset))
+        if abs(offset - i) > 0.1:
+            warnings.warn(
+                "Can't align this waveform; its start is not on a frame boundary."
+            )
+        return i
 
     def segment(self, start=None, duration=None):
         """Extracts a segment.
@@ -367,7 +880,7 @@ class ImeWave:
         returns: Wave
         """
         if start is None:
-            start = self.ts[0]
+            start = self.start
             i = 0
         else:
             i = self.find_index(start)
@@ -378,13 +891,93 @@ class ImeWave:
     def slice(self, i, j):
         """Makes a slice from a Wave.
 
+        The slice shares the samples of this wave, copy-on-write like copy,
+        an encoded slice maps the same encoded frames.
+
         i: first slice index
         j: second slice index
+
+        returns: new ImeWave
         """
-        ys = self.ys[i:j].copy()
-        ts = self.ts[i:j].copy()
-        return Wave(ys, ts, self.framerate)
+        i, j, _ = slice(i, j).indices(len(self))
+        j = max(i, j)
+        start = self.start + i / self.framerate
+        if self._raw is not None:
+            w = self._share(start=start)
+            w._source = copy.copy(self._source)
+            w._raw = self._raw[i:j]
+            w.nframes = j - i
+            return w
+        w = self.__class__(None, framerate=self.framerate, sampwidth=self.sampwidth, start=start,
+                           precision=self.precision)
+        self._share_ys(w, self._ys[..., i:j])
+        return w
+
+
+def apodize_gains(start, end, n, k):
+    """Returns the taper of apodize for frames [start, end) of n frames.
+
+    start: first frame
+    end: frame one past the last frame
+    n: total number of frames
+    k: frames tapered at each end
+
+    returns: NumPy array of end - start multipliers
+    """
+    i = numpy.arange(start, end, dtype=numpy.float64)
+    if k < 2:
+        return numpy.ones_like(i)
+    # the same ramps as linspace(0, 1, k) and linspace(1, 0, k)
+    return numpy.clip(numpy.minimum(i, n - 1 - i) / (k - 1), 0.0, 1.0)
+
+
+def apodize(ys, framerate, denom=20, duration=0.1):
+    """Tapers the amplitude at the beginning and end of the signal.
+
+    Tapers either the given duration of time or the given
+    fraction of the total duration, whichever is less.
+
+    ys: wave array
+    framerate: int frames per second
+    denom: float fraction of the segment to taper
+    duration: float duration of the taper in seconds
+
+    returns: wave array
+    """
+    n = ys.shape[-1]
+    k = min(n // denom, int(duration * framerate))
+    return ys * apodize_gains(0, n, n, k).astype(ys.dtype, copy=False)
+
+
+def truncate(ys, n):
+    """Trims a wave array to the given length.
+
+    ys: wave array
+    n: integer length
+
+    returns: wave array
+    """
+    return ys[..., :n]
+
+
+def zero_pad(array, n):
+    """Extends an array with zeros.
+
+    array: NumPy array
+    n: length of result
+
+    returns: new NumPy array
+    """
+    res = numpy.zeros(array.shape[:-1] + (n,), dtype=array.dtype)
+    res[..., : array.shape[-1]] = array
+    return res
 
 
+def unbias(ys):
+    """Shifts a wave array so it has mean 0.
 
+    ys: wave array
 
+    returns: wave array
+    """
+    return ys - ys.mean(axis=-1, keepdims=True)
@@ -0,0 +1,236 @@
+#!python3
+r""" ImeWaveCache.py
+
+    ImeWaveCache keeps decoded working-format copies of source files on
+    disk so reopening them is a memory map rather than a decode.
+
+    An entry is a .npy file holding the planar ys of the wave and a .json file
+    with the rest of what ImeWave needs. Entries are named by a hash of the
+    source's content plus the parameters of the decode, so renaming or
+    copying a file still hits, while editing it or changing the precision
+    misses. Hashing a large file costs a full read, so the hash is remembered
+    per path together with the size and mtime it was computed for.
+
+    The total size of the entries is kept under a budget by evicting the
+    least recently used ones. Using an entry touches its mtime.
+
+    Sources are decoded by the functions in decoders, keyed by extension.
+    Compressed formats (mp3, m4a) can be added there: decode once into the
+    cache, then serve at disk speed.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import hashlib
+import json
+import os
+import pathlib
+import threading
+
+import numpy
+
+import ImeResampler
+import ImeWave
+import ImeWavFile
+
+try:
+    import platformdirs
+except ImportError:
+    platformdirs = None
+
+
+DEFAULT_BUDGET = 8 << 30    # bytes
+# bumped whenever the decode or the entry layout changes, invalidating entries
+CACHE_VERSION = 2
+HASH_BLOCK = 1 << 20
+
+
+def default_directory():
+    if platformdirs:
+        return pathlib.Path(platformdirs.user_cache_dir(appname='ime', appauthor=False)) / 'waves'
+    return pathlib.Path.home() / '.cache' / 'ime' / 'waves'
+
+
+def _decode_wav(filename, ys_path, dtype, framerate=None):
+    """Decodes a wav file straight into a new .npy file.
+
+    The array is created as a memory map and the file is decoded into it a
+    block at a time, so the decode never holds the whole signal in RAM. With
+    a framerate other than the file's, each block goes through an
+    ImeResampler on its way in.
+
+    returns: dict of the ImeWave attributes besides ys
+    """
+    info = ImeWavFile.ImeWavFile(filename)
+    framerate = framerate or info.framerate
+    if framerate == info.framerate:
+        ys = numpy.lib.format.open_memmap(ys_path, mode='w+', dtype=dtype, shape=(info.nchannels, info.nframes))
+        info.read(out=ys, planar=True)
+    else:
+        resampler = ImeResampler.ImeResampler(info.framerate, framerate, dtype=dtype)
+        nframes = resampler.nframes_out(info.nframes)
+        ys = numpy.lib.format.open_memmap(ys_path, mode='w+', dtype=dtype, shape=(info.nchannels, nframes))
+        blocks = (info.read(dtype=dtype, start=start, nframes=ImeWavFile.BLOCK_FRAMES, planar=True)
+                  for start in range(0, info.nframes, ImeWavFile.BLOCK_FRAMES))
+        i = 0
+        for zs in resampler(blocks):
+            ys[:, i:i + zs.shape[-1]] = zs
+            i += zs.shape[-1]
+    ys.flush()
+    nframes = ys.shape[-1]
+    del ys
+    return dict(framerate=framerate, nframes=nframes, sampwidth=info.bits)
+
+
+# extension: function(filename, ys_path, dtype, framerate) -> dict of ImeWave attributes
+decoders = {
+    '.wav': _decode_wav,
+}
+
+
+class ImeWaveCache:
+    """A directory of decoded waves, evicted least recently used first."""
+
+    def __init__(self, directory=None, budget=DEFAULT_BUDGET):
+        """Opens or creates the cache.
+
+        directory: folder of the cache, default is the user cache folder
+        budget: maximum total size of the entries in bytes
+        """
+        self.directory = pathlib.Path(directory) if directory else default_directory()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._hashes_path = self.directory / 'hashes.json'
+        try:
+            self._hashes = json.loads(self._hashes_path.read_text())
+        except (OSError, ValueError):
+            self._hashes = dict()
+
+    def __repr__(self):
+        return f"ImeWaveCache({str(self.directory)!r}, budget={self.budget})"
+
+    def content_hash(self, filename):
+        """Returns the sha256 of the file's content, remembered per path."""
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        with self._lock:
+            known = self._hashes.get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while block := f.read(HASH_BLOCK):
+                h.update(block)
+        digest = h.hexdigest()
+        with self._lock:
+            self._hashes[path] = [st.st_size, st.st_mtime_ns, digest]
+            self._write_hashes()
+        return digest
+
+    def key(self, filename, precision, framerate=None):
+        """Names the entry for filename decoded with precision at framerate."""
+        params = f"{CACHE_VERSION}:{precision}:{framerate or 'source'}"
+        return hashlib.sha256(f"{self.content_hash(filename)}:{params}".encode()).hexdigest()[:32]
+
+    def open(self, filename, precision=None, framerate=None):
+        """Returns filename as an ImeWave whose ys is mapped from the cache.
+
+        The file is decoded into the cache first if it is not there yet.
+
+        filename: path of the source file
+        precision: PRECISION_FLOAT32 or PRECISION_FLOAT64, default is
+                   ImeWave.ImeWave.precision
+        framerate: optional frames per second, the entry is resampled to it
+                   once when it is added
+
+        returns: new ImeWave
+        """
+        precision = precision or ImeWave.ImeWave.precision
+        if precision == ImeWave.PRECISION_NATIVE:
+            raise ValueError(f"{self.__class__.__name__} holds decoded waves, {precision=} keeps them encoded")
+        key = self.key(filename, precision, framerate)
+        ys_path = self.directory / f"{key}.npy"
+        meta_path = self.directory / f"{key}.json"
+        try:
+            meta = json.loads(meta_path.read_text())
+            os.utime(ys_path)
+            os.utime(meta_path)
+        except (OSError, ValueError):
+            meta = self._add(filename, precision, framerate, ys_path, meta_path)
+
+        # copy on write, so in place DSP on the wave never reaches the cache
+        ys = numpy.load(ys_path, mmap_mode='c')
+        if len(ys) == 1:
+            ys = ys[0]
+        return ImeWave.ImeWave(ys, precision=precision, **meta)
+
+    def _add(self, filename, precision, framerate, ys_path, meta_path):
+        ext = pathlib.Path(filename).suffix.lower()
+        if ext not in decoders:
+            raise ValueError(f"{self.__class__.__name__} has no decoder for {ext} files")
+        # decode under temporary names, so concurrent opens of the same file
+        # and crashes never leave a partial entry behind
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        tmp_ys = ys_path.with_name(ys_path.name + suffix)
+        tmp_meta = meta_path.with_name(meta_path.name + suffix)
+        try:
+            meta = decoders[ext](filename, tmp_ys, ImeWave._working_dtypes[precision], framerate)
+            tmp_meta.write_text(json.dumps(meta))
+            os.replace(tmp_ys, ys_path)
+            os.replace(tmp_meta, meta_path)
+        finally:
+            for tmp in (tmp_ys, tmp_meta):
+                tmp.unlink(missing_ok=True)
+        # the new entry stays even if it alone is over budget
+        self.evict(keep=ys_path)
+        return meta
+
+    def size(self):
+        """Returns the total size of the entries in bytes."""
+        return sum(p.stat().st_size for p in self.directory.glob('*.npy'))
+
+    def evict(self, budget=None, keep=None):
+        """Removes least recently used entries until they fit the budget.
+
+        budget: bytes to fit in, default is self.budget
+        keep: path of an entry that must not be removed
+        """
+        budget = self.budget if budget is None else budget
+        with self._lock:
+            entries = []
+            for p in self.directory.glob('*.npy'):
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, p))
+            total = sum(size for _, size, _ in entries)
+            for _, size, p in sorted(entries):
+                if total <= budget:
+                    break
+                if p == keep:
+                    continue
+                # an entry mapped by a live ImeWave keeps its data until the
+                # wave is gone on posix, on Windows the unlink fails and the
+                # entry survives until the next eviction
+                try:
+                    p.unlink()
+                    p.with_suffix('.json').unlink(missing_ok=True)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self):
+        """Removes every entry."""
+        self.evict(budget=0)
+
+    def _write_hashes(self):
+        # other processes, e.g. bounce workers, write the same memo, each
+        # under its own temporary name, the last replace wins
+        tmp = self._hashes_path.with_name(f"{self._hashes_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            tmp.write_text(json.dumps(self._hashes))
+            os.replace(tmp, self._hashes_path)
+        except OSError:
+            # a lost update only means hashing the file again next time
+            tmp.unlink(missing_ok=True)
@@ -0,0 +1,72 @@
+#!python3
+r""" file_bounce.py - file_bounce action module
+
+This module publishes the file_bounce action, which renders the project
+mixdown to a wav file faster than real time, see ImeBounce.
+
+The bounce runs in worker processes coordinated by an ImeBouncer, so the GUI
+stays responsive. Progress is shown in the status bar next to a button that
+cancels the bounce, which deletes the unfinished files.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+
+import PySide6
+
+import ImeBounce
+
+
+def attach_action(parent):
+    a = PySide6.QtGui.QAction(
+        PySide6.QtGui.QIcon('./assets/file_save.svg'),
+        'Bounce',
+        parent)
+    a.setShortcut(PySide6.QtGui.QKeySequence(PySide6.QtCore.Qt.CTRL | PySide6.QtCore.Qt.ALT | PySide6.QtCore.Qt.Key_B))
+    parent.file_bounce = file_bounce.__get__(parent)
+    a.triggered.connect(parent.file_bounce)
+    return a
+
+
+def file_bounce(self):
+    filename, _ = PySide6.QtWidgets.QFileDialog.getSaveFileName(
+        self,
+        "Bounce To",
+        str(self.default_dir),
+        "Wave File (*.wav)"
+    )
+    if not filename:
+        return
+
+    bouncer = ImeBounce.ImeBouncer(self)
+    cancel_button = PySide6.QtWidgets.QPushButton("Cancel")
+    cancel_button.clicked.connect(bouncer.cancel)
+    self.status_bar.addPermanentWidget(cancel_button)
+
+    def progress(done, total):
+        self.status_bar.showMessage(f"Bounced {done} of {total} segments to {filename}")
+
+    def done():
+        self.status_bar.removeWidget(cancel_button)
+        cancel_button.deleteLater()
+        bouncer.deleteLater()
+
+    def finished(filenames):
+        self.status_bar.showMessage(f"Bounced {', '.join(filenames)}")
+        done()
+
+    def cancelled():
+        self.status_bar.showMessage(f"Bounce to {filename} cancelled")
+        done()
+
+    def failed(error):
+        self.status_bar.showMessage(f"Bounce to {filename} failed: {error}")
+        done()
+
+    bouncer.progress_signal.connect(progress)
+    bouncer.finished_signal.connect(finished)
+    bouncer.cancelled_signal.connect(cancelled)
+    bouncer.failed_signal.connect(failed)
+    try:
+        bouncer.start(self.tracks, filename)
+    except ValueError as e:
+        failed(str(e))
@@ -7,11 +7,17 @@ function, passing the main window's object.
 This module must instantiate the action and attach both the action and its
 related callback to the main window object, parent.
 
+The selected files are decoded by an ImeFileLoader in a worker pool, so the
+GUI stays responsive. Each file becomes a track as soon as it finishes,
+progress is shown in the status bar next to a button that cancels the rest,
+and the files that failed to load are listed there when the loader finishes.
+
     Copyright (c) 2024 Chip Ueltschey All rights reserved.
 """
 
 import PySide6
 
+import ImeFileLoader
 import ImeTrack
 
 
@@ -27,16 +33,49 @@ def attach_action(parent):
 
 
 def file_open_dialog(self):
-    filename, ok = PySide6.QtWidgets.QFileDialog.getOpenFileName(
+    filenames, ok = PySide6.QtWidgets.QFileDialog.getOpenFileNames(
         self,
-        "Select a File",
+        "Select Files",
         str(self.default_dir),
         "Wave File (*.wav)"
     )
-    print(f"{filename=}, {ok=}")
-    if filename:
+    print(f"{filenames=}, {ok=}")
+    if not filenames:
+        return
+
+    loader = ImeFileLoader.ImeFileLoader(self)
+    cancel_button = PySide6.QtWidgets.QPushButton("Cancel")
+    cancel_button.clicked.connect(loader.cancel)
+    self.status_bar.addPermanentWidget(cancel_button)
+
+    def wave_loaded(filename, w, peaks):
         new_track = ImeTrack.ImeTrack(filename)
-        new_track.add_wav(filename)
+        new_track.add_wave(filename, w, peaks)
         self.tracks.append(new_track)
-    print(f"added to {self.tracks=}")
 
+    # progress follows every failure, so they are counted there and listed
+    # in the status bar once the loader is finished
+    failures = []
+
+    def load_failed(filename, error):
+        failures.append(f"{filename}: {error}")
+
+    def progress(filename, done, total):
+        failed = f", {len(failures)} failed" if failures else ""
+        self.status_bar.showMessage(f"Loaded {done} of {total} files{failed}: {filename}")
+
+    def finished():
+        self.status_bar.removeWidget(cancel_button)
+        cancel_button.deleteLater()
+        loader.deleteLater()
+        if failures:
+            self.status_bar.showMessage(f"Failed to load {'; '.join(failures)}")
+        print(f"added to {self.tracks=}")
+
+    loader.wave_loaded_signal.connect(wave_loaded)
+    loader.load_failed_signal.connect(load_failed)
+    loader.progress_signal.connect(progress)
+    loader.finished_signal.connect(finished)
+    # memory map the files so opening is cheap, see ImeTrack.add_wav
+    loader.load(filenames, mmap=True, precision=self.tracks.precision, cache=self.tracks.cache,
+                framerate=self.tracks.framerate)
@@ -1,23 +1,79 @@
 #!python3
-r""" player_record.py
+r""" player_record.py - player_record action module
 
+This module publishes the player_record action, which starts recording a
+take from the audio input at the playhead, on a new track, and stops it when
+triggered again, see ImeRecorder.
 
+The take is written to a file in the record_dir setting, the project
+directory by default, and grows on its track while it is recorded.
 
     Copyright (c) 2024 Chip Ueltschey All rights reserved.
 """
+import pathlib
+import time
+
 import PySide6.QtGui
 
+import ImeRecorder
+import ImeTrack
+
 
 def attach_action(parent):
     a = PySide6.QtGui.QAction(
         PySide6.QtGui.QIcon('./assets/player_record.svg'),
         'Record',
         parent)
-    #a.setShortcut('Ctrl+P')
+    a.setShortcut(PySide6.QtGui.QKeySequence(PySide6.QtCore.Qt.CTRL | PySide6.QtCore.Qt.Key_R))
+    parent.recorder = None
     parent.player_record = player_record.__get__(parent)
     a.triggered.connect(parent.player_record)
     return a
 
 
 def player_record(self):
-    print(f"player_record")
+    if self.recorder is not None:
+        self.recorder.stop()
+        return
+
+    record_dir = pathlib.Path(self.settings.value("record_dir", str(self.default_dir)))
+    filename = str(record_dir / time.strftime("take-%Y%m%d-%H%M%S.wav"))
+    position = self.player.io_device.frame()
+    recorder = ImeRecorder.ImeRecorder(self, self.settings, self.tracks.framerate)
+    track = ImeTrack.ImeTrack(pathlib.Path(filename).stem)
+    clip = None
+
+    def grown(nframes):
+        # the clip is made with the first frames, a clip cannot be empty
+        nonlocal clip
+        if clip is None:
+            clip = track.add_wave(filename, recorder.wave, recorder.peaks, position)
+        else:
+            clip.length = nframes
+            track.add_clip(clip)
+        track.data_changed_signal.emit()
+        self.status_bar.showMessage(f"Recording {filename}, {nframes / self.tracks.framerate:.1f} s")
+
+    def done():
+        self.recorder = None
+        recorder.deleteLater()
+
+    def finished(filename):
+        self.status_bar.showMessage(f"Recorded {filename}")
+        done()
+
+    def failed(error):
+        self.status_bar.showMessage(f"Recording to {filename} failed: {error}")
+        done()
+
+    recorder.grown_signal.connect(grown)
+    recorder.finished_signal.connect(finished)
+    recorder.failed_signal.connect(failed)
+    try:
+        recorder.start(filename)
+    except (OSError, ValueError) as e:
+        failed(str(e))
+        return
+    self.recorder = recorder
+    self.tracks.append(track)
+    self.player.play()
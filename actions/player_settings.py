@@ -0,0 +1,27 @@
+#!python3
+r""" player_settings.py - player_settings action module
+
+This module publishes the player_settings action, which edits the output
+device, sample format, channels and buffer size of the player. The sink is
+rebuilt with them right away, see ImeAudioPlayer.
+
+    Copyright (c) 2024 Chip Ueltschey All rights reserved.
+"""
+import PySide6.QtGui
+
+import ImeAudioPlayer
+
+
+def attach_action(parent):
+    a = PySide6.QtGui.QAction(
+        PySide6.QtGui.QIcon('./assets/filter-cog.svg'),
+        'Audio Settings',
+        parent)
+    parent.player_settings = player_settings.__get__(parent)
+    a.triggered.connect(parent.player_settings)
+    return a
+
+
+def player_settings(self):
+    dialog = ImeAudioPlayer.ImeAudioSettingsDialog(self, self.player)
+    dialog.exec()
@@ -34,6 +34,8 @@ import PySide6
 import ImeMixerView
 import ImeTrack
 import ImeActionManager
+import ImeMetrics
+import ImeWaveCache
 
 
 # The application three letter acronymn is used to prefix classes and serves as
@@ -48,6 +50,7 @@ application_menu = [
         [
             'file_new',
             'file_open',
+            'file_bounce',
         ]
     ),
     ('&Edit',
@@ -67,6 +70,11 @@ application_menu = [
             'track_del',
         ]
     ),
+    ('&Options',
+        [
+            'player_settings',
+        ]
+    ),
     ('&Help',
         [
             'about',
@@ -99,6 +107,10 @@ class ImeMainWindow(PySide6.QtWidgets.QMainWindow):
         # Initialize settings
         self.settings = PySide6.QtCore.QSettings(APPLICATION_TLA, APPLICATION_TLA)
 
+        # Decoded waves are cached across launches, the disk budget is a setting
+        self.tracks.cache = ImeWaveCache.ImeWaveCache(
+            budget=int(self.settings.value("wave_cache_budget", ImeWaveCache.DEFAULT_BUDGET)))
+
         # Restore geometry and state
         self.restore_settings()
 
@@ -127,6 +139,16 @@ class ImeMainWindow(PySide6.QtWidgets.QMainWindow):
         self.status_bar = PySide6.QtWidgets.QStatusBar()
         self.setStatusBar(self.status_bar)
 
+        # Audio path metrics, off by default, see ImeMetrics
+        self.metrics_reporter = None
+        if self.settings.value("metrics_enabled", False, type=bool):
+            self.metrics_reporter = ImeMetrics.ImeMetricsReporter(
+                self,
+                interval=int(self.settings.value("metrics_interval", 1000)),
+                filename=self.settings.value("metrics_snapshot", None))
+            self.status_bar.addPermanentWidget(self.metrics_reporter.label)
+            self.metrics_reporter.start()
+
         # Process the actions folder to instantiate all actions, attaching them to this window object.
         self.status_bar.showMessage("Loading actions...")
         self.attached_actions = ImeActionManager.ImeActionManager(self)
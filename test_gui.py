@@ -39,6 +39,8 @@ import PySide6.QtCore
 import PySide6.QtMultimedia
 import PySide6.QtWidgets
 
+import ImeSpectrogram
+
 class LibrosaDemo():
     pass
 
@@ -69,7 +71,7 @@ def work():
     # how do I put that on the canvas
 
     # Display Power
-    D = librosa.amplitude_to_db(np.abs(librosa.stft(y)), ref=np.max)
+    D = ImeSpectrogram.amplitude_to_db(np.abs(ImeSpectrogram.stft(y)), ref=np.max)
     librosa.display.specshow(D, y_axis='linear', x_axis='time')
     plt.colorbar()
     # need to put this picture on there somwhere